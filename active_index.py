@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import re
+
+from sqlalchemy.future import select
+
+from models import Record, RecordStatus
+from shards import shard_router
+
+
+# 在场车辆的内存索引
+# 入场时判断"车辆/用户是否已经在停车"不再每次查询records表,而是查这里的字典
+# 启动时从records表构建,入场/出场时同步更新,并定期与数据库对账
+RECONCILE_INTERVAL = int(os.getenv("ACTIVE_INDEX_RECONCILE_INTERVAL", "300"))  # 对账间隔(秒)
+
+
+# 车牌标准化: 去掉空格、横线和分隔点,统一大写,容易混淆的字母换成数字(O->0, I->1)
+# 车牌一般不会只靠O/0、I/1来区分,按同一辆车处理
+PLATE_CONFUSABLES = str.maketrans({"O": "0", "I": "1"})
+
+
+def normalize_plate(car_number: str) -> str:
+    return re.sub(r"[\s\-·.]", "", car_number or "").upper().translate(PLATE_CONFUSABLES)
+
+
+class ActiveVehicle:
+    __slots__ = ("record_id", "user_id", "plate", "parking_lot_id")
+
+    def __init__(self, record_id, user_id, plate, parking_lot_id):
+        self.record_id = record_id  # 占位(还未写入数据库)时为None
+        self.user_id = user_id
+        self.plate = plate
+        self.parking_lot_id = parking_lot_id
+
+
+class ActiveVehicleIndex:
+    # 所有修改方法都是同步的,中间没有await,在事件循环里天然是原子的
+    def __init__(self):
+        self.by_plate = {}   # 标准化车牌 -> ActiveVehicle
+        self.by_user = {}    # 用户ID -> ActiveVehicle
+        self.by_record = {}  # 记录ID -> ActiveVehicle
+        self._touched = None  # 对账期间被入场/出场修改过的记录ID
+
+    def __len__(self):
+        return len(self.by_record)
+
+    def user_parked(self, user_id: int) -> bool:
+        return user_id in self.by_user
+
+    def plate_parked(self, car_number: str) -> bool:
+        return normalize_plate(car_number) in self.by_plate
+
+    # 入场前先占位,防止同一用户/车辆的并发请求同时通过检查
+    # 调用方需要保证检查和占位之间没有await
+    def claim(self, user_id: int, car_number: str, parking_lot_id: int) -> ActiveVehicle:
+        vehicle = ActiveVehicle(None, user_id, normalize_plate(car_number), parking_lot_id)
+        self.by_user[vehicle.user_id] = vehicle
+        self.by_plate[vehicle.plate] = vehicle
+        return vehicle
+
+    # 记录写入数据库后确认占位
+    def confirm(self, vehicle: ActiveVehicle, record_id: int):
+        vehicle.record_id = record_id
+        self.by_record[record_id] = vehicle
+        if self._touched is not None:
+            self._touched.add(record_id)
+
+    # 入场失败时释放占位
+    def release(self, vehicle: ActiveVehicle):
+        if self.by_user.get(vehicle.user_id) is vehicle:
+            del self.by_user[vehicle.user_id]
+        if self.by_plate.get(vehicle.plate) is vehicle:
+            del self.by_plate[vehicle.plate]
+        if vehicle.record_id is not None and self.by_record.get(vehicle.record_id) is vehicle:
+            del self.by_record[vehicle.record_id]
+
+    # 出场
+    def check_out(self, record_id: int):
+        vehicle = self.by_record.get(record_id)
+        if vehicle:
+            self.release(vehicle)
+        if self._touched is not None:
+            self._touched.add(record_id)
+
+    # 用数据库里的PARKED记录替换索引内容,返回不一致的记录数
+    def _apply(self, rows, touched=frozenset()) -> int:
+        by_plate, by_user, by_record = {}, {}, {}
+
+        def add(vehicle):
+            by_plate[vehicle.plate] = vehicle
+            by_user[vehicle.user_id] = vehicle
+            if vehicle.record_id is not None:
+                by_record[vehicle.record_id] = vehicle
+
+        db_ids = set()
+        for row in rows:
+            db_ids.add(row.id)
+            if row.id not in touched:
+                add(ActiveVehicle(row.id, row.user_id, normalize_plate(row.car_number), row.parking_lot_id))
+
+        # 对账期间发生变化的记录以内存为准,占位中的请求也保留
+        for vehicle in list(self.by_plate.values()) + list(self.by_user.values()):
+            if vehicle.record_id is None or vehicle.record_id in touched:
+                add(vehicle)
+
+        drift = len((db_ids ^ set(self.by_record)) - set(touched))
+        self.by_plate, self.by_user, self.by_record = by_plate, by_user, by_record
+        return drift
+
+    async def _load_parked(self):
+        async def load(db):
+            result = await db.execute(
+                select(Record.id, Record.user_id, Record.car_number, Record.parking_lot_id)
+                .filter(Record.status == RecordStatus.PARKED)
+            )
+            return result.all()
+        return await shard_router.gather(load)
+
+    # 启动时构建索引
+    async def rebuild(self):
+        rows = await self._load_parked()
+        self._apply(rows)
+        logging.info(f"在场车辆索引已构建: {len(self)} 辆")
+
+    # 与数据库对账
+    async def reconcile(self) -> int:
+        self._touched = set()
+        try:
+            rows = await self._load_parked()
+            drift = self._apply(rows, self._touched)
+        finally:
+            self._touched = None
+        if drift:
+            logging.warning(f"在场车辆索引与数据库不一致,已修正 {drift} 条")
+        return drift
+
+
+active_index = ActiveVehicleIndex()
+
+
+# 后台定期对账
+async def reconcile_loop():
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            await active_index.reconcile()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"在场车辆索引对账时发生错误: {str(e)}")
+
+
+# 内存占用测试: python active_index.py
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+    from collections import namedtuple
+
+    Row = namedtuple("Row", "id user_id car_number parking_lot_id")
+    count = 100_000
+    rows = [Row(i, i, f"ab-{i:06d}", i % 50) for i in range(1, count + 1)]
+
+    tracemalloc.start()
+    index = ActiveVehicleIndex()
+    index._apply(rows)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{count} 辆在场车辆: 占用 {current / 1024 / 1024:.1f} MiB, 峰值 {peak / 1024 / 1024:.1f} MiB, "
+          f"每辆约 {current / count:.0f} 字节")
+
+    started = time.perf_counter()
+    for i in range(1, count + 1):
+        index.plate_parked(f"AB {i:06d}")
+        index.user_parked(i)
+    elapsed = time.perf_counter() - started
+    print(f"查重: 每次 {elapsed / count * 1e6:.2f} 微秒")
@@ -0,0 +1,202 @@
+import asyncio
+import math
+import os
+import re
+import time
+
+from fastapi import status
+from fastapi.responses import JSONResponse
+
+from database import pool_wait_monitor
+
+
+# 准入控制和限流
+# 高峰期所有请求都在等数据库连接池,大家一起变慢直到超时
+# 这里按接口类型分别限制并发,入场/出场优先; 按用户做令牌桶限流;
+# 连接池等待时间超过阈值时,先拒绝低优先级的请求(503),保证入场/出场的延迟
+def _env_int(name, default):
+    return int(os.getenv(name, str(default)))
+
+
+def _env_float(name, default):
+    return float(os.getenv(name, str(default)))
+
+
+# 接口分类: (类型, 方法, 路径); 按顺序匹配,都不匹配的归为normal
+ROUTE_CLASSES = (
+    ("critical", "POST", re.compile(r"^/customer/records$")),
+    ("critical", "PUT", re.compile(r"^/customer/records/\d+$")),
+    ("critical", None, re.compile(r"^/auth/")),
+    ("low", None, re.compile(r"^/admin/")),
+)
+# 不经过准入控制的路径(静态文件和首页)
+EXEMPT_PATHS = re.compile(r"^/($|static/)")
+
+# 每类接口的并发上限、排队等待的最长秒数、开始拒绝请求的连接池平均等待秒数
+CLASS_LIMITS = {
+    "critical": (_env_int("ADMISSION_CRITICAL_CONCURRENCY", 64), _env_float("ADMISSION_CRITICAL_QUEUE_TIMEOUT", 2.0),
+                 _env_float("ADMISSION_CRITICAL_POOL_WAIT", 1.0)),
+    "normal": (_env_int("ADMISSION_NORMAL_CONCURRENCY", 32), _env_float("ADMISSION_NORMAL_QUEUE_TIMEOUT", 0.5),
+               _env_float("ADMISSION_NORMAL_POOL_WAIT", 0.25)),
+    "low": (_env_int("ADMISSION_LOW_CONCURRENCY", 8), _env_float("ADMISSION_LOW_QUEUE_TIMEOUT", 0.1),
+            _env_float("ADMISSION_LOW_POOL_WAIT", 0.1)),
+}
+
+RATE_LIMIT_PER_SECOND = _env_float("RATE_LIMIT_PER_SECOND", 10.0)  # 每个用户每秒补充的令牌数
+RATE_LIMIT_BURST = _env_float("RATE_LIMIT_BURST", 20.0)  # 令牌桶容量
+RATE_LIMIT_MAX_BUCKETS = _env_int("RATE_LIMIT_MAX_BUCKETS", 100000)  # 最多保留的令牌桶数量
+OVERLOAD_RETRY_AFTER = _env_int("ADMISSION_RETRY_AFTER", 1)  # 过载时建议客户端重试的秒数
+
+
+def classify(method: str, path: str, query_string: bytes = b"") -> str:
+    for route_class, route_method, pattern in ROUTE_CLASSES:
+        if (route_method is None or route_method == method) and pattern.match(path):
+            return route_class
+    # 按位置搜索停车场也算低优先级
+    if path == "/parking/lots" and b"location=" in query_string:
+        return "low"
+    return "normal"
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate: float = RATE_LIMIT_PER_SECOND, burst: float = RATE_LIMIT_BURST,
+                 max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self._buckets = {}  # 客户端 -> [剩余令牌, 上次更新时间]
+
+    # 取一个令牌,成功返回0,否则返回需要等待的秒数
+    def acquire(self, client) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune(now)
+            bucket = self._buckets[client] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / self.rate
+
+    # 已经补满的令牌桶和新建的没有区别,可以直接丢掉
+    def _prune(self, now):
+        full = [client for client, (tokens, updated_at) in self._buckets.items()
+                if tokens + (now - updated_at) * self.rate >= self.burst]
+        for client in full:
+            del self._buckets[client]
+        if len(self._buckets) >= self.max_buckets:
+            self._buckets.clear()
+
+
+class AdmissionControlMiddleware:
+    # 需要放在SessionMiddleware里面,才能按用户限流
+    def __init__(self, app, monitor=None, limits: dict = None, rate_limiter: TokenBucketLimiter = None):
+        self.app = app
+        self.monitor = monitor or pool_wait_monitor
+        limits = limits or CLASS_LIMITS
+        self.limits = limits
+        self.semaphores = {name: asyncio.Semaphore(limit[0]) for name, limit in limits.items()}
+        self.rate_limiter = rate_limiter or TokenBucketLimiter()
+        self.rejected = {name: 0 for name in limits}  # 各类接口被拒绝的请求数
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or EXEMPT_PATHS.match(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        route_class = classify(scope["method"], scope["path"], scope.get("query_string", b""))
+        _, queue_timeout, pool_wait_threshold = self.limits[route_class]
+
+        # 按用户限流,未登录时按客户端地址
+        user_id = scope.get("session", {}).get("user_id")
+        client = user_id or (scope.get("client") or ("unknown",))[0]
+        retry_after = self.rate_limiter.acquire(client)
+        if retry_after:
+            await self._reject(route_class, status.HTTP_429_TOO_MANY_REQUESTS, "请求过于频繁，请稍后重试",
+                               math.ceil(retry_after), scope, receive, send)
+            return
+
+        # 数据库已经过载时直接拒绝,不再排队等连接
+        if self.monitor.current() > pool_wait_threshold:
+            await self._reject(route_class, status.HTTP_503_SERVICE_UNAVAILABLE, "服务繁忙，请稍后重试",
+                               OVERLOAD_RETRY_AFTER, scope, receive, send)
+            return
+
+        semaphore = self.semaphores[route_class]
+        try:
+            await asyncio.wait_for(semaphore.acquire(), queue_timeout)
+        except asyncio.TimeoutError:
+            await self._reject(route_class, status.HTTP_503_SERVICE_UNAVAILABLE, "服务繁忙，请稍后重试",
+                               OVERLOAD_RETRY_AFTER, scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            semaphore.release()
+
+    async def _reject(self, route_class, status_code, detail, retry_after, scope, receive, send):
+        self.rejected[route_class] += 1
+        response = JSONResponse(
+            status_code=status_code,
+            content={"detail": detail},
+            headers={"Retry-After": str(retry_after)}
+        )
+        await response(scope, receive, send)
+
+
+# 过载测试: python admission.py
+# 模拟一个只有5个连接的连接池,大量管理员查询和少量入场请求同时到达,对比入场请求的p99延迟
+if __name__ == "__main__":
+    import httpx
+    from fastapi import FastAPI
+    from database import PoolWaitMonitor
+
+    def build_app():
+        test_app = FastAPI()
+        pool = asyncio.Semaphore(5)
+        monitor = PoolWaitMonitor()
+
+        async def use_pool(seconds):
+            started = time.perf_counter()
+            async with pool:
+                monitor.record(time.perf_counter() - started)
+                await asyncio.sleep(seconds)
+
+        @test_app.post("/customer/records")
+        async def fake_check_in():
+            await use_pool(0.01)
+            return {"status": "PARKED"}
+
+        @test_app.get("/admin/records")
+        async def fake_admin_records():
+            await use_pool(0.05)
+            return []
+
+        return test_app, monitor
+
+    async def run(with_admission):
+        test_app, monitor = build_app()
+        app = AdmissionControlMiddleware(test_app, monitor, rate_limiter=TokenBucketLimiter(1e9, 1e9)) \
+            if with_admission else test_app
+        transport = httpx.ASGITransport(app=app)
+        latencies = []
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+            async def check_in():
+                started = time.perf_counter()
+                response = await client.post("/customer/records")
+                latencies.append((time.perf_counter() - started, response.status_code))
+
+            admin = [client.get("/admin/records") for _ in range(500)]
+            results = await asyncio.gather(*admin, *[check_in() for _ in range(100)])
+        ok = sorted(latency for latency, code in latencies if code == 200)
+        shed = sum(1 for result in results[:500] if result.status_code == 503)
+        p99 = ok[int(len(ok) * 0.99) - 1] if ok else float("nan")
+        label = "开启准入控制" if with_admission else "关闭准入控制"
+        print(f"{label}: 入场成功 {len(ok)}/100, p99 {p99 * 1000:.0f} 毫秒, 被拒绝的管理员请求 {shed}/500")
+
+    asyncio.run(run(False))
+    asyncio.run(run(True))
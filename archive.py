@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Record, ArchivedRecord, RecordStatus, RECORD_COLUMNS
+from shards import shard_router
+
+
+# 冷热数据归档
+# records表只保留进行中和最近完成的记录(热数据),更早的已完成记录分批迁移到records_archive(冷数据)
+# 每一批都是独立的小事务,批与批之间暂停一下,避免长时间持有锁影响入场/出场的请求
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))  # 完成多少天之后归档
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))  # 每批迁移的记录数
+ARCHIVE_BATCH_PAUSE = float(os.getenv("ARCHIVE_BATCH_PAUSE", "0.5"))  # 每批之间暂停的秒数
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "3600"))  # 后台归档任务的运行间隔(秒)
+
+
+# 迁移一批记录,返回本批迁移的数量
+async def archive_batch(db: AsyncSession, cutoff: datetime, batch_size: int) -> int:
+    try:
+        result = await db.execute(
+            select(Record.id)
+            .filter(
+                Record.status == RecordStatus.COMPLETED,
+                Record.exit_time < cutoff
+            )
+            .order_by(Record.id)
+            .limit(batch_size)
+        )
+        record_ids = result.scalars().all()
+        if not record_ids:
+            return 0
+
+        # 先复制到归档表,再从热表删除,两步在同一个事务里
+        await db.execute(
+            insert(ArchivedRecord).from_select(
+                list(RECORD_COLUMNS),
+                select(*[getattr(Record, name) for name in RECORD_COLUMNS])
+                .filter(Record.id.in_(record_ids))
+            )
+        )
+        await db.execute(
+            delete(Record)
+            .filter(Record.id.in_(record_ids))
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        return len(record_ids)
+    except Exception as e:
+        await db.rollback()
+        raise e
+
+
+# 归档所有超过保留期的已完成记录,返回迁移的总数
+async def archive_completed_records(
+    older_than_days: int = None,
+    batch_size: int = None,
+    pause: float = None,
+    max_batches: int = None
+) -> int:
+    older_than_days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    pause = ARCHIVE_BATCH_PAUSE if pause is None else pause
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+
+    total = 0
+    for shard in range(len(shard_router)):
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            # 每批使用新的会话,不让一个长事务贯穿整个归档过程
+            async with shard_router.session(shard) as db:
+                moved = await archive_batch(db, cutoff, batch_size)
+            total += moved
+            batches += 1
+            if moved < batch_size:
+                break
+            await asyncio.sleep(pause)
+
+    if total:
+        logging.info(f"归档完成: 迁移 {total} 条记录 (截止时间 {cutoff})")
+    return total
+
+
+# 后台定期归档
+async def archive_loop():
+    while True:
+        try:
+            await archive_completed_records()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"归档任务发生错误: {str(e)}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
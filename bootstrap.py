@@ -0,0 +1,168 @@
+import asyncio
+import os
+import statistics
+import time
+
+from sqlalchemy.future import select
+
+import circuit
+import crud
+import sync
+from circuit import DatabaseUnavailable
+from fast_json import record_rows
+from lot_snapshot import lot_snapshot
+from models import User, UserRole
+from pricing import priced
+from schemas import ParkingLotSearch
+from shards import shard_router
+from singleflight import coalesced_query
+
+
+# 页面首次加载的数据
+# 前端打开页面或登录之后原来要依次请求 /auth/status、/sync/changes(游标)、/parking/lots、
+# /customer/my-records(之前还要再查一次 /auth/status),管理员再加 /admin/records;
+# 这里一次返回用户、同步游标、停车场列表和第一页停车记录,各部分的查询同时执行
+# 游标和数据并发读取,之间的变化由增量同步的重叠时间(SYNC_OVERLAP_SECONDS)覆盖
+BOOTSTRAP_RECORDS_LIMIT = int(os.getenv("BOOTSTRAP_RECORDS_LIMIT", "50"))  # 第一页记录的条数
+
+
+async def _load_user(user_id: int):
+    async with shard_router.session() as db:
+        result = await db.execute(select(User.id, User.username, User.role).filter(User.id == user_id))
+        return result.first()
+
+
+async def _load_cursor():
+    async with shard_router.session() as db:
+        return await sync.current_cursor(db)
+
+
+# 和 /parking/lots 共用合并查询; 数据库不可用时用停车场快照
+async def _load_lots(location: str = None) -> tuple:
+    if circuit.degraded() and lot_snapshot.lots is not None:
+        return lot_snapshot.search(location), True
+    try:
+        lots = await coalesced_query(
+            "parking_lots", location, crud.get_parking_lots, search_criteria=ParkingLotSearch(location=location)
+        )
+    except DatabaseUnavailable:
+        if lot_snapshot.lots is None:
+            raise
+        return lot_snapshot.search(location), True
+    return [priced(lot).model_dump() for lot in lots], False
+
+
+async def _load_records(user_id: int = None, limit: int = BOOTSTRAP_RECORDS_LIMIT) -> list:
+    rows = await shard_router.gather_page(
+        crud.get_record_history, sort_key=crud.history_sort_key, descending=True,
+        skip=0, limit=limit, user_id=user_id
+    )
+    return record_rows(rows)
+
+
+# 未登录(或者会话里的用户已经不存在)时user为空,只返回停车场
+# 会话里的角色是管理员时另外查询所有用户的第一页记录(all_records),返回之前再按数据库里的角色确认
+async def load(user_id: int = None, role: str = None, location: str = None,
+               limit: int = BOOTSTRAP_RECORDS_LIMIT) -> dict:
+    queries = [_load_lots(location), _load_cursor()]
+    if user_id is not None:
+        queries += [_load_user(user_id), _load_records(user_id, limit)]
+        if role == UserRole.admin.value:
+            queries.append(_load_records(None, limit))
+    (lots, stale), cursor, *rest = await asyncio.gather(*queries)
+
+    data = {"user": None, "cursor": cursor, "lots": lots, "stale": stale, "records": [], "all_records": []}
+    user = rest[0] if rest else None
+    if user is None:
+        return data
+    user_role = getattr(user.role, "value", user.role)
+    data["user"] = {"id": user.id, "username": user.username, "role": user_role}
+    data["records"] = rest[1]
+    if user_role == UserRole.admin.value and len(rest) > 2:
+        data["all_records"] = rest[2]
+    return data
+
+
+# 页面加载的请求数和耗时: python bootstrap.py
+# 按前端原来的请求顺序(同一个函数里依次await,不同函数之间并发)和现在的一次请求对比,
+# 每个请求加上BENCH_RTT_MS的网络往返时间; 使用database.py里配置的数据库和默认管理员账号
+if __name__ == "__main__":
+    import logging
+
+    import httpx
+
+    BENCH_RTT_MS = float(os.getenv("BENCH_RTT_MS", "40"))
+    BENCH_ROUNDS = int(os.getenv("BENCH_ROUNDS", "20"))
+    BENCH_USERNAME = os.getenv("BENCH_USERNAME", "admin")
+    BENCH_PASSWORD = os.getenv("BENCH_PASSWORD", "adminpass")
+    # 原来的页面加载一次就有8-9个请求,连续测试会触发按用户限流,这里放开(导入main之前设置)
+    os.environ.setdefault("RATE_LIMIT_PER_SECOND", "100000")
+    os.environ.setdefault("RATE_LIMIT_BURST", "100000")
+
+    class LatencyTransport(httpx.AsyncBaseTransport):
+        def __init__(self, app):
+            self.transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+            self.requests = 0
+
+        async def handle_async_request(self, request):
+            self.requests += 1
+            await asyncio.sleep(BENCH_RTT_MS / 1000)
+            return await self.transport.handle_async_request(request)
+
+    # 原来的页面加载(已登录): 停车场和登录状态并发,登录状态返回之后再加载各个列表
+    # 原来登录之后还要固定等待1秒再查登录状态,这里没有计入
+    async def old_flow(client, admin: bool):
+        async def load_lots():
+            await client.get("/sync/changes")
+            await client.get("/parking/lots")
+
+        async def load_my_records():
+            await client.get("/sync/changes")
+            await client.get("/auth/status")
+            await client.get("/customer/my-records")
+
+        async def load_all_records():
+            await client.get("/sync/changes")
+            await client.get("/admin/records")
+
+        async def check_status():
+            await client.get("/auth/status")
+            loads = [load_lots(), load_my_records()]
+            if admin:
+                loads.append(load_all_records())
+            await asyncio.gather(*loads)
+
+        await asyncio.gather(load_lots(), check_status())
+
+    async def new_flow(client, admin: bool):
+        response = await client.get("/bootstrap")
+        assert response.status_code == 200, response.text
+
+    async def bench():
+        import main
+
+        logging.getLogger().setLevel(logging.WARNING)
+        for factory in shard_router.session_factories:
+            factory.kw["bind"].sync_engine.echo = False
+        await main.startup_event()
+        try:
+            transport = LatencyTransport(main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                response = await client.post("/auth/login", json={"username": BENCH_USERNAME, "password": BENCH_PASSWORD})
+                assert response.status_code == 200, response.text
+                admin = response.json()["role"] == UserRole.admin.value
+                await new_flow(client, admin)  # 预热
+                await old_flow(client, admin)
+                for name, flow in (("原来的请求顺序", old_flow), ("bootstrap", new_flow)):
+                    durations = []
+                    transport.requests = 0
+                    for _ in range(BENCH_ROUNDS):
+                        started = time.perf_counter()
+                        await flow(client, admin)
+                        durations.append(time.perf_counter() - started)
+                    print(f"{name}: 每次页面加载 {transport.requests / BENCH_ROUNDS:.0f} 个请求, "
+                          f"耗时中位数 {statistics.median(durations) * 1000:.1f} 毫秒 (往返时间 {BENCH_RTT_MS:g} 毫秒)")
+        finally:
+            await main.shutdown_event()
+
+    asyncio.run(bench())
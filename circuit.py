@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+import time
+
+from sqlalchemy import event, exc, text
+
+
+# 数据库熔断
+# 每个数据库引擎(主库和每个分库)一个熔断器: 连续失败(连接错误、断线、超时、慢查询)达到阈值时打开,
+# 打开期间新建会话直接抛出DatabaseUnavailable,请求马上失败,不再占着连接池和worker等超时
+# 打开DB_BREAKER_RESET_TIMEOUT秒之后进入半开状态,每个窗口只放行一个探测(真实请求或后台的SELECT 1),
+# 探测成功后关闭,失败则重新打开
+# 熔断只影响对应的数据库: 写请求先按停车场/记录ID路由到分库,新建会话时检查这个分库的熔断器(guard),
+# 只有目标分库熔断时才返回503,其他分库的入场/出场不受影响
+# 需要查询所有分库的停车场列表,在任何一个分库熔断时由最后一次成功查询的快照提供(lot_snapshot.py)
+DB_BREAKER_FAILURE_THRESHOLD = int(os.getenv("DB_BREAKER_FAILURE_THRESHOLD", "5"))  # 连续失败多少次打开
+DB_BREAKER_RESET_TIMEOUT = float(os.getenv("DB_BREAKER_RESET_TIMEOUT", "10"))  # 打开多少秒后开始探测
+DB_SLOW_CALL_SECONDS = float(os.getenv("DB_SLOW_CALL_SECONDS", "5"))  # 超过这个时间的SQL算一次失败
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "5"))  # 取连接的最长等待秒数
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class DatabaseUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # 状态修改都是同步的,在事件循环线程里执行(SQLAlchemy的事件也在这个线程的greenlet里触发)
+    def __init__(self, name: str, failure_threshold: int = DB_BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = DB_BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0  # 连续失败次数
+        self.opened_at = 0.0
+        self.probe_at = 0.0  # 半开状态下最近一次放行探测的时间
+        self.last_error = None
+        self.trips = 0
+        self.rejected = 0
+
+    # 新建会话之前调用,不允许访问数据库时抛出DatabaseUnavailable
+    def allow(self):
+        if self.state == CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self.probe_at = 0.0
+        if self.state == HALF_OPEN and now - self.probe_at >= self.reset_timeout:
+            self.probe_at = now
+            return
+        self.rejected += 1
+        raise DatabaseUnavailable(f"数据库({self.name})暂时不可用")
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logging.warning(f"数据库({self.name})已恢复,熔断器关闭")
+            self.state = CLOSED
+        self.failures = 0
+
+    def record_failure(self, reason: str):
+        self.failures += 1
+        self.last_error = reason
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            logging.error(f"数据库({self.name})连续失败 {self.failures} 次,熔断器打开: {reason}")
+
+    def metrics(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "last_error": self.last_error,
+            "open_seconds": round(time.monotonic() - self.opened_at, 1) if self.state != CLOSED else 0.0,
+        }
+
+
+_breakers = {}  # 同步引擎 -> CircuitBreaker
+_engines = {}   # 同步引擎 -> 异步引擎(后台探测用)
+
+
+# 给异步引擎加上熔断器,通过SQLAlchemy事件统计每条SQL的成功/失败
+def install(engine, name: str) -> CircuitBreaker:
+    sync_engine = engine.sync_engine
+    if sync_engine in _breakers:
+        return _breakers[sync_engine]
+    breaker = _breakers[sync_engine] = CircuitBreaker(name)
+    _engines[sync_engine] = engine
+    _listen(sync_engine, breaker)
+    return breaker
+
+
+def _listen(sync_engine, breaker: CircuitBreaker):
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["circuit_started"] = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop("circuit_started", time.perf_counter())
+        if elapsed > DB_SLOW_CALL_SECONDS:
+            breaker.record_failure(f"慢查询 {elapsed:.1f} 秒")
+        else:
+            breaker.record_success()
+
+    # 只统计连接层面的错误,SQL本身的错误(约束冲突等)说明数据库是好的
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, (exc.OperationalError, exc.InterfaceError)):
+            breaker.record_failure(str(context.original_exception)[:200])
+
+
+def breaker_for(session_factory) -> CircuitBreaker:
+    bind = session_factory.kw.get("bind")
+    return _breakers.get(getattr(bind, "sync_engine", None))
+
+
+# 新建会话之前检查熔断器
+def guard(session_factory):
+    breaker = breaker_for(session_factory)
+    if breaker is not None:
+        breaker.allow()
+
+
+# 取连接失败/超时(连接池耗尽、数据库不响应)也算一次失败
+def record_connect_failure(session_factory, reason: str):
+    breaker = breaker_for(session_factory)
+    if breaker is not None:
+        breaker.record_failure(reason)
+
+
+# 有任何一个数据库处于熔断状态; 跨所有分库的读取(停车场列表)这时改用快照
+# 单个分库的读写不要用它判断,直接用guard检查目标分库
+def degraded() -> bool:
+    return any(breaker.state != CLOSED for breaker in _breakers.values())
+
+
+def metrics() -> list:
+    return [breaker.metrics() for breaker in _breakers.values()]
+
+
+# 后台探测: 没有请求的时候熔断器也能自动恢复
+async def probe_loop():
+    while True:
+        await asyncio.sleep(DB_BREAKER_RESET_TIMEOUT)
+        for sync_engine, breaker in list(_breakers.items()):
+            if breaker.state == CLOSED:
+                continue
+            try:
+                breaker.allow()
+            except DatabaseUnavailable:
+                continue
+            try:
+                async with _engines[sync_engine].connect() as conn:
+                    await asyncio.wait_for(conn.execute(text("SELECT 1")), DB_CONNECT_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                breaker.record_failure(f"探测失败: {str(e)[:200]}")
+
+
+# 数据库正常时熔断器增加的开销: python circuit.py
+# 每个会话调用一次guard,每条SQL触发before/after_cursor_execute两个事件;
+# 用内存SQLite的同步引擎分别执行带事件和不带事件的SELECT 1,差值就是事件的开销
+# (不用aiosqlite: 它每次查询都要切换线程,波动远大于熔断器本身的开销)
+if __name__ == "__main__":
+    import statistics
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    from sqlalchemy.orm import sessionmaker
+
+    count = 1_000_000
+    breaker = CircuitBreaker("bench")
+    started = time.perf_counter()
+    for _ in range(count):
+        breaker.allow()
+        breaker.record_success()
+    print(f"allow + record_success: 每次 {(time.perf_counter() - started) / count * 1e9:.0f} 纳秒")
+
+    factory = sessionmaker(bind=create_async_engine("sqlite+aiosqlite://"), class_=AsyncSession)
+    install(factory.kw["bind"], "bench")
+    started = time.perf_counter()
+    for _ in range(count):
+        guard(factory)
+    print(f"guard(新建会话之前): 每次 {(time.perf_counter() - started) / count * 1e9:.0f} 纳秒")
+
+    def run(engine, queries):
+        with engine.connect() as conn:
+            statement = text("SELECT 1")
+            started = time.perf_counter()
+            for _ in range(queries):
+                conn.execute(statement)
+            return (time.perf_counter() - started) / queries
+
+    queries = 20000
+    engines = {"不加熔断器": create_engine("sqlite://"), "加熔断器": create_engine("sqlite://")}
+    _listen(engines["加熔断器"], CircuitBreaker("bench"))
+    for engine in engines.values():
+        run(engine, 2000)  # 预热
+    # 交替测几轮取中位数
+    rounds = {name: [] for name in engines}
+    for _ in range(7):
+        for name, engine in engines.items():
+            rounds[name].append(run(engine, queries))
+    results = {name: statistics.median(values) for name, values in rounds.items()}
+    for name, elapsed in results.items():
+        print(f"{name}: 每条SQL {elapsed * 1e6:.2f} 微秒")
+    print(f"事件增加的开销: 每条SQL {(results['加熔断器'] - results['不加熔断器']) * 1e6:.2f} 微秒")
@@ -1,14 +1,28 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import or_
+from sqlalchemy import func, or_, union_all
 from sqlalchemy.exc import SQLAlchemyError
 import bcrypt
 from datetime import datetime
 
-from models import User, ParkingLot, Record, RecordStatus
-from schemas import UserCreate, ParkingLotSearch, RecordCreate, RecordUpdate, ParkingLotCreate
+from models import User, ParkingLot, Record, RecordStatus, ArchivedRecord, RECORD_COLUMNS, Reservation, ReservationStatus
+from schemas import UserCreate, ParkingLotSearch, RecordCreate, RecordUpdate, ParkingLotCreate, ReservationCreate
 import logging
 
+import lot_counters
+import lot_events
+import statements
+from active_index import active_index, normalize_plate
+from event_log import event_log
+from http_cache import db_time_to_utc
+from overstay import overstay_monitor
+from plates import plate_index
+from pricing import dynamic_pricing
+from spots import spot_map
+import tasks
+from tasks import task_queue
+from reservations import planner, to_local
+
 
 # 关于crud文件，首先需要了解到crud文件和main文件的关系
 # crud只是一个动作，在稍后的main文件里我们会通过上一层的函数调取这些动作
@@ -34,7 +48,7 @@ async def create_user(db: AsyncSession, user: UserCreate):
 
 # 通过用户名读取用户
 async def get_user_by_username(db: AsyncSession, username: str):
-    result = await db.execute(select(User).filter(User.username == username))
+    result = await db.execute(statements.USER_BY_USERNAME, {"username": username})
     return result.scalar()
 
 
@@ -54,29 +68,35 @@ async def create_parking_lot(db: AsyncSession, parking_lot: ParkingLotCreate):
             location=parking_lot.location,   # 从传入函数的parking_lot里面提取对应的数据
             description=parking_lot.description,
             capacity=parking_lot.capacity,
-            fee_rate=parking_lot.fee_rate
+            fee_rate=parking_lot.fee_rate,
+            max_stay_hours=parking_lot.max_stay_hours,
+            updated_at=func.now()
         )
         db.add(db_parking_lot)   # 将新创建的 db_parking_lot 对象添加到数据库会话中。
         await db.commit()  # 提交
         await db.refresh(db_parking_lot)  # 刷新对象
+        lot_events.publish([db_parking_lot.id])  # 通知停车场信息变化
         return db_parking_lot  # 返回对象
     except SQLAlchemyError as e:
         await db.rollback()   # 如果出现异常,撤销刚才的更改,恢复执行前的状态
         raise e  # 返回错误提示
 
 
+# 只在有值且不为空字符串时添加过滤条件
+def _filter_parking_lots(query, search_criteria: ParkingLotSearch):
+    if search_criteria.location and search_criteria.location.strip():
+        query = query.filter(ParkingLot.location.ilike(f"%{search_criteria.location.strip()}%"))
+    if search_criteria.name and search_criteria.name.strip():
+        query = query.filter(ParkingLot.name.ilike(f"%{search_criteria.name.strip()}%"))
+    if search_criteria.id:
+        query = query.filter(ParkingLot.id == search_criteria.id)
+    return query
+
+
 # 读取所有停车场
 async def get_parking_lots(db: AsyncSession, search_criteria: ParkingLotSearch):
     try:
-        query = select(ParkingLot)
-
-        # 只在有值且不为空字符串时添加过滤条件
-        if search_criteria.location and search_criteria.location.strip():
-            query = query.filter(ParkingLot.location.ilike(f"%{search_criteria.location.strip()}%"))
-        if search_criteria.name and search_criteria.name.strip():
-            query = query.filter(ParkingLot.name.ilike(f"%{search_criteria.name.strip()}%"))
-        if search_criteria.id:
-            query = query.filter(ParkingLot.id == search_criteria.id)
+        query = _filter_parking_lots(select(ParkingLot), search_criteria)
 
         # 添加排序
         query = query.order_by(ParkingLot.id)
@@ -88,10 +108,51 @@ async def get_parking_lots(db: AsyncSession, search_criteria: ParkingLotSearch):
         raise e
 
 
-# 读取某个用户的所有记录
+# 停车场列表的版本(用于ETag/Last-Modified,不读取停车场本身): [(最后修改时间(UTC), 停车场数量, 占用数之和)]
+# 占用数之和用来区分同一秒内的入场/出场(MySQL的DATETIME只精确到秒)
+async def get_parking_lots_version(db: AsyncSession, search_criteria: ParkingLotSearch):
+    query = _filter_parking_lots(
+        select(
+            func.max(func.coalesce(ParkingLot.updated_at, ParkingLot.created_at)),
+            func.count(ParkingLot.id),
+            func.coalesce(func.sum(ParkingLot.occupancy), 0),
+        ),
+        search_criteria
+    )
+    last_modified, count, occupancy = (await db.execute(query)).one()
+    return [(db_time_to_utc(last_modified, db.bind.dialect.name), count, int(occupancy))]
+
+
+# 读取某个用户的所有记录(包含已归档的记录)
 async def get_records_by_user(db: AsyncSession, user_id: int):
-    result = await db.execute(select(Record).filter(Record.user_id == user_id))
-    return result.scalars().all()
+    return await get_record_history(db, user_id=user_id)
+
+
+# 读取历史记录,合并热表records和归档表records_archive,按入场时间倒序分页
+# user_id为空时返回所有用户的记录(管理员)
+async def get_record_history(db: AsyncSession, user_id: int = None, skip: int = 0, limit: int = None):
+    hot_query = select(*[getattr(Record, name).label(name) for name in RECORD_COLUMNS])
+    archive_query = select(*[getattr(ArchivedRecord, name).label(name) for name in RECORD_COLUMNS])
+    if user_id is not None:
+        hot_query = hot_query.filter(Record.user_id == user_id)
+        archive_query = archive_query.filter(ArchivedRecord.user_id == user_id)
+
+    history = union_all(hot_query, archive_query).subquery()
+    query = (
+        select(history)
+        .order_by(history.c.entry_time.desc(), history.c.id.desc())
+        .offset(skip)
+    )
+    if limit is not None:
+        query = query.limit(limit)
+
+    result = await db.execute(query)
+    return result.all()
+
+
+# 跨分库归并历史记录时的排序键,和get_record_history的排序一致
+def history_sort_key(row):
+    return row.entry_time, row.id
 
 
 # 读取单个停车场的所有记录
@@ -102,28 +163,19 @@ async def get_records_by_parking_lot(db: AsyncSession, parking_lot_id: int):
 
 # 读取记录
 async def get_record(db: AsyncSession, record_id: int):
-    result = await db.execute(select(Record).filter(Record.id == record_id))
+    result = await db.execute(statements.RECORD_BY_ID, {"record_id": record_id})
     return result.scalar()
 
 
 # 创建记录
 async def create_record(db: AsyncSession, record: RecordCreate, user_id: int):
     try:
-        # 检查车牌号是否已经在其他停车场停车
-        existing_record = await db.execute(
-            select(Record)
-            .filter(
-                Record.car_number == record.car_number,
-                Record.status == RecordStatus.PARKED
-            )
-        )
-        if existing_record.scalar():
+        # 检查车牌号是否已经在其他停车场停车 - 使用内存索引
+        if active_index.plate_parked(record.car_number):
             raise ValueError("该车辆已在其他停车场停车")
 
         # 检查停车场是否存在且有可用空间
-        parking_lot = await db.execute(
-            select(ParkingLot).filter(ParkingLot.id == record.parking_lot_id)
-        )
+        parking_lot = await db.execute(statements.LOT_BY_ID, {"parking_lot_id": record.parking_lot_id})
         parking_lot = parking_lot.scalar()
         
         if not parking_lot:
@@ -137,15 +189,51 @@ async def create_record(db: AsyncSession, record: RecordCreate, user_id: int):
             user_id=user_id,
             parking_lot_id=record.parking_lot_id,
             car_number=record.car_number,
+            plate_key=normalize_plate(record.car_number),
             status=RecordStatus.PARKED,  # 直接使用枚举值
-            entry_time=datetime.now()
+            entry_time=datetime.now(),
+            hourly_rate=dynamic_pricing.rate(parking_lot.id, parking_lot.fee_rate),  # 入场时的价格
+            updated_at=func.now()
         )
         
-        # 更新停车场占用情况
-        parking_lot.occupancy += 1
-        
-        db.add(db_record)
-        await db.commit()
+        # 更新停车场占用情况(分段计数的停车场在下面和停车记录一起修改其中一段)
+        striped = parking_lot.occupancy_stripes > 1
+        if not striped:
+            parking_lot.occupancy += 1
+
+        # 占位,防止并发的重复入场(检查和占位之间没有await)
+        if active_index.plate_parked(record.car_number):
+            raise ValueError("该车辆已在其他停车场停车")
+        vehicle = active_index.claim(user_id, record.car_number, record.parking_lot_id)
+        try:
+            db_record.spot_number = spot_map.allocate(
+                parking_lot.id, parking_lot.capacity, parking_lot.ev_spots, parking_lot.accessible_spots,
+                record.spot_class
+            )
+            if db_record.spot_number is None:
+                raise ValueError("没有空闲的车位")
+            if striped:
+                # 配额按容量减去预约保留的车位(用户自己的预约除外)分配
+                held = planner.held_now(parking_lot.id) - (1 if planner.find_current(user_id, parking_lot.id) else 0)
+                if not await lot_counters.acquire(
+                    db, parking_lot.id, parking_lot.capacity - held, parking_lot.occupancy_stripes
+                ):
+                    raise ValueError("停车场已满")
+            db.add(db_record)
+            await db.commit()
+            active_index.confirm(vehicle, db_record.id)
+            spot_map.confirm(db_record.parking_lot_id, db_record.spot_number)
+            dynamic_pricing.check_in(db_record.parking_lot_id)
+            overstay_monitor.check_in(db_record.id, user_id, db_record.car_number,
+                                      db_record.parking_lot_id, db_record.entry_time)
+            plate_index.add(db_record.car_number)
+            event_log.append("check_in", record_id=db_record.id, user_id=user_id,
+                             car_number=db_record.car_number, parking_lot_id=db_record.parking_lot_id)
+        finally:
+            if vehicle.record_id is None:
+                active_index.release(vehicle)
+                if db_record.spot_number is not None:
+                    spot_map.release(db_record.parking_lot_id, db_record.spot_number)
         await db.refresh(db_record)
         return db_record
     except Exception as e:
@@ -170,9 +258,7 @@ async def update_record(db: AsyncSession, record_id: int, record_update: RecordU
         # 如果状态变更为已完成，需要计算费用并更新停车场占用情况
         if record_update.status == RecordStatus.COMPLETED and db_record.status != RecordStatus.COMPLETED:
             # 获取停车场
-            parking_lot = await db.execute(
-                select(ParkingLot).filter(ParkingLot.id == db_record.parking_lot_id)
-            )
+            parking_lot = await db.execute(statements.LOT_BY_ID, {"parking_lot_id": db_record.parking_lot_id})
             parking_lot = parking_lot.scalar()
             
             if not parking_lot:
@@ -184,16 +270,38 @@ async def update_record(db: AsyncSession, record_id: int, record_update: RecordU
             # 计算停车时长（小时）
             duration = (db_record.exit_time - db_record.entry_time).total_seconds() / 3600
             
-            # 计算费用
-            db_record.amount = duration * parking_lot.fee_rate
+            # 计算费用: 按入场时记录的价格,旧记录没有价格时按停车场的基础价格
+            hourly_rate = db_record.hourly_rate if db_record.hourly_rate is not None else parking_lot.fee_rate
+            db_record.amount = duration * hourly_rate
             
             # 更新停车场占用情况
-            parking_lot.occupancy -= 1
+            if parking_lot.occupancy_stripes > 1:
+                await lot_counters.release(db, parking_lot.id, parking_lot.occupancy_stripes)
+            else:
+                parking_lot.occupancy -= 1
+
+            # 出场后的小票、统计等工作写成后台任务,和状态变化一起提交
+            await tasks.enqueue_checkout(db, record_id, parking_lot.id, db_record.exit_time, db_record.amount)
 
         # 更新状态，确保使用枚举值
+        was_parked = db_record.status == RecordStatus.PARKED
+        previous_status = db_record.status
         db_record.status = record_update.status
         
         await db.commit()
+        if was_parked and db_record.status != RecordStatus.PARKED:
+            task_queue.notify()
+            active_index.check_out(record_id)
+            overstay_monitor.check_out(record_id)
+            if db_record.spot_number is not None:
+                spot_map.release(db_record.parking_lot_id, db_record.spot_number)
+            dynamic_pricing.check_out(db_record.parking_lot_id)
+            event_log.append("check_out", record_id=record_id, parking_lot_id=db_record.parking_lot_id,
+                             status=getattr(db_record.status, "value", db_record.status), amount=db_record.amount)
+        elif previous_status != db_record.status:
+            event_log.append("status_change", record_id=record_id, parking_lot_id=db_record.parking_lot_id,
+                             from_status=getattr(previous_status, "value", previous_status),
+                             to_status=getattr(db_record.status, "value", db_record.status))
         await db.refresh(db_record)
         return db_record
     except Exception as e:
@@ -209,3 +317,79 @@ async def get_uncompleted_records(db: AsyncSession):
         .order_by(Record.entry_time.desc())
     )
     return result.scalars().all()
+
+
+# 创建预约
+async def create_reservation(db: AsyncSession, reservation: ReservationCreate, user_id: int):
+    try:
+        parking_lot = await db.execute(
+            select(ParkingLot).filter(ParkingLot.id == reservation.parking_lot_id)
+        )
+        parking_lot = parking_lot.scalar()
+        if not parking_lot:
+            raise ValueError("停车场不存在")
+
+        start_time = to_local(reservation.start_time)
+        end_time = to_local(reservation.end_time)
+        if end_time <= datetime.now():
+            raise ValueError("预约时间已过")
+
+        # 检查容量并占位(检查和占位之间没有await)
+        key = object()
+        if not planner.try_hold(key, parking_lot.id, user_id, start_time, end_time,
+                                parking_lot.capacity, parking_lot.occupancy):
+            raise ValueError("该时间段车位已被预约满")
+
+        try:
+            db_reservation = Reservation(
+                user_id=user_id,
+                parking_lot_id=parking_lot.id,
+                car_number=reservation.car_number,
+                start_time=start_time,
+                end_time=end_time,
+                status=ReservationStatus.ACTIVE
+            )
+            db.add(db_reservation)
+            await db.commit()
+            planner.rekey(key, db_reservation.id)
+            key = None
+        finally:
+            if key is not None:
+                planner.release(key)
+
+        await db.refresh(db_reservation)
+        return db_reservation
+    except Exception as e:
+        await db.rollback()
+        raise e
+
+
+# 读取预约
+async def get_reservation(db: AsyncSession, reservation_id: int):
+    result = await db.execute(select(Reservation).filter(Reservation.id == reservation_id))
+    return result.scalar()
+
+
+# 读取某个用户的所有预约
+async def get_reservations_by_user(db: AsyncSession, user_id: int):
+    result = await db.execute(
+        select(Reservation)
+        .filter(Reservation.user_id == user_id)
+        .order_by(Reservation.start_time.desc())
+    )
+    return result.scalars().all()
+
+
+# 取消预约
+async def cancel_reservation(db: AsyncSession, db_reservation: Reservation):
+    try:
+        if db_reservation.status != ReservationStatus.ACTIVE:
+            raise ValueError("只能取消预约中的记录")
+        db_reservation.status = ReservationStatus.CANCELLED
+        await db.commit()
+        planner.release(db_reservation.id)
+        await db.refresh(db_reservation)
+        return db_reservation
+    except Exception as e:
+        await db.rollback()
+        raise e
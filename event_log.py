@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+import orjson
+
+
+# 闸机事件日志
+# 入场、出场、状态变化和停车场修改按顺序追加到本地的段文件里(每行一个JSON事件),不修改也不删除,作为状态变化的审计记录
+# 写入先放进内存缓冲区,后台每隔一小段时间把整批事件一次顺序写入当前段文件; 段文件超过大小上限时换新文件
+# 每隔一定数量的事件把各停车场的在场车辆写成快照,恢复时加载最新的快照,只重放快照之后的事件
+# 同一个目录只能有一个进程写入,多进程部署时每个进程配置自己的EVENT_LOG_DIR
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR", "eventlog")
+EVENT_LOG_SEGMENT_BYTES = int(os.getenv("EVENT_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024)))  # 段文件大小上限
+EVENT_LOG_FLUSH_INTERVAL = float(os.getenv("EVENT_LOG_FLUSH_INTERVAL", "0.2"))  # 批量写入的间隔(秒)
+EVENT_LOG_SNAPSHOT_EVERY = int(os.getenv("EVENT_LOG_SNAPSHOT_EVERY", "100000"))  # 每写入多少个事件做一次快照
+EVENT_LOG_FSYNC = os.getenv("EVENT_LOG_FSYNC", "1") == "1"  # 每批写入后是否fsync
+
+SEGMENT_PATTERN = re.compile(r"^segment-(\d{20})\.log$")
+SNAPSHOT_PATTERN = re.compile(r"^snapshot-(\d{20})\.json$")
+
+
+class GateState:
+    # 由事件推导出的状态: 在场的记录和各停车场的在场车辆数
+    def __init__(self, seq: int = 0, parked: dict = None):
+        self.seq = seq
+        self.parked = dict(parked or {})  # 记录ID -> 停车场ID
+        self.occupancy = Counter(self.parked.values())  # 停车场ID -> 在场车辆数
+
+    def apply(self, event: dict):
+        kind = event["type"]
+        if kind == "check_in":
+            self.parked[event["record_id"]] = event["parking_lot_id"]
+            self.occupancy[event["parking_lot_id"]] += 1
+        elif kind == "check_out":
+            lot_id = self.parked.pop(event["record_id"], None)
+            if lot_id is not None:
+                self.occupancy[lot_id] -= 1
+                if not self.occupancy[lot_id]:
+                    del self.occupancy[lot_id]
+        self.seq = event["seq"]
+
+    def to_snapshot(self) -> dict:
+        return {
+            "seq": self.seq,
+            "occupancy": dict(self.occupancy),
+            "parked": list(self.parked.items()),
+        }
+
+    @classmethod
+    def from_snapshot(cls, data: dict) -> "GateState":
+        return cls(data["seq"], {record_id: lot_id for record_id, lot_id in data["parked"]})
+
+
+class EventLog:
+    def __init__(self, directory: str = EVENT_LOG_DIR, segment_bytes: int = EVENT_LOG_SEGMENT_BYTES,
+                 snapshot_every: int = EVENT_LOG_SNAPSHOT_EVERY, fsync: bool = EVENT_LOG_FSYNC):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.state = GateState()
+        self.buffer = []
+        self.segment = None  # 当前写入的段文件
+        self.segment_size = 0
+        self.since_snapshot = 0
+        self.written_seq = 0
+        self.lock = threading.Lock()  # 后台线程和关闭时的写入不能交错
+
+    def _files(self, pattern) -> list:
+        if not os.path.isdir(self.directory):
+            return []
+        files = []
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if match:
+                files.append((int(match.group(1)), os.path.join(self.directory, name)))
+        files.sort()
+        return files
+
+    # 按顺序读取seq大于after_seq的事件; 段文件名是段内第一个事件的seq,整段都在after_seq之前的直接跳过
+    # 进程崩溃时最后一行可能没有写完,读到无法解析的行时停止
+    def events(self, after_seq: int = 0):
+        segments = self._files(SEGMENT_PATTERN)
+        for i, (first_seq, path) in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1][0] <= after_seq + 1:
+                continue
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        event = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        logging.warning(f"事件日志 {path} 的末尾有不完整的事件,已忽略")
+                        break
+                    if event["seq"] > after_seq:
+                        yield event
+
+    def read(self, after_seq: int = 0, limit: int = 100) -> list:
+        result = []
+        for event in self.events(after_seq):
+            result.append(event)
+            if len(result) >= limit:
+                break
+        return result
+
+    # 恢复状态: 加载最新的快照,重放快照之后的事件
+    def recover(self) -> dict:
+        started = time.perf_counter()
+        snapshots = self._files(SNAPSHOT_PATTERN)
+        state = GateState()
+        if snapshots:
+            with open(snapshots[-1][1], "rb") as f:
+                state = GateState.from_snapshot(orjson.loads(f.read()))
+        snapshot_seq = state.seq
+        replayed = 0
+        for event in self.events(snapshot_seq):
+            state.apply(event)
+            replayed += 1
+        self.state = state
+        self.buffer = []
+        self.written_seq = state.seq
+        self.since_snapshot = replayed
+        # 之后的写入从新的段文件开始,不接在可能不完整的最后一行后面
+        self.close()
+        stats = {
+            "seq": state.seq,
+            "snapshot_seq": snapshot_seq,
+            "replayed": replayed,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        logging.info(f"事件日志已恢复: {stats}")
+        return stats
+
+    # 追加事件(只放进缓冲区),返回事件的seq
+    def append(self, kind: str, **fields) -> int:
+        event = {"seq": self.state.seq + 1, "ts": time.time(), "type": kind, **fields}
+        self.state.apply(event)
+        self.buffer.append(event)
+        return event["seq"]
+
+    # 取出缓冲区里的事件; 需要做快照时同时复制当前状态,快照的seq正好是这一批的最后一个事件
+    def take(self):
+        batch, self.buffer = self.buffer, []
+        snapshot = None
+        self.since_snapshot += len(batch)
+        if batch and self.since_snapshot >= self.snapshot_every:
+            snapshot = self.state.to_snapshot()
+            self.since_snapshot = 0
+        return batch, snapshot
+
+    # 把一批事件一次写入段文件,再写快照(可以在线程里执行)
+    def write(self, batch: list, snapshot: dict = None):
+        with self.lock:
+            self._write(batch, snapshot)
+
+    def _write(self, batch: list, snapshot: dict = None):
+        if batch:
+            data = b"".join(orjson.dumps(event) + b"\n" for event in batch)
+            if self.segment is None or self.segment_size >= self.segment_bytes:
+                self.close()
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, f"segment-{batch[0]['seq']:020d}.log")
+                self.segment = open(path, "ab")
+                self.segment_size = 0
+            self.segment.write(data)
+            self.segment.flush()
+            if self.fsync:
+                os.fsync(self.segment.fileno())
+            self.segment_size += len(data)
+            self.written_seq = batch[-1]["seq"]
+        if snapshot is not None:
+            path = os.path.join(self.directory, f"snapshot-{snapshot['seq']:020d}.json")
+            with open(path + ".tmp", "wb") as f:
+                f.write(orjson.dumps(snapshot, option=orjson.OPT_NON_STR_KEYS))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+
+    def flush(self):
+        self.write(*self.take())
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+            self.segment_size = 0
+
+
+event_log = EventLog()
+
+
+# 后台批量写入,写文件放在线程里,不阻塞事件循环
+async def flush_loop():
+    while True:
+        try:
+            batch, snapshot = event_log.take()
+            if batch:
+                await asyncio.to_thread(event_log.write, batch, snapshot)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"写入事件日志时发生错误: {str(e)}")
+        await asyncio.sleep(EVENT_LOG_FLUSH_INTERVAL)
+
+
+# 重放吞吐测试(100万个事件): python event_log.py
+if __name__ == "__main__":
+    import random
+    import shutil
+    import tempfile
+
+    random.seed(1)
+    count = 1_000_000
+    lots = 50
+    batch_size = 1000  # 模拟每个写入间隔积累的事件数
+    directory = tempfile.mkdtemp(prefix="eventlog-")
+    try:
+        log = EventLog(directory, segment_bytes=16 * 1024 * 1024, snapshot_every=count * 2, fsync=False)
+        parked = []
+        next_id = 1
+        started = time.perf_counter()
+        for i in range(count):
+            if parked and (len(parked) > 20_000 or random.random() < 0.45):
+                record_id, lot_id = parked.pop(random.randrange(len(parked)))
+                log.append("check_out", record_id=record_id, parking_lot_id=lot_id, amount=12.5)
+            else:
+                lot_id = random.randrange(lots)
+                log.append("check_in", record_id=next_id, user_id=next_id, parking_lot_id=lot_id,
+                           car_number=f"AB{next_id:06d}")
+                parked.append((next_id, lot_id))
+                next_id += 1
+            if len(log.buffer) >= batch_size:
+                log.flush()
+            if i == count * 9 // 10:
+                # 90%的位置做一次快照
+                log.flush()
+                log.write([], log.state.to_snapshot())
+        log.flush()
+        log.close()
+        elapsed = time.perf_counter() - started
+        size = sum(os.path.getsize(path) for _, path in log._files(SEGMENT_PATTERN))
+        print(f"追加 {count} 个事件(每批 {batch_size} 个): {count / elapsed:,.0f} 个/秒, "
+              f"{size / 1024 / 1024:.1f} MB, {len(log._files(SEGMENT_PATTERN))} 个段文件")
+
+        started = time.perf_counter()
+        state = GateState()
+        for event in log.events():
+            state.apply(event)
+        elapsed = time.perf_counter() - started
+        print(f"全量重放: {count / elapsed:,.0f} 个事件/秒, 共 {elapsed:.2f} 秒")
+
+        recovered = EventLog(directory)
+        stats = recovered.recover()
+        print(f"快照 + 重放尾部 {stats['replayed']} 个事件: 共 {stats['seconds']:.2f} 秒")
+        assert recovered.state.occupancy == state.occupancy == Counter(lot_id for _, lot_id in parked)
+        print(f"恢复后在场车辆 {len(recovered.state.parked)}, 和全量重放一致")
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,66 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+
+# HTTP条件请求
+# ETag由数据的版本(最后修改时间、数量等)生成,不依赖响应内容: 客户端带着If-None-Match/If-Modified-Since再次请求时,
+# 先查版本,没有变化就直接返回304,不再查询、计算价格和序列化整个列表
+
+
+# 数据库里没有时区的时间转换成UTC
+# SQLite的CURRENT_TIMESTAMP是UTC; MySQL的CURRENT_TIMESTAMP和应用写入的datetime.now()都是本地时间
+def db_time_to_utc(value, dialect: str) -> datetime:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None and dialect == "sqlite":
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _http_date(value: datetime) -> str:
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def make_etag(*version) -> str:
+    return '"' + hashlib.sha256(repr(version).encode()).hexdigest()[:32] + '"'
+
+
+def _not_modified_since(request: Request, last_modified: datetime) -> bool:
+    since = request.headers.get("if-modified-since")
+    if not since or last_modified is None:
+        return False
+    try:
+        return last_modified.astimezone(timezone.utc).replace(microsecond=0) <= parsedate_to_datetime(since)
+    except (TypeError, ValueError):
+        return False
+
+
+def _validator_headers(etag: str, last_modified: datetime = None) -> dict:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = _http_date(last_modified)
+    return headers
+
+
+# 客户端缓存的版本还是最新的时返回304响应,否则返回None,由调用方查询数据后调用conditional_json_response
+# last_modified需要带时区(见db_time_to_utc)
+def not_modified_response(request: Request, etag: str, last_modified: datetime = None) -> Response:
+    # If-None-Match优先,没有时才看If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if (if_none_match and etag in if_none_match) or (not if_none_match and _not_modified_since(request, last_modified)):
+        return Response(status_code=304, headers=_validator_headers(etag, last_modified))
+    return None
+
+
+# 带ETag/Last-Modified的JSON响应
+def conditional_json_response(content, etag: str, last_modified: datetime = None) -> Response:
+    response = JSONResponse(jsonable_encoder(content))
+    response.headers.update(_validator_headers(etag, last_modified))
+    return response
@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+from fastapi import status
+from fastapi.responses import JSONResponse, Response
+from starlette.middleware.base import BaseHTTPMiddleware
+
+
+# 幂等键
+# 闸机在网络不稳定时会重试入场/出场请求,带上相同的Idempotency-Key时直接返回第一次的响应,不再访问数据库
+# 同一个键的并发请求只有一个会真正执行,其余的等待它的结果
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))  # 响应保留的秒数
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))  # 最多保留的响应数
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "30"))  # 等待并发请求结果的最长秒数
+
+# 支持幂等键的接口
+IDEMPOTENT_ROUTES = (
+    ("POST", re.compile(r"^/customer/records$")),
+    ("PUT", re.compile(r"^/customer/records/\d+$")),
+)
+
+
+# 保存并重放的响应: 成功的响应和不取决于当时状态的客户端错误(请求本身不合法)
+# 停车场已满、没有空闲车位等拒绝不保存,车位空出来之后用同一个键重试需要重新执行
+REPLAYABLE_CLIENT_ERRORS = (422,)  # 请求校验失败
+
+
+def is_replayable(status_code: int) -> bool:
+    return 200 <= status_code < 300 or status_code in REPLAYABLE_CLIENT_ERRORS
+
+
+class StoredResponse:
+    __slots__ = ("status_code", "headers", "body", "fingerprint", "expires_at")
+
+    def __init__(self, status_code, headers, body, fingerprint, expires_at):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.fingerprint = fingerprint  # 请求体的哈希,同一个键不能用于不同的请求
+        self.expires_at = expires_at
+
+
+class InFlight:
+    __slots__ = ("future", "fingerprint")
+
+    def __init__(self, future, fingerprint):
+        self.future = future
+        self.fingerprint = fingerprint
+
+
+class IdempotencyStore:
+    # 保存的响应按写入顺序排列,过期时间单调递增,淘汰时从最旧的开始
+    # 正在处理的请求单独保存,不参与淘汰,否则淘汰之后到达的重复请求会再执行一次
+    def __init__(self, max_entries: int = IDEMPOTENCY_MAX_ENTRIES, ttl: int = IDEMPOTENCY_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # 键 -> StoredResponse
+        self._inflight = {}  # 键 -> InFlight
+
+    def __len__(self):
+        return len(self._entries) + len(self._inflight)
+
+    def get(self, key):
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return inflight
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def begin(self, key, fingerprint) -> InFlight:
+        inflight = InFlight(asyncio.get_running_loop().create_future(), fingerprint)
+        self._inflight[key] = inflight
+        return inflight
+
+    def finish(self, key, inflight: InFlight, response: StoredResponse = None):
+        # response为空表示结果不可复用(出错、5xx或者取决于当时状态的拒绝),下一个请求重新执行
+        if self._inflight.get(key) is inflight:
+            del self._inflight[key]
+            if response is not None:
+                self._entries[key] = response
+                self._entries.move_to_end(key)
+        if not inflight.future.done():
+            inflight.future.set_result(None)
+        self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at <= now or len(self._entries) > self.max_entries:
+                del self._entries[key]
+            else:
+                break
+
+
+idempotency_store = IdempotencyStore()
+
+
+class IdempotencyMiddleware(BaseHTTPMiddleware):
+    # 需要放在SessionMiddleware里面,才能按用户区分幂等键
+    def __init__(self, app, store: IdempotencyStore = None):
+        super().__init__(app)
+        self.store = store or idempotency_store
+
+    async def dispatch(self, request, call_next):
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not idempotency_key or not any(
+            request.method == method and pattern.match(request.url.path)
+            for method, pattern in IDEMPOTENT_ROUTES
+        ):
+            return await call_next(request)
+
+        user_id = request.scope.get("session", {}).get("user_id")
+        if not user_id:
+            return await call_next(request)
+
+        body = await request.body()
+        fingerprint = hashlib.sha256(body).hexdigest()
+        key = (user_id, request.method, request.url.path, idempotency_key)
+
+        while True:
+            entry = self.store.get(key)
+            if entry is None:
+                break
+            if entry.fingerprint != fingerprint:
+                return JSONResponse(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    content={"detail": "Idempotency-Key已用于另一个不同的请求"}
+                )
+            if isinstance(entry, StoredResponse):
+                headers = dict(entry.headers)
+                headers["Idempotent-Replayed"] = "true"
+                return Response(content=entry.body, status_code=entry.status_code, headers=headers)
+            # 相同的请求正在处理,等待它完成后重新检查
+            try:
+                await asyncio.wait_for(asyncio.shield(entry.future), IDEMPOTENCY_WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                return JSONResponse(
+                    status_code=status.HTTP_409_CONFLICT,
+                    content={"detail": "相同的请求正在处理中，请稍后重试"}
+                )
+
+        inflight = self.store.begin(key, fingerprint)
+        stored = None
+        try:
+            response = await call_next(request)
+            response_body = b"".join([chunk async for chunk in response.body_iterator])
+            headers = {
+                name: value for name, value in response.headers.items()
+                if name.lower() != "content-length"
+            }
+            if is_replayable(response.status_code):
+                stored = StoredResponse(
+                    response.status_code, headers, response_body, fingerprint,
+                    time.monotonic() + self.store.ttl
+                )
+            return Response(content=response_body, status_code=response.status_code, headers=headers)
+        except Exception as e:
+            logging.error(f"幂等请求 {idempotency_key} 处理失败: {str(e)}")
+            raise
+        finally:
+            self.store.finish(key, inflight, stored)
+
+
+# 性能测试: python idempotency.py
+if __name__ == "__main__":
+    import httpx
+    from fastapi import FastAPI
+
+    calls = {"count": 0}
+    test_app = FastAPI()
+
+    @test_app.post("/customer/records")
+    async def fake_check_in():
+        calls["count"] += 1
+        await asyncio.sleep(0.05)  # 模拟数据库耗时
+        return {"id": calls["count"], "status": "PARKED"}
+
+    # 模拟SessionMiddleware写入的用户信息
+    async def with_session(scope, receive, send):
+        scope["session"] = {"user_id": 1}
+        await inner(scope, receive, send)
+
+    inner = IdempotencyMiddleware(test_app, IdempotencyStore())
+
+    async def run():
+        transport = httpx.ASGITransport(app=with_session)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            # 重试风暴: 200个并发请求使用同一个幂等键
+            responses = await asyncio.gather(*[
+                client.post("/customer/records", json={"car_number": "AB1"}, headers={IDEMPOTENCY_HEADER: "storm"})
+                for _ in range(200)
+            ])
+            ids = {response.json()["id"] for response in responses}
+            print(f"重试风暴: 200个请求, 处理函数执行 {calls['count']} 次, 返回的记录ID {ids}")
+
+            # 重放路径耗时
+            count = 2000
+            started = time.perf_counter()
+            for _ in range(count):
+                await client.post("/customer/records", json={"car_number": "AB1"}, headers={IDEMPOTENCY_HEADER: "storm"})
+            elapsed = time.perf_counter() - started
+            print(f"重放: 每次 {elapsed / count * 1e6:.0f} 微秒 (包含测试客户端开销)")
+
+    asyncio.run(run())
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+import random
+
+from sqlalchemy import delete, insert, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import statements
+from models import ParkingLot, ParkingLotCounter
+from shards import shard_router
+
+
+# 分段占用计数
+# 每次入场/出场都要修改parking_lots里同一行,繁忙的停车场(机场等)所有闸口的事务都在这一行的行锁上排队
+# 停车场的occupancy_stripes大于1时,占用数分散在parking_lot_counters的N行里,入场/出场随机选一行修改:
+#   - 每一行有自己的配额(上限平均分成N份),入场时条件UPDATE "occupancy < 配额",这一行满了就换下一行,
+#     所有行都满才算满场; 配额之和等于上限,所以并发入场也不会超过上限,不需要先读总数再加锁
+#     上限是容量减去当前被预约保留的车位,并发入场不会占用预约保留的车位
+#   - 出场时同样随机选一行减1(occupancy > 0)
+#   - 准确的占用数是各行之和(入场检查预约保留车位时读取); parking_lots.occupancy是定期汇总的缓存,
+#     停车场列表、可用车位、动态定价等读取的都是它
+# 修改分段数时在停车场行上加锁,把当前占用数重新分配到新的各行; 切换过程中的少量偏差由占用数对账(occupancy.py)修正
+OCCUPANCY_STRIPES_MAX = int(os.getenv("OCCUPANCY_STRIPES_MAX", "64"))  # 最多分成多少段
+OCCUPANCY_STRIPE_SYNC_INTERVAL = float(os.getenv("OCCUPANCY_STRIPE_SYNC_INTERVAL", "2"))  # 汇总到parking_lots的间隔(秒)
+
+
+# 第stripe段的配额,各段配额之和等于limit
+def stripe_quota(limit: int, stripes: int, stripe: int) -> int:
+    quota, extra = divmod(max(0, limit), stripes)
+    return quota + (1 if stripe < extra else 0)
+
+
+# 各段之和(准确的占用数)
+async def total(db: AsyncSession, parking_lot_id: int) -> int:
+    result = await db.execute(statements.STRIPE_TOTAL, {"parking_lot_id": parking_lot_id})
+    return result.scalar() or 0
+
+
+# 入场: 从随机的一段开始找还有配额的段加1,所有段都满时返回False
+# limit是这次入场允许的占用上限(容量减去预约保留的车位); 各段的配额之和等于limit,
+# 有一段没到配额就说明总数小于limit,不会因为并发入场占用保留的车位
+# 在调用方的事务里执行,和停车记录一起提交
+async def acquire(db: AsyncSession, parking_lot_id: int, limit: int, stripes: int) -> bool:
+    start = random.randrange(stripes)
+    for offset in range(stripes):
+        stripe = (start + offset) % stripes
+        result = await db.execute(statements.ACQUIRE_STRIPE, {
+            "parking_lot_id": parking_lot_id,
+            "stripe": stripe,
+            "quota": stripe_quota(limit, stripes, stripe),
+        })
+        if result.rowcount:
+            return True
+    return False
+
+
+# 出场: 从随机的一段开始找不为0的段减1
+async def release(db: AsyncSession, parking_lot_id: int, stripes: int) -> bool:
+    start = random.randrange(stripes)
+    for offset in range(stripes):
+        result = await db.execute(statements.RELEASE_STRIPE, {
+            "parking_lot_id": parking_lot_id,
+            "stripe": (start + offset) % stripes,
+        })
+        if result.rowcount:
+            return True
+    return False
+
+
+# 修改停车场的分段数(1表示不分段,直接使用parking_lots.occupancy),返回修改后的分段情况
+async def set_stripes(db: AsyncSession, parking_lot_id: int, stripes: int) -> dict:
+    if not 1 <= stripes <= OCCUPANCY_STRIPES_MAX:
+        raise ValueError(f"分段数必须在1到{OCCUPANCY_STRIPES_MAX}之间")
+    try:
+        # 锁住停车场行,不分段的入场/出场在切换完成之前会等待
+        result = await db.execute(
+            select(ParkingLot.capacity, ParkingLot.occupancy, ParkingLot.occupancy_stripes)
+            .filter(ParkingLot.id == parking_lot_id)
+            .with_for_update()
+        )
+        lot = result.first()
+        if lot is None:
+            return None
+        current = await total(db, parking_lot_id) if lot.occupancy_stripes > 1 else (lot.occupancy or 0)
+
+        await db.execute(delete(ParkingLotCounter).where(ParkingLotCounter.parking_lot_id == parking_lot_id))
+        counters = []
+        if stripes > 1:
+            # 按配额依次填满,超出容量的部分(数据偏差)放在最后一段
+            remaining = current
+            for stripe in range(stripes):
+                count = min(remaining, stripe_quota(lot.capacity, stripes, stripe))
+                if stripe == stripes - 1:
+                    count = remaining
+                remaining -= count
+                counters.append({"parking_lot_id": parking_lot_id, "stripe": stripe, "occupancy": count})
+            await db.execute(insert(ParkingLotCounter), counters)
+        await db.execute(
+            update(ParkingLot)
+            .where(ParkingLot.id == parking_lot_id)
+            .values(occupancy_stripes=stripes, occupancy=current)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    return {
+        "parking_lot_id": parking_lot_id,
+        "stripes": stripes,
+        "occupancy": current,
+        "counters": [counter["occupancy"] for counter in counters],
+    }
+
+
+# 把各段之和写回parking_lots.occupancy(只更新有变化的停车场),返回更新的停车场数
+async def sync_totals() -> int:
+    async def run(db):
+        result = await db.execute(text("""
+            UPDATE parking_lots
+            SET occupancy = (
+                    SELECT COALESCE(SUM(c.occupancy), 0) FROM parking_lot_counters c
+                    WHERE c.parking_lot_id = parking_lots.id
+                ),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE occupancy_stripes > 1 AND occupancy <> (
+                SELECT COALESCE(SUM(c.occupancy), 0) FROM parking_lot_counters c
+                WHERE c.parking_lot_id = parking_lots.id
+            )
+        """))
+        await db.commit()
+        return result.rowcount
+    return sum(await shard_router.scatter(run))
+
+
+async def sync_loop():
+    while True:
+        await asyncio.sleep(OCCUPANCY_STRIPE_SYNC_INTERVAL)
+        try:
+            await sync_totals()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"汇总分段占用数时发生错误: {str(e)}")
+
+
+# 单个停车场的并发入场吞吐量: python lot_counters.py
+# 需要MySQL(database.py里配置的数据库),SQLite整个库只有一个写锁,分段没有意义
+# 每个入场事务执行和入场处理函数(main._create_parking_record)相同的占用数语句,
+# 然后保持BENCH_HOLD_MS毫秒(模拟同一事务里写停车记录、更新预约和提交的往返)再提交,这段时间里计数行的行锁一直被持有:
+#   - 分段数1: 读取停车场行(LOT_FOR_CHECK_IN),再按读到的值写回 occupancy + 1(UPDATE_LOT_OCCUPANCY),即现在不分段的写法
+#   - 分段数大于1: 读取停车场行和各段之和,再对其中一段做条件UPDATE(acquire)
+if __name__ == "__main__":
+    import time
+
+    from database import async_sessionmaker
+
+    BENCH_WORKERS = int(os.getenv("BENCH_WORKERS", "12"))  # 并发的入场事务数(闸口),不超过连接池大小(默认5+10)
+    BENCH_SECONDS = float(os.getenv("BENCH_SECONDS", "10"))
+    BENCH_HOLD_MS = float(os.getenv("BENCH_HOLD_MS", "2"))
+    BENCH_STRIPES = [int(value) for value in os.getenv("BENCH_STRIPES", "1,4,16").split(",")]
+
+    async def worker(parking_lot_id: int, stripes: int, deadline: float) -> int:
+        count = 0
+        while time.perf_counter() < deadline:
+            async with async_sessionmaker() as db:
+                result = await db.execute(statements.LOT_FOR_CHECK_IN, {"parking_lot_id": parking_lot_id})
+                lot = result.fetchone()
+                if stripes > 1:
+                    await total(db, parking_lot_id)
+                    ok = await acquire(db, parking_lot_id, lot.capacity, stripes)
+                else:
+                    await db.execute(statements.UPDATE_LOT_OCCUPANCY, {"occupancy": lot.occupancy + 1, "id": lot.id})
+                    ok = True
+                await asyncio.sleep(BENCH_HOLD_MS / 1000)
+                await db.commit()
+            count += ok
+        return count
+
+    async def occupied(parking_lot_id: int, stripes: int) -> int:
+        async with async_sessionmaker() as db:
+            if stripes > 1:
+                return await total(db, parking_lot_id)
+            result = await db.execute(select(ParkingLot.occupancy).filter(ParkingLot.id == parking_lot_id))
+            return result.scalar()
+
+    async def bench():
+        logging.getLogger().setLevel(logging.WARNING)
+        for factory in shard_router.session_factories:
+            factory.kw["bind"].sync_engine.echo = False
+        shard_router.prepare()
+        async with async_sessionmaker() as db:
+            lot = ParkingLot(name="stripe bench", location="bench", description="bench",
+                             capacity=10 ** 9, fee_rate=0.0, occupancy=0, occupancy_stripes=1)
+            db.add(lot)
+            await db.commit()
+            parking_lot_id = lot.id
+        try:
+            for stripes in BENCH_STRIPES:
+                async with async_sessionmaker() as db:
+                    await set_stripes(db, parking_lot_id, stripes)
+                before = await occupied(parking_lot_id, stripes)
+                deadline = time.perf_counter() + BENCH_SECONDS
+                counts = await asyncio.gather(*(worker(parking_lot_id, stripes, deadline) for _ in range(BENCH_WORKERS)))
+                # 不分段的写法按读到的值写回,并发时会丢失更新,占用数的增加比入场次数少
+                lost = sum(counts) - (await occupied(parking_lot_id, stripes) - before)
+                print(f"{stripes} 段: {sum(counts) / BENCH_SECONDS:.0f} 次入场/秒, 丢失的占用数更新 {lost} 次 "
+                      f"({BENCH_WORKERS} 个并发事务, 每个事务持有行锁 {BENCH_HOLD_MS:g} 毫秒)")
+        finally:
+            async with async_sessionmaker() as db:
+                await db.execute(delete(ParkingLotCounter).where(ParkingLotCounter.parking_lot_id == parking_lot_id))
+                await db.execute(delete(ParkingLot).where(ParkingLot.id == parking_lot_id))
+                await db.commit()
+
+    asyncio.run(bench())
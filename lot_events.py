@@ -0,0 +1,22 @@
+import logging
+
+
+# 停车场信息变更通知
+# 停车场被创建/修改后调用publish,订阅者(缓存、快照等)据此失效或刷新
+# 批量导入只在结束时通知一次
+_listeners = []
+
+
+def subscribe(listener):
+    _listeners.append(listener)
+
+
+# lot_ids: 发生变化的停车场ID列表,None表示全部停车场都可能有变化
+def publish(lot_ids=None):
+    if lot_ids is not None:
+        lot_ids = list(lot_ids)
+    for listener in _listeners:
+        try:
+            listener(lot_ids)
+        except Exception as e:
+            logging.error(f"停车场变更通知处理失败: {str(e)}")
@@ -0,0 +1,260 @@
+import csv
+import json
+import logging
+import os
+from collections import deque
+
+from pydantic import ValidationError
+from sqlalchemy import bindparam, func, insert, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import lot_events
+from models import ParkingLot, ParkingLotCounter
+from schemas import ParkingLotCreate
+
+
+# 停车场批量导入
+# 支持CSV、JSON数组和NDJSON(每行一个JSON对象); CSV和NDJSON边读边校验,不需要把整个文件读进内存
+# 带id的行更新已有停车场,只修改这一行提供的字段(没有的字段和CSV里留空的字段保持不变); 不带id的行新建停车场
+# 每批一个事务,批量写入
+IMPORT_BATCH_SIZE = int(os.getenv("LOT_IMPORT_BATCH_SIZE", "500"))  # 每个事务写入的行数
+IMPORT_MAX_ROWS = int(os.getenv("LOT_IMPORT_MAX_ROWS", "100000"))  # 单次导入最多的行数
+IMPORT_MAX_ERRORS = 1000  # 最多返回的错误条数
+
+LOT_FIELDS = ("name", "location", "description", "capacity", "fee_rate", "max_stay_hours", "ev_spots", "accessible_spots")
+OPTIONAL_FIELDS = ("max_stay_hours",)  # CSV里留空表示不限制(使用默认值)
+SPOT_FIELDS = ("ev_spots", "accessible_spots")  # 留空或者没有这一列时为0
+
+
+# 把请求体按行切分
+async def _iter_lines(stream):
+    buffer = b""
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8-sig").rstrip("\r")
+    if buffer.strip():
+        yield buffer.decode("utf-8-sig").rstrip("\r")
+
+
+# 逐条产生 (行号, 原始字典); 行号是记录的序号,从1开始,CSV不计表头
+# CSV的字段可以在引号里换行(多行的description),所有行交给同一个csv.reader解析:
+# 行先放进队列,引号成对(记录已经结束)时才从reader取下一条记录,一条记录可能由多行组成
+async def iter_rows(stream, content_type: str):
+    if content_type.startswith("text/csv"):
+        pending = deque()
+        reader = csv.reader(iter(pending.popleft, None))
+        quotes = 0  # 当前记录里引号的个数
+        header = None
+        row_number = 0
+        async for line in _iter_lines(stream):
+            if not pending and not line.strip():
+                continue
+            pending.append(line + "\n")
+            quotes += line.count('"')
+            if quotes % 2:
+                continue
+            quotes = 0
+            values = next(reader)
+            if header is None:
+                header = [name.strip() for name in values]
+                continue
+            row_number += 1
+            yield row_number, dict(zip(header, values))
+        if pending and header is not None:
+            yield row_number + 1, ValueError("CSV格式错误: 引号没有闭合")
+    elif content_type.startswith("application/x-ndjson"):
+        row_number = 0
+        async for line in _iter_lines(stream):
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                yield row_number, json.loads(line)
+            except ValueError as e:
+                yield row_number, ValueError(f"JSON格式错误: {str(e)}")
+    else:
+        body = b"".join([chunk async for chunk in stream])
+        rows = json.loads(body or b"[]")
+        if not isinstance(rows, list):
+            raise ValueError("JSON导入需要一个数组")
+        for row_number, row in enumerate(rows, start=1):
+            yield row_number, row
+
+
+# 校验停车场的全部字段,返回字段字典
+def _check_lot(values: dict) -> dict:
+    data = ParkingLotCreate(**values)
+    if data.capacity <= 0:
+        raise ValueError("capacity必须大于0")
+    if data.fee_rate < 0:
+        raise ValueError("fee_rate不能为负数")
+    if data.max_stay_hours is not None and data.max_stay_hours <= 0:
+        raise ValueError("max_stay_hours必须大于0")
+    return data.model_dump()
+
+
+# 校验一行,返回 (停车场ID或None, 字段字典)
+# 新建的行校验全部字段; 更新的行只返回提供的字段,和已有的值合并后在flush里校验
+def validate_row(raw):
+    if isinstance(raw, Exception):
+        raise raw
+    if not isinstance(raw, dict):
+        raise ValueError("每行需要是一个对象")
+    lot_id = raw.get("id")
+    lot_id = int(lot_id) if lot_id not in (None, "") else None
+    if lot_id is not None:
+        changes = {field: raw[field] for field in LOT_FIELDS if field in raw and raw[field] != ""}
+        if not changes:
+            raise ValueError("没有需要更新的字段")
+        return lot_id, changes
+    return lot_id, _check_lot({
+        field: None if field in OPTIONAL_FIELDS and raw.get(field) == ""
+        else 0 if field in SPOT_FIELDS and raw.get(field) in (None, "")
+        else raw.get(field)
+        for field in LOT_FIELDS
+    })
+
+
+def _error_message(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+    return str(e)
+
+
+class LotImporter:
+    def __init__(self, db: AsyncSession, batch_size: int = IMPORT_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.batch = []  # [(行号, 停车场ID, 字段字典)]
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, row_number, message):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"row": row_number, "error": message})
+
+    async def add(self, row_number, raw):
+        try:
+            lot_id, data = validate_row(raw)
+        except (ValueError, TypeError, ValidationError) as e:
+            self.add_error(row_number, _error_message(e))
+            return
+        self.batch.append((row_number, lot_id, data))
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+
+    # 写入当前批次,一个事务
+    async def flush(self):
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        table = ParkingLot.__table__
+        try:
+            updates = [(row_number, lot_id, data) for row_number, lot_id, data in batch if lot_id is not None]
+            creates = [data for _, lot_id, data in batch if lot_id is None]
+
+            if updates:
+                updates = await self._merge_updates(updates)
+
+            # 每行修改的字段不同,按字段分组批量更新
+            groups = {}
+            for _, lot_id, changes in updates:
+                groups.setdefault(tuple(changes), []).append(
+                    {"lot_id": lot_id, **{f"new_{field}": value for field, value in changes.items()}}
+                )
+            for fields, params in groups.items():
+                await self.db.execute(
+                    update(table)
+                    .where(table.c.id == bindparam("lot_id"))
+                    .values({field: bindparam(f"new_{field}") for field in fields}),
+                    params
+                )
+
+            if creates:
+                await self.db.execute(insert(table).values([{**data, "occupancy": 0, "updated_at": func.now()} for data in creates]))
+
+            await self.db.commit()
+            self.updated += len(updates)
+            self.created += len(creates)
+        except SQLAlchemyError as e:
+            await self.db.rollback()
+            logging.error(f"批量导入停车场时发生数据库错误: {str(e)}")
+            for row_number, _, _ in batch:
+                self.add_error(row_number, "数据库错误，该批次未写入")
+
+    # 把更新的字段和停车场现有的值合并后校验,返回 [(行号, 停车场ID, 要修改的字段)]
+    # 不存在的停车场、校验失败、容量小于当前占用数的行记为错误
+    async def _merge_updates(self, updates):
+        table = ParkingLot.__table__
+        lot_ids = {lot_id for _, lot_id, _ in updates}
+        result = await self.db.execute(
+            select(table.c.id, table.c.occupancy, table.c.occupancy_stripes, *(table.c[field] for field in LOT_FIELDS))
+            .where(table.c.id.in_(lot_ids))
+            .with_for_update()
+        )
+        rows = {row.id: row for row in result}
+        # 分段计数的停车场,parking_lots.occupancy是定期汇总的缓存,准确的占用数是各段之和
+        striped = [lot_id for lot_id, row in rows.items() if row.occupancy_stripes > 1]
+        stripe_totals = {}
+        if striped:
+            result = await self.db.execute(
+                select(ParkingLotCounter.parking_lot_id, func.sum(ParkingLotCounter.occupancy))
+                .where(ParkingLotCounter.parking_lot_id.in_(striped))
+                .group_by(ParkingLotCounter.parking_lot_id)
+            )
+            stripe_totals = dict(result.all())
+
+        # 同一批里同一个停车场的多行依次合并,后面的行在前面的行修改后的基础上校验
+        current = {lot_id: {field: row._mapping[field] for field in LOT_FIELDS} for lot_id, row in rows.items()}
+        merged = []
+        for row_number, lot_id, changes in updates:
+            row = rows.get(lot_id)
+            if row is None:
+                self.add_error(row_number, f"停车场 {lot_id} 不存在")
+                continue
+            try:
+                data = _check_lot({**current[lot_id], **changes})
+            except (ValueError, TypeError, ValidationError) as e:
+                self.add_error(row_number, _error_message(e))
+                continue
+            occupancy = stripe_totals.get(lot_id, 0) if row.occupancy_stripes > 1 else row.occupancy or 0
+            if data["capacity"] < occupancy:
+                self.add_error(row_number, f"capacity不能小于当前占用数 {occupancy}")
+                continue
+            current[lot_id] = data
+            merged.append((row_number, lot_id, {field: data[field] for field in changes}))
+        return merged
+
+    def report(self) -> dict:
+        return {
+            "created": self.created,
+            "updated": self.updated,
+            "failed": self.failed,
+            "errors": self.errors,
+        }
+
+
+# 导入整个请求体,结束时只发一次变更通知
+async def import_parking_lots(db: AsyncSession, stream, content_type: str) -> dict:
+    importer = LotImporter(db)
+    row_count = 0
+    try:
+        async for row_number, raw in iter_rows(stream, content_type):
+            row_count += 1
+            if row_count > IMPORT_MAX_ROWS:
+                importer.add_error(row_number, f"超过单次导入上限 {IMPORT_MAX_ROWS} 行")
+                break
+            await importer.add(row_number, raw)
+        await importer.flush()
+    finally:
+        # 多行插入拿不到每个新停车场的ID,统一通知"全部停车场可能有变化"
+        if importer.created or importer.updated:
+            lot_events.publish(None)
+    return importer.report()
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy.future import select
+
+import lot_events
+from models import ParkingLot
+from pricing import priced
+from shards import shard_router
+
+
+# 停车场快照
+# 保存最后一次成功查询到的全部停车场,数据库熔断(circuit.py)或查询失败时,
+# 停车场列表和可用车位从这里返回,响应带上过期标记(X-Data-Stale)和快照的年龄
+# 每次成功的全量列表查询都会刷新快照,停车场信息变化时也在后台重新加载
+class LotSnapshot:
+    def __init__(self):
+        self.lots = None  # 停车场字典的列表(按ID排序),还没有加载过时为None
+        self.by_id = {}
+        self.occupancy = {}  # 停车场ID -> 快照时的占用数(响应模型里没有这个字段,单独保存)
+        self.taken_at = None
+        self.updated = 0.0
+
+    def update(self, lots: list, occupancy: dict):
+        self.lots = lots
+        self.by_id = {lot["id"]: lot for lot in lots}
+        self.occupancy = occupancy
+        self.taken_at = datetime.now()
+        self.updated = time.monotonic()
+
+    def age_seconds(self) -> float:
+        return round(time.monotonic() - self.updated, 1) if self.lots is not None else None
+
+    # 和crud.get_parking_lots一样按位置做不区分大小写的包含匹配
+    def search(self, location: str = None) -> list:
+        if self.lots is None:
+            return None
+        if not location or not location.strip():
+            return self.lots
+        keyword = location.strip().lower()
+        return [lot for lot in self.lots if keyword in (lot["location"] or "").lower()]
+
+    def get(self, parking_lot_id: int) -> dict:
+        return self.by_id.get(parking_lot_id)
+
+    # 可用车位用的(容量, 占用数),快照里没有这个停车场时返回None
+    def capacity(self, parking_lot_id: int) -> tuple:
+        lot = self.by_id.get(parking_lot_id)
+        if lot is None:
+            return None
+        return lot["capacity"], self.occupancy.get(parking_lot_id, 0)
+
+    def headers(self) -> dict:
+        return {
+            "X-Data-Stale": "true",
+            "X-Snapshot-Age": str(self.age_seconds()),
+            "Warning": '110 - "Response is Stale"',
+        }
+
+    async def refresh(self):
+        async def load(db):
+            result = await db.execute(select(ParkingLot).order_by(ParkingLot.id))
+            return result.scalars().all()
+        lots = await shard_router.gather(load, sort_key=lambda lot: lot.id)
+        self.update(
+            [priced(lot).model_dump() for lot in lots],
+            {lot.id: lot.occupancy for lot in lots}
+        )
+
+
+lot_snapshot = LotSnapshot()
+
+_refresh_tasks = set()
+
+
+async def _refresh():
+    try:
+        await lot_snapshot.refresh()
+    except Exception as e:
+        logging.warning(f"刷新停车场快照失败,继续使用旧快照: {str(e)}")
+
+
+# 停车场信息变化时重新加载快照
+def _on_lot_change(lot_ids):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    task = loop.create_task(_refresh())
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+lot_events.subscribe(_on_lot_change)
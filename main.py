@@ -6,35 +6,77 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.future import select
 import logging
+import asyncio
 from pydantic import ValidationError
 from sqlalchemy.exc import SQLAlchemyError
 import bcrypt
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 from sqlalchemy import text
 
-from database import get_db, sync_engine, Base, async_sessionmaker
 from models import User as ModelUser, ParkingLot as ModelParkingLot, Record as ModelRecord, UserRole, RecordStatus
 from schemas import (
     UserCreate, User as SchemaUser, ParkingLotSearch, Token,
-    ParkingLot, RecordCreate, Record, RecordUpdate, ParkingLotCreate
+    ParkingLot, RecordCreate, Record, RecordUpdate, ParkingLotCreate,
+    ReservationCreate, Reservation, ReservationAvailability
 )
 import crud
+import bootstrap
+import lot_events
+import lot_import
+import occupancy
+import lot_counters
+import archive
+import sync
+import statements
+from active_index import active_index, reconcile_loop, normalize_plate
+import spots
+from spots import spot_map, SPOT_CLASS_NAMES
+from reservations import planner, expire_loop, to_local
+from overstay import overstay_monitor, overstay_loop
+import plates
+from plates import plate_index
+import event_log
+from event_log import event_log as gate_events
+import tasks
+from tasks import task_queue
+from idempotency import IdempotencyMiddleware
+from admission import AdmissionControlMiddleware
+from profiler import ProfilerMiddleware, profiler
+import circuit
+from circuit import DatabaseUnavailable
+from lot_snapshot import lot_snapshot
+import pricing
+from pricing import dynamic_pricing, priced
+from singleflight import single_flight, coalesced_query
+from shards import shard_router, get_db, get_lot_db, get_record_db, get_reservation_db
+from static_assets import PrecompressedStaticFiles, VaryDedupMiddleware, index_response
+from http_cache import conditional_json_response, make_etag, not_modified_response
+from fast_json import ORJSONResponse, record_rows
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 使用同步引擎创建数据库表
-Base.metadata.create_all(bind=sync_engine)
+# 使用同步引擎创建数据库表(每个分库)
+shard_router.prepare()
 
 # 配置FastAPI应用
 app = FastAPI()
 
-# 挂载静态文件目录
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# 挂载静态文件目录,支持预压缩文件和永久缓存(先运行 python static_assets.py 生成)
+app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
+
+# 请求性能分析,放在最内层才能沿着await链找到接口函数
+app.add_middleware(ProfilerMiddleware)
+
+# 入场/出场请求的幂等键,需要在SessionMiddleware里面(先添加的中间件在内层)
+app.add_middleware(IdempotencyMiddleware)
+
+# 准入控制和限流,同样需要在SessionMiddleware里面
+app.add_middleware(AdmissionControlMiddleware)
 
 # 配置CORS
 origins = [
@@ -64,6 +106,12 @@ app.add_middleware(
     max_age=3600  # 会话有效期1小时
 )
 
+# 响应压缩,放在幂等键外面,幂等键保存的是未压缩的响应
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+# 去掉压缩追加的重复Vary值,放在最外层
+app.add_middleware(VaryDedupMiddleware)
+
 
 # async def get_current_user(request: Request, db: AsyncSession = Depends(get_db)):
 #     user_id = request.session.get("user_id")
@@ -192,24 +240,53 @@ async def logout(request: Request):
 
 
 @app.get("/parking/lots", response_model=list[ParkingLot])
-async def get_parking_lots(
-    location: str = None,
-    db: AsyncSession = Depends(get_db)
-):
+async def get_parking_lots(request: Request, location: str = None):
+    # 数据库熔断时直接返回快照
+    if circuit.degraded():
+        return _stale_parking_lots(location)
     try:
         # 创建搜索条件
         search_criteria = ParkingLotSearch(location=location)
-        
-        # 获取停车场列表
-        parking_lots = await crud.get_parking_lots(db=db, search_criteria=search_criteria)
+
+        # 先查列表的版本(最后修改时间、数量、占用数之和),加上搜索条件和动态定价的版本生成ETag,
+        # 客户端缓存的还是最新的就直接返回304,不再查询停车场、计算价格和序列化
+        # 版本在读取列表之前查询,中间有修改时返回的是旧版本号配新数据,下次请求会再返回200,不会漏掉修改
+        versions = await coalesced_query(
+            "parking_lots_version", location, crud.get_parking_lots_version, search_criteria=search_criteria
+        )
+        last_modified = max((version[0] for version in versions if version[0]), default=None)
+        etag = make_etag(
+            last_modified and last_modified.isoformat(),
+            sum(version[1] for version in versions),
+            sum(version[2] for version in versions),
+            location or "",
+            dynamic_pricing.version
+        )
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        # 获取停车场列表,相同条件的并发请求共用一次查询
+        parking_lots = await coalesced_query(
+            "parking_lots", location, crud.get_parking_lots, search_criteria=search_criteria
+        )
         
         # 确保返回的是列表
         if not isinstance(parking_lots, list):
             parking_lots = [parking_lots] if parking_lots else []
-            
-        return parking_lots
-    except SQLAlchemyError as e:
+
+        # 当前价格直接从内存里的动态定价读取
+        lots = [priced(lot) for lot in parking_lots]
+        if not location:
+            lot_snapshot.update(
+                [lot.model_dump() for lot in lots],
+                {lot.id: getattr(lot, "occupancy", 0) for lot in parking_lots}
+            )
+        return conditional_json_response(lots, etag, last_modified)
+    except (DatabaseUnavailable, SQLAlchemyError) as e:
         logging.error(f"Database error getting parking lots: {str(e)}")
+        if lot_snapshot.lots is not None:
+            return _stale_parking_lots(location)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="数据库错误，请稍后重试"
@@ -222,6 +299,24 @@ async def get_parking_lots(
         )
 
 
+# 从快照返回停车场列表,带过期标记; 还没有快照时返回503
+def _stale_parking_lots(location: str = None):
+    lots = lot_snapshot.search(location)
+    if lots is None:
+        raise DatabaseUnavailable("数据库暂时不可用，停车场数据尚未加载")
+    return ORJSONResponse(lots, headers=lot_snapshot.headers())
+
+
+# 数据库熔断或取不到连接: 返回503,提示客户端稍后重试
+@app.exception_handler(DatabaseUnavailable)
+async def database_unavailable_handler(request: Request, exc: DatabaseUnavailable):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(int(circuit.DB_BREAKER_RESET_TIMEOUT))}
+    )
+
+
 # 权限检查函数
 async def check_admin(request: Request):
     user_role = request.session.get("user_role")
@@ -238,7 +333,7 @@ async def update_parking_lot(
     parking_lot_id: int,
     parking_lot_update: ParkingLotCreate,
     request: Request,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_lot_db)
 ):
     try:
         # 检查管理员权限
@@ -256,11 +351,14 @@ async def update_parking_lot(
             )
 
         # 更新停车场信息
-        for field, value in parking_lot_update.dict(exclude_unset=True).items():
+        changes = parking_lot_update.dict(exclude_unset=True)
+        for field, value in changes.items():
             setattr(parking_lot, field, value)
 
         await db.commit()
         await db.refresh(parking_lot)
+        lot_events.publish([parking_lot.id])
+        gate_events.append("lot_edit", parking_lot_id=parking_lot.id, changes=changes)
         return parking_lot
     except Exception as e:
         logging.error(f"Error updating parking lot: {str(e)}")
@@ -270,20 +368,249 @@ async def update_parking_lot(
         )
 
 
+# 管理员批量导入/更新停车场,支持CSV(text/csv)、JSON数组和NDJSON(application/x-ndjson)
+# 带id的行更新已有停车场,不带id的行新建; 返回每一行的错误
+# 一次导入写入一个分库(shard,默认主库),更新的停车场也需要在这个分库里
+@app.post("/admin/parkinglots/import")
+async def import_parking_lots(request: Request, shard: int = 0):
+    await check_admin(request)
+    if not 0 <= shard < len(shard_router):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"分库编号需要在 0 到 {len(shard_router) - 1} 之间"
+        )
+    content_type = request.headers.get("content-type", "application/json")
+    try:
+        async with shard_router.session(shard) as db:
+            report = await lot_import.import_parking_lots(db, request.stream(), content_type)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    logging.info(f"批量导入停车场: 新建 {report['created']}, 更新 {report['updated']}, 失败 {report['failed']}")
+    gate_events.append("lot_import", shard=shard, created=report["created"], updated=report["updated"])
+    return report
+
+
+# 管理员手动触发停车场占用数对账,dry_run=true时只报告偏差不修正
+@app.post("/admin/occupancy/reconcile")
+async def reconcile_occupancy(request: Request, dry_run: bool = False):
+    await check_admin(request)
+    try:
+        return await occupancy.reconcile_occupancy(apply=not dry_run)
+    except SQLAlchemyError as e:
+        logging.error(f"停车场占用数对账时发生数据库错误: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="数据库错误，请稍后重试"
+        )
+
+
+# 管理员查看合并查询的统计: 每个分组执行了多少次查询,平均每次服务多少个请求
+@app.get("/admin/metrics/singleflight")
+async def get_singleflight_metrics(request: Request):
+    await check_admin(request)
+    return single_flight.metrics()
+
+
+# 管理员查看超时停车告警: 在场时间超过停车场最长停车时长的车辆,超时最久的在前
+@app.get("/admin/overstays")
+async def get_overstay_alerts(request: Request, parking_lot_id: Optional[int] = None):
+    await check_admin(request)
+    alerts = overstay_monitor.active_alerts(parking_lot_id)
+    return {
+        "count": len(alerts),
+        "monitored": len(overstay_monitor),
+        "alerts": alerts,
+    }
+
+
+# 管理员查看停车场每类车位的编号范围、空闲数和已占用的车位
+@app.get("/admin/parkinglots/{parking_lot_id}/spots")
+async def get_parking_lot_spots(parking_lot_id: int, request: Request):
+    await check_admin(request)
+    summary = spot_map.summary(parking_lot_id)
+    if summary is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Parking lot not found"
+        )
+    return {"parking_lot_id": parking_lot_id, "classes": summary, "allocator": spot_map.metrics()}
+
+
+# 管理员设置停车场占用数的分段数(繁忙的停车场分成多段,减少入场/出场在同一行上的锁等待),1表示不分段
+@app.put("/admin/parkinglots/{parking_lot_id}/stripes")
+async def set_parking_lot_stripes(
+    parking_lot_id: int,
+    stripes: int,
+    request: Request,
+    db: AsyncSession = Depends(get_lot_db)
+):
+    await check_admin(request)
+    try:
+        result = await lot_counters.set_stripes(db, parking_lot_id, stripes)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Parking lot not found"
+        )
+    gate_events.append("lot_stripes", parking_lot_id=parking_lot_id, stripes=stripes)
+    return result
+
+
+# 管理员查看每个停车场的占用率和当前价格倍率
+@app.get("/admin/pricing")
+async def get_pricing(request: Request):
+    await check_admin(request)
+    return {
+        "tiers": [
+            {"min_occupancy_ratio": threshold, "multiplier": multiplier}
+            for threshold, multiplier in zip(dynamic_pricing.thresholds, dynamic_pricing.multipliers)
+        ],
+        "lots": dynamic_pricing.summary(),
+    }
+
+
+# 管理员查看数据库熔断器状态和停车场快照的年龄
+@app.get("/admin/metrics/database")
+async def get_database_metrics(request: Request):
+    await check_admin(request)
+    return {
+        "degraded": circuit.degraded(),
+        "breakers": circuit.metrics(),
+        "lot_snapshot": {
+            "lots": len(lot_snapshot.lots) if lot_snapshot.lots is not None else None,
+            "taken_at": lot_snapshot.taken_at,
+            "age_seconds": lot_snapshot.age_seconds(),
+        },
+    }
+
+
+# 管理员查看后台任务队列: 各状态的任务数、最早的到期任务已经等待的秒数、执行统计
+@app.get("/admin/metrics/tasks")
+async def get_task_metrics(request: Request):
+    await check_admin(request)
+    return await task_queue.metrics()
+
+
+# 管理员查看每个停车场每天的出场车次和收入(由出场后的后台任务汇总)
+@app.get("/admin/stats/daily")
+async def get_daily_stats(request: Request, parking_lot_id: Optional[int] = None, days: int = 30):
+    await check_admin(request)
+    return await tasks.daily_stats(parking_lot_id, min(max(days, 1), 366))
+
+
+# 管理员查看最近的请求性能分析结果(请求带 X-Profile: 1 或 ?profile=1,或者按比例抽样)
+@app.get("/admin/profiles")
+async def get_profiles(request: Request):
+    await check_admin(request)
+    return {"sample_rate": profiler.sample_rate, "profiles": profiler.summaries()}
+
+
+def _get_profile(profile_id: int):
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="分析结果不存在或已被淘汰"
+        )
+    return profile
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: int, request: Request):
+    await check_admin(request)
+    return _get_profile(profile_id).detail()
+
+
+# 下载折叠栈格式,可以用flamegraph.pl或speedscope生成火焰图
+@app.get("/admin/profiles/{profile_id}/flamegraph", response_class=PlainTextResponse)
+async def get_profile_flamegraph(profile_id: int, request: Request):
+    await check_admin(request)
+    return PlainTextResponse(
+        _get_profile(profile_id).folded(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'}
+    )
+
+
+# 管理员调整抽样分析的比例(0到1,0表示只分析显式要求的请求)
+@app.put("/admin/profiler")
+async def update_profiler(request: Request, sample_rate: float):
+    await check_admin(request)
+    if not 0 <= sample_rate <= 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="sample_rate需要在0到1之间"
+        )
+    profiler.sample_rate = sample_rate
+    return {"sample_rate": profiler.sample_rate}
+
+
+# 管理员查看闸机事件日志: 按顺序返回seq大于after_seq的事件
+@app.get("/admin/events")
+async def get_gate_events(request: Request, after_seq: int = 0, limit: int = 100):
+    await check_admin(request)
+    events = await asyncio.to_thread(gate_events.read, after_seq, min(limit, 1000))
+    return ORJSONResponse({
+        "seq": gate_events.state.seq,
+        "written_seq": gate_events.written_seq,
+        "events": events,
+    })
+
+
+# 管理员查看由事件日志推导出的各停车场在场车辆数
+@app.get("/admin/events/occupancy")
+async def get_gate_event_occupancy(request: Request):
+    await check_admin(request)
+    return ORJSONResponse({
+        "seq": gate_events.state.seq,
+        "occupancy": {str(lot_id): count for lot_id, count in sorted(gate_events.state.occupancy.items())},
+    })
+
+
+# 管理员按车牌查找车辆(在场车辆和最近的记录): 默认按前缀查找,fuzzy=true时按编辑距离模糊查找
+# 车牌先标准化(大小写、空格、横线、O/0、I/1),返回匹配的车牌和对应的记录
+@app.get("/admin/plates/search")
+async def search_plates(
+    request: Request,
+    q: str,
+    fuzzy: bool = False,
+    max_distance: int = 1,
+    limit: int = 20
+):
+    await check_admin(request)
+    try:
+        return ORJSONResponse(await plates.search_records(q, fuzzy, max_distance, min(limit, 100)))
+    except SQLAlchemyError as e:
+        logging.error(f"查找车牌时发生数据库错误: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="数据库错误，请稍后重试"
+        )
+
+
 # 管理员查看所有停车记录
 @app.get("/admin/records", response_model=list[Record])
 async def get_all_records(
     request: Request,
-    db: AsyncSession = Depends(get_db)
+    skip: int = 0,
+    limit: Optional[int] = None
 ):
     try:
         # 检查管理员权限
         await check_admin(request)
 
-        # 获取所有记录
-        result = await db.execute(select(ModelRecord))
-        records = result.scalars().all()
-        return records
+        # 获取所有分库的记录(包含已归档的记录),归并后分页,直接序列化查询结果
+        records = await shard_router.gather_page(
+            crud.get_record_history, sort_key=crud.history_sort_key, descending=True, skip=skip, limit=limit
+        )
+        return ORJSONResponse(record_rows(records))
     except Exception as e:
         logging.error(f"Error getting all records: {str(e)}")
         raise HTTPException(
@@ -294,7 +621,7 @@ async def get_all_records(
 
 # 修改现有的用户端点，添加权限检查
 @app.get("/customer/records", response_model=list[Record])
-async def get_user_records(request: Request, db: AsyncSession = Depends(get_db)):
+async def get_user_records(request: Request):
     try:
         # 获取当前用户ID
         user_id = request.session.get("user_id")
@@ -304,9 +631,11 @@ async def get_user_records(request: Request, db: AsyncSession = Depends(get_db))
                 detail="Not authenticated"
             )
 
-        # 获取用户的停车记录
-        records = await crud.get_records_by_user(db=db, user_id=user_id)
-        return records
+        # 获取用户在所有分库的停车记录,直接序列化查询结果
+        records = await shard_router.gather(
+            crud.get_records_by_user, sort_key=crud.history_sort_key, descending=True, user_id=user_id
+        )
+        return ORJSONResponse(record_rows(records))
     except Exception as e:
         logging.error(f"Error getting user records: {str(e)}")
         raise HTTPException(
@@ -315,12 +644,14 @@ async def get_user_records(request: Request, db: AsyncSession = Depends(get_db))
         )
 
 
+# 入场: 在停车场所在的分库里执行
 @app.post("/customer/records", response_model=Record)
-async def create_parking_record(
-    record: RecordCreate,
-    request: Request,
-    db: AsyncSession = Depends(get_db)
-):
+async def create_parking_record(record: RecordCreate, request: Request):
+    async with shard_router.session_for_id(record.parking_lot_id) as db:
+        return await _create_parking_record(record, request, db)
+
+
+async def _create_parking_record(record: RecordCreate, request: Request, db: AsyncSession):
     try:
         # 获取当前用户ID
         user_id = request.session.get("user_id")
@@ -333,13 +664,8 @@ async def create_parking_record(
                 detail="未登录，请先登录"
             )
 
-        # 验证停车场是否存在 - 使用原生SQL
-        parking_lot_query = """
-        SELECT id, name, location, description, capacity, fee_rate, occupancy
-        FROM parking_lots
-        WHERE id = :parking_lot_id
-        """
-        result = await db.execute(text(parking_lot_query), {"parking_lot_id": record.parking_lot_id})
+        # 验证停车场是否存在 - 使用原生SQL(预先构建的语句,见statements.py)
+        result = await db.execute(statements.LOT_FOR_CHECK_IN, {"parking_lot_id": record.parking_lot_id})
         parking_lot = result.fetchone()
         
         if not parking_lot:
@@ -349,68 +675,108 @@ async def create_parking_record(
                 detail="停车场不存在"
             )
 
-        # 检查停车场是否已满
-        if parking_lot.occupancy >= parking_lot.capacity:
+        # 检查停车场是否已满(被预约保留的车位也算占用,用户自己的预约除外)
+        # 分段计数的停车场读取各段之和,parking_lots.occupancy只是定期汇总的缓存
+        striped = parking_lot.occupancy_stripes > 1
+        occupied = await lot_counters.total(db, parking_lot.id) if striped else parking_lot.occupancy
+        reservation_id = planner.find_current(user_id, parking_lot.id)
+        held = planner.held_now(parking_lot.id) - (1 if reservation_id else 0)
+        if occupied + held >= parking_lot.capacity:
             logging.warning(f"停车场 {record.parking_lot_id} 已满")
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="停车场已满"
             )
 
-        # 检查用户是否有未完成的停车记录 - 使用原生SQL
-        active_record_query = """
-        SELECT id FROM records
-        WHERE user_id = :user_id
-        AND UPPER(status) IN ('PARKED')
-        """
-        active_result = await db.execute(text(active_record_query), {"user_id": user_id})
-        if active_result.fetchone():
+        # 检查用户/车辆是否有未完成的停车记录 - 使用内存索引
+        if active_index.user_parked(user_id):
             logging.warning(f"用户 {user_id} 已有一个进行中的停车记录")
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="您已有一个正在进行的停车记录"
             )
+        if active_index.plate_parked(record.car_number):
+            logging.warning(f"车辆 {record.car_number} 已在停车场内")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="该车辆已在其他停车场停车"
+            )
 
+        # 占位,防止并发的重复入场
+        vehicle = active_index.claim(user_id, record.car_number, record.parking_lot_id)
+        spot_number = None
         try:
-            # 更新停车场占用情况 - 使用原生SQL
-            new_occupancy = parking_lot.occupancy + 1
-            update_parking_lot_query = """
-            UPDATE parking_lots
-            SET occupancy = :occupancy
-            WHERE id = :id
-            """
-            await db.execute(
-                text(update_parking_lot_query),
-                {
-                    "occupancy": new_occupancy,
-                    "id": parking_lot.id
-                }
+            # 分配车位(编号最小的空闲车位)
+            spot_number = spot_map.allocate(
+                parking_lot.id, parking_lot.capacity, parking_lot.ev_spots, parking_lot.accessible_spots,
+                record.spot_class
             )
+            if spot_number is None:
+                logging.warning(f"停车场 {record.parking_lot_id} 没有空闲的{record.spot_class.value}车位")
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"没有空闲的{SPOT_CLASS_NAMES[record.spot_class]}车位"
+                )
+
+            # 按入场时的占用率定价,价格记在停车记录上,出场按这个价格计费
+            hourly_rate = dynamic_pricing.rate(parking_lot.id, parking_lot.fee_rate)
+
+            # 更新停车场占用情况 - 使用原生SQL
+            # 分段计数的停车场只修改其中一段,所有段都到了配额说明并发入场已经占满
+            # 配额按容量减去预约保留的车位分配,上面读取的总数没有加锁,这里才是原子的检查
+            if striped:
+                if not await lot_counters.acquire(
+                    db, parking_lot.id, parking_lot.capacity - held, parking_lot.occupancy_stripes
+                ):
+                    logging.warning(f"停车场 {record.parking_lot_id} 已满")
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="停车场已满"
+                    )
+            else:
+                new_occupancy = parking_lot.occupancy + 1
+                await db.execute(
+                    statements.UPDATE_LOT_OCCUPANCY,
+                    {
+                        "occupancy": new_occupancy,
+                        "id": parking_lot.id
+                    }
+                )
             
             # 创建停车记录 - 使用原生SQL (MySQL兼容版本)
             entry_time = datetime.now()
-            create_record_query = """
-            INSERT INTO records (user_id, car_number, parking_lot_id, entry_time, status, amount)
-            VALUES (:user_id, :car_number, :parking_lot_id, :entry_time, :status, :amount)
-            """
             insert_result = await db.execute(
-                text(create_record_query),
+                statements.INSERT_RECORD,
                 {
                     "user_id": user_id,
                     "car_number": record.car_number,
+                    "plate_key": normalize_plate(record.car_number),
                     "parking_lot_id": record.parking_lot_id,
                     "entry_time": entry_time,
                     "status": "PARKED",
-                    "amount": 0.0
+                    "amount": 0.0,
+                    "spot_number": spot_number,
+                    "hourly_rate": hourly_rate
                 }
             )
             
-            # 获取最后插入的ID - MySQL特有方法
-            get_last_id_query = "SELECT LAST_INSERT_ID() as id"
-            last_id_result = await db.execute(text(get_last_id_query))
-            record_id = last_id_result.scalar_one()
+            # 插入的ID由驱动在INSERT的响应里返回,不再单独查询LAST_INSERT_ID()
+            record_id = insert_result.lastrowid
+
+            # 用户按预约入场,预约标记为已入场
+            if reservation_id:
+                await db.execute(statements.FULFILL_RESERVATION, {"id": reservation_id})
             
             await db.commit()
+            active_index.confirm(vehicle, record_id)
+            spot_map.confirm(parking_lot.id, spot_number)
+            dynamic_pricing.check_in(parking_lot.id)
+            overstay_monitor.check_in(record_id, user_id, record.car_number, record.parking_lot_id, entry_time)
+            plate_index.add(record.car_number)
+            gate_events.append("check_in", record_id=record_id, user_id=user_id, car_number=record.car_number,
+                               parking_lot_id=record.parking_lot_id, spot_number=spot_number)
+            if reservation_id:
+                planner.release(reservation_id)
             
             logging.info(f"成功创建停车记录: ID {record_id}")
             
@@ -423,7 +789,9 @@ async def create_parking_record(
                 "status": "PARKED",
                 "entry_time": entry_time,
                 "exit_time": None,
-                "amount": 0.0
+                "amount": 0.0,
+                "spot_number": spot_number,
+                "hourly_rate": hourly_rate
             }
 
         except SQLAlchemyError as e:
@@ -433,6 +801,12 @@ async def create_parking_record(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="数据库错误，请稍后重试"
             )
+        finally:
+            # 没有成功写入时释放占位和车位
+            if vehicle.record_id is None:
+                active_index.release(vehicle)
+                if spot_number is not None:
+                    spot_map.release(parking_lot.id, spot_number)
 
     except HTTPException:
         raise
@@ -449,7 +823,7 @@ async def update_record(
     record_id: int,
     record_update: RecordUpdate,
     request: Request,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_record_db)
 ):
     try:
         # 获取当前用户ID
@@ -463,13 +837,7 @@ async def update_record(
         logging.info(f"更新记录 {record_id}，状态: {record_update.status}，用户ID: {user_id}")
 
         # 获取记录 - 使用直接的SQL查询，避免枚举问题
-        query = """
-        SELECT id, user_id, car_number, parking_lot_id, 
-               status, entry_time, exit_time, amount
-        FROM records 
-        WHERE id = :record_id
-        """
-        result = await db.execute(text(query), {"record_id": record_id})
+        result = await db.execute(statements.RECORD_FOR_UPDATE, {"record_id": record_id})
         record_row = result.fetchone()
         
         if not record_row:
@@ -495,17 +863,14 @@ async def update_record(
             target_status = record_update.status.upper()
             current_status = str(record_row.status).upper()
             
+            exit_time = record_row.exit_time
+            amount = record_row.amount
             if current_status != target_status:
                 logging.info(f"状态将从 {current_status} 变为 {target_status}")
                 
                 # 获取停车场
-                parking_lot_query = """
-                SELECT id, name, location, description, capacity, fee_rate, occupancy
-                FROM parking_lots
-                WHERE id = :parking_lot_id
-                """
                 parking_lot_result = await db.execute(
-                    text(parking_lot_query), 
+                    statements.LOT_FOR_CHECK_OUT,
                     {"parking_lot_id": record_row.parking_lot_id}
                 )
                 parking_lot = parking_lot_result.fetchone()
@@ -525,35 +890,28 @@ async def update_record(
                 # 计算停车时长（小时）
                 duration = (exit_time - record_row.entry_time).total_seconds() / 3600
                 
-                # 计算费用
-                amount = duration * parking_lot.fee_rate
+                # 计算费用: 按入场时记录的价格,没有记录价格的旧记录按停车场的基础价格
+                hourly_rate = record_row.hourly_rate if record_row.hourly_rate is not None else parking_lot.fee_rate
+                amount = duration * hourly_rate
                 
-                # 更新停车场占用情况
-                new_occupancy = max(0, parking_lot.occupancy - 1)
-                
-                await db.execute(
-                    text("""
-                    UPDATE parking_lots
-                    SET occupancy = :occupancy
-                    WHERE id = :id
-                    """),
-                    {
-                        "occupancy": new_occupancy,
-                        "id": parking_lot.id
-                    }
-                )
-                
-                logging.info(f"更新后的停车场占用: {new_occupancy}, 停车时长: {duration}小时, 费用: {amount}")
+                # 更新停车场占用情况(分段计数的停车场只修改其中一段)
+                if parking_lot.occupancy_stripes > 1:
+                    await lot_counters.release(db, parking_lot.id, parking_lot.occupancy_stripes)
+                    logging.info(f"停车场 {parking_lot.id} 分段占用数减1, 停车时长: {duration}小时, 费用: {amount}")
+                else:
+                    new_occupancy = max(0, parking_lot.occupancy - 1)
+                    await db.execute(
+                        statements.UPDATE_LOT_OCCUPANCY,
+                        {
+                            "occupancy": new_occupancy,
+                            "id": parking_lot.id
+                        }
+                    )
+                    logging.info(f"更新后的停车场占用: {new_occupancy}, 停车时长: {duration}小时, 费用: {amount}")
 
                 # 更新记录
                 await db.execute(
-                    text("""
-                    UPDATE records
-                    SET status = :status,
-                        exit_time = :exit_time,
-                        amount = :amount
-                    WHERE id = :id
-                    """),
+                    statements.COMPLETE_RECORD,
                     {
                         "status": target_status,
                         "exit_time": exit_time,
@@ -561,14 +919,14 @@ async def update_record(
                         "id": record_id
                     }
                 )
+
+                # 出场后的小票、统计等工作写成后台任务,和状态变化一起提交
+                if current_status == "PARKED":
+                    await tasks.enqueue_checkout(db, record_id, parking_lot.id, exit_time, amount)
             else:
                 # 只更新状态
                 await db.execute(
-                    text("""
-                    UPDATE records
-                    SET status = :status
-                    WHERE id = :id
-                    """),
+                    statements.UPDATE_RECORD_STATUS,
                     {
                         "status": target_status,
                         "id": record_id
@@ -576,29 +934,35 @@ async def update_record(
                 )
             
             await db.commit()
+
+            # 离开停车中状态时从在场车辆索引移除
+            if current_status == "PARKED" and target_status != "PARKED":
+                task_queue.notify()
+                active_index.check_out(record_id)
+                overstay_monitor.check_out(record_id)
+                if record_row.spot_number is not None:
+                    spot_map.release(record_row.parking_lot_id, record_row.spot_number)
+                dynamic_pricing.check_out(record_row.parking_lot_id)
+                gate_events.append("check_out", record_id=record_id, parking_lot_id=record_row.parking_lot_id,
+                                   status=target_status, amount=amount)
+            elif current_status != target_status:
+                gate_events.append("status_change", record_id=record_id, parking_lot_id=record_row.parking_lot_id,
+                                   from_status=current_status, to_status=target_status)
             
-            # 获取更新后的记录
-            updated_record_query = """
-            SELECT id, user_id, car_number, parking_lot_id, 
-                   status, entry_time, exit_time, amount
-            FROM records 
-            WHERE id = :record_id
-            """
-            updated_result = await db.execute(text(updated_record_query), {"record_id": record_id})
-            updated_record = updated_result.fetchone()
-            
-            logging.info(f"成功更新记录 {updated_record.id}, 新状态: {updated_record.status}")
+            logging.info(f"成功更新记录 {record_id}, 新状态: {target_status}")
             
-            # 将记录转换为字典并返回
+            # 更新后的记录由查询到的记录和本次修改组成,不再重新查询
             return {
-                "id": updated_record.id,
-                "user_id": updated_record.user_id,
-                "car_number": updated_record.car_number,
-                "parking_lot_id": updated_record.parking_lot_id,
+                "id": record_row.id,
+                "user_id": record_row.user_id,
+                "car_number": record_row.car_number,
+                "parking_lot_id": record_row.parking_lot_id,
                 "status": target_status,
-                "entry_time": updated_record.entry_time,
-                "exit_time": updated_record.exit_time,
-                "amount": updated_record.amount
+                "entry_time": record_row.entry_time,
+                "exit_time": exit_time,
+                "amount": amount,
+                "spot_number": record_row.spot_number,
+                "hourly_rate": record_row.hourly_rate
             }
             
         except SQLAlchemyError as e:
@@ -620,7 +984,7 @@ async def update_record(
 
 
 @app.get("/customer/records/uncompleted", response_model=list[Record])
-async def get_uncompleted_records(request: Request, db: AsyncSession = Depends(get_db)):
+async def get_uncompleted_records(request: Request):
     try:
         # 获取当前用户ID
         user_id = request.session.get("user_id")
@@ -630,8 +994,11 @@ async def get_uncompleted_records(request: Request, db: AsyncSession = Depends(g
                 detail="Not authenticated"
             )
 
-        # 获取未完成的记录
-        records = await crud.get_uncompleted_records(db=db)
+        # 获取未完成的记录,并发请求共用一次查询
+        records = await coalesced_query(
+            "uncompleted_records", None, crud.get_uncompleted_records,
+            sort_key=lambda record: record.entry_time, descending=True
+        )
         return records
     except Exception as e:
         logging.error(f"Error getting uncompleted records: {str(e)}")
@@ -642,7 +1009,11 @@ async def get_uncompleted_records(request: Request, db: AsyncSession = Depends(g
 
 
 @app.get("/customer/my-records", response_model=List[Record])
-async def get_my_records(request: Request, db: AsyncSession = Depends(get_db)):
+async def get_my_records(
+    request: Request,
+    skip: int = 0,
+    limit: Optional[int] = None
+):
     try:
         # 获取当前用户ID
         user_id = request.session.get("user_id")
@@ -655,40 +1026,19 @@ async def get_my_records(request: Request, db: AsyncSession = Depends(get_db)):
         logging.info(f"正在获取用户 {user_id} 的停车记录")
 
         try:
-            # 使用直接的SQL查询
-            query = """
-            SELECT id, user_id, car_number, parking_lot_id, 
-                   UPPER(status) as status, entry_time, exit_time, amount,
-                   created_at, updated_at
-            FROM records 
-            WHERE user_id = :user_id
-            ORDER BY created_at DESC
-            """
-            result = await db.execute(text(query), {"user_id": user_id})
-            rows = result.fetchall()
+            # 合并查询所有分库的热表和归档表
+            rows = await shard_router.gather_page(
+                crud.get_record_history, sort_key=crud.history_sort_key, descending=True,
+                skip=skip, limit=limit, user_id=user_id
+            )
             
             logging.info(f"成功获取到 {len(rows)} 条停车记录")
             
-            # 将行转换为字典
-            records = []
-            for row in rows:
-                record_dict = {
-                    "id": row.id,
-                    "user_id": row.user_id,
-                    "car_number": row.car_number,
-                    "parking_lot_id": row.parking_lot_id,
-                    "status": row.status,
-                    "entry_time": row.entry_time,
-                    "exit_time": row.exit_time,
-                    "amount": row.amount
-                }
-                records.append(record_dict)
-            
-            return records
+            # 将行直接转换为字典并序列化,不再逐条经过pydantic校验
+            return ORJSONResponse(record_rows(rows))
 
         except SQLAlchemyError as e:
             logging.error(f"查询停车记录时发生数据库错误: {str(e)}")
-            await db.rollback()
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="查询数据库时发生错误"
@@ -704,9 +1054,166 @@ async def get_my_records(request: Request, db: AsyncSession = Depends(get_db)):
         )
 
 
+# 增量同步: 返回游标之后变化的停车记录和停车场,不带since时只返回当前游标
+# scope=all返回所有用户的记录(管理员),否则只返回自己的记录; 未登录时只返回停车场
+# reset为true表示变化太多,前端需要重新全量加载
+@app.get("/sync/changes")
+async def get_changes(
+    request: Request,
+    since: Optional[datetime] = None,
+    scope: str = "mine"
+):
+    user_id = request.session.get("user_id")
+    if scope == "all":
+        await check_admin(request)
+    try:
+        changes = await sync.get_changes(
+            since,
+            user_id=None if scope == "all" else user_id,
+            include_records=scope == "all" or user_id is not None
+        )
+    except SQLAlchemyError as e:
+        logging.error(f"查询增量变化时发生数据库错误: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="数据库错误，请稍后重试"
+        )
+    return ORJSONResponse(changes)
+
+
+# 查询停车场某个时间段是否还能预约
+@app.get("/parking/lots/{parking_lot_id}/availability", response_model=ReservationAvailability)
+async def get_reservation_availability(
+    parking_lot_id: int,
+    start_time: datetime,
+    end_time: datetime
+):
+    if end_time <= start_time:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="结束时间必须晚于开始时间"
+        )
+
+    # 停车场所在分库熔断(session_for_id抛出DatabaseUnavailable)或查询失败时用停车场快照里的容量和占用数
+    parking_lot = None
+    stale = False
+    try:
+        async with shard_router.session_for_id(parking_lot_id) as db:
+            result = await db.execute(
+                select(ModelParkingLot.capacity, ModelParkingLot.occupancy)
+                .filter(ModelParkingLot.id == parking_lot_id)
+            )
+            parking_lot = result.first()
+    except (DatabaseUnavailable, SQLAlchemyError) as e:
+        logging.error(f"查询停车场 {parking_lot_id} 时发生数据库错误: {str(e)}")
+        stale = True
+    if stale:
+        if lot_snapshot.lots is None:
+            raise DatabaseUnavailable("数据库暂时不可用，停车场数据尚未加载")
+        parking_lot = lot_snapshot.capacity(parking_lot_id)
+    if not parking_lot:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="停车场不存在"
+        )
+
+    capacity, occupancy = parking_lot
+    reserved = planner.reserved(parking_lot_id, start_time, end_time)
+    in_use = (occupancy or 0) if to_local(start_time) <= datetime.now() else 0
+    content = {
+        "parking_lot_id": parking_lot_id,
+        "start_time": start_time,
+        "end_time": end_time,
+        "capacity": capacity,
+        "reserved": reserved,
+        "available": reserved + in_use < capacity,
+        "stale": stale,
+    }
+    if stale:
+        return ORJSONResponse(content, headers=lot_snapshot.headers())
+    return content
+
+
+# 创建预约
+@app.post("/customer/reservations", response_model=Reservation)
+async def create_reservation(reservation: ReservationCreate, request: Request):
+    user_id = request.session.get("user_id")
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="未登录，请先登录"
+        )
+
+    try:
+        # 预约和停车场在同一个分库
+        async with shard_router.session_for_id(reservation.parking_lot_id) as db:
+            return await crud.create_reservation(db=db, reservation=reservation, user_id=user_id)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except SQLAlchemyError as e:
+        logging.error(f"创建预约时发生数据库错误: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="数据库错误，请稍后重试"
+        )
+
+
+# 查看自己的预约
+@app.get("/customer/reservations", response_model=List[Reservation])
+async def get_my_reservations(request: Request):
+    user_id = request.session.get("user_id")
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="未登录，请先登录"
+        )
+    return await shard_router.gather(
+        crud.get_reservations_by_user,
+        sort_key=lambda reservation: reservation.start_time, descending=True, user_id=user_id
+    )
+
+
+# 取消预约
+@app.delete("/customer/reservations/{reservation_id}", response_model=Reservation)
+async def cancel_reservation(
+    reservation_id: int,
+    request: Request,
+    db: AsyncSession = Depends(get_reservation_db)
+):
+    user_id = request.session.get("user_id")
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="未登录，请先登录"
+        )
+
+    db_reservation = await crud.get_reservation(db=db, reservation_id=reservation_id)
+    if not db_reservation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="预约不存在"
+        )
+    if db_reservation.user_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="没有权限取消此预约"
+        )
+
+    try:
+        return await crud.cancel_reservation(db=db, db_reservation=db_reservation)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+
 @app.get("/")
-async def root():
-    return FileResponse("static/index.html", media_type="text/html")
+async def root(request: Request):
+    return index_response(request)
 
 
 # 初始化管理员用户
@@ -750,7 +1257,7 @@ async def init_parking_lots(db: AsyncSession):
                     description="24/7 Secure parking near subway station",
                     capacity=100,
                     fee_rate=10.0,
-                    occupancy=30
+                    accessible_spots=4
                 ),
                 ModelParkingLot(
                     name="Business District Parking B",
@@ -758,7 +1265,8 @@ async def init_parking_lots(db: AsyncSession):
                     description="Premium parking with EV charging stations",
                     capacity=200,
                     fee_rate=15.0,
-                    occupancy=80
+                    ev_spots=20,
+                    accessible_spots=6
                 ),
                 ModelParkingLot(
                     name="Shopping Mall Parking C",
@@ -766,7 +1274,7 @@ async def init_parking_lots(db: AsyncSession):
                     description="Covered parking with direct mall access",
                     capacity=300,
                     fee_rate=8.0,
-                    occupancy=150
+                    accessible_spots=10
                 )
             ]
             
@@ -786,11 +1294,11 @@ async def init_parking_lots(db: AsyncSession):
 async def startup_event():
     try:
         # 初始化数据库
-        Base.metadata.create_all(bind=sync_engine)
+        shard_router.prepare()
         logging.info("数据库表已创建")
         
-        # 修复记录状态值
-        async with async_sessionmaker() as db:
+        # 修复记录状态值(每个分库)
+        async def fix_record_status(db):
             try:
                 # 更新所有小写的状态值为大写
                 await db.execute(text("""
@@ -804,22 +1312,91 @@ async def startup_event():
                     WHERE LOWER(status) IN ('parked', 'paid', 'completed')
                 """))
                 await db.commit()
-                logging.info("成功修复记录状态值")
             except Exception as e:
                 logging.error(f"修复记录状态值时发生错误: {str(e)}")
                 await db.rollback()
                 raise
+        await shard_router.scatter(fix_record_status)
+        logging.info("成功修复记录状态值")
 
-        # 初始化管理员用户和停车场
-        async with async_sessionmaker() as db:
+        # 初始化管理员用户和停车场(主库)
+        async with shard_router.session() as db:
             await init_admin_user(db)
             await init_parking_lots(db)
+
+        # 构建在场车辆索引、预约容量规划和超时停车监控
+        await active_index.rebuild()
+        await spot_map.rebuild()
+        await planner.rebuild()
+        await overstay_monitor.rebuild()
+        await asyncio.to_thread(gate_events.recover)
+        # 先加载动态定价,快照里的停车场带上当前价格
+        try:
+            await dynamic_pricing.sync()
+        except Exception as e:
+            logging.warning(f"加载停车场价格失败: {str(e)}")
+        try:
+            await lot_snapshot.refresh()
+        except Exception as e:
+            logging.warning(f"加载停车场快照失败: {str(e)}")
+
+        # 启动后台任务
+        app.state.background_tasks = [
+            asyncio.create_task(archive.archive_loop()),
+            asyncio.create_task(reconcile_loop()),
+            asyncio.create_task(expire_loop()),
+            asyncio.create_task(occupancy.reconcile_loop()),
+            asyncio.create_task(overstay_loop()),
+            asyncio.create_task(plates.refresh_loop()),
+            asyncio.create_task(event_log.flush_loop()),
+            asyncio.create_task(task_queue.run()),
+            asyncio.create_task(tasks.purge_loop()),
+            asyncio.create_task(circuit.probe_loop()),
+            asyncio.create_task(spots.flush_loop()),
+            asyncio.create_task(spots.reconcile_loop()),
+            asyncio.create_task(pricing.sync_loop()),
+            asyncio.create_task(lot_counters.sync_loop()),
+        ]
             
     except Exception as e:
         logging.error(f"启动事件发生错误: {str(e)}")
         raise
 
 
+# 应用关闭时停止后台任务
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
+    # 写入缓冲区里剩下的事件和车位位图
+    gate_events.flush()
+    gate_events.close()
+    try:
+        await spot_map.flush()
+    except Exception as e:
+        logging.error(f"写入车位位图时发生错误: {str(e)}")
+
+
+# 页面加载和登录之后一次取回用户、同步游标、停车场列表和第一页停车记录,未登录时user为null
+@app.get("/bootstrap")
+async def get_bootstrap(request: Request, location: str = None):
+    try:
+        data = await bootstrap.load(
+            user_id=request.session.get("user_id"),
+            role=request.session.get("role"),
+            location=location
+        )
+    except SQLAlchemyError as e:
+        logging.error(f"加载页面数据时发生数据库错误: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="数据库错误，请稍后重试"
+        )
+    if data["stale"]:
+        return ORJSONResponse(data, headers=lot_snapshot.headers())
+    return ORJSONResponse(data)
+
+
 @app.get("/auth/status", response_model=SchemaUser)
 async def get_auth_status(request: Request, db: AsyncSession = Depends(get_db)):
     try:
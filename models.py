@@ -1,5 +1,5 @@
 # 模型类 ,两张数据库的表格
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Enum
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Date, ForeignKey, Enum, Index, Text, LargeBinary
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import enum
@@ -29,6 +29,23 @@ class RecordStatus(str, enum.Enum):
                     return member
         return None
 
+class SpotClass(str, enum.Enum):
+    standard = "standard"      # 普通车位
+    ev = "ev"                  # 充电车位
+    accessible = "accessible"  # 无障碍车位
+
+class TaskStatus(str, enum.Enum):
+    PENDING = "PENDING"      # 等待执行(包括等待重试)
+    RUNNING = "RUNNING"      # 执行中
+    DONE = "DONE"            # 已完成
+    FAILED = "FAILED"        # 重试次数用完
+
+class ReservationStatus(str, enum.Enum):
+    ACTIVE = "ACTIVE"        # 预约中
+    FULFILLED = "FULFILLED"  # 已入场
+    CANCELLED = "CANCELLED"  # 已取消
+    EXPIRED = "EXPIRED"      # 已过期(未入场)
+
 class User(Base):
     __tablename__ = "users"
 
@@ -41,6 +58,7 @@ class User(Base):
 
     # 关联关系
     records = relationship("Record", back_populates="user")
+    reservations = relationship("Reservation", back_populates="user")
 
 class ParkingLot(Base):
     __tablename__ = "parking_lots"
@@ -52,12 +70,23 @@ class ParkingLot(Base):
     capacity = Column(Integer, nullable=False)
     fee_rate = Column(Float, nullable=False)  # 每小时费用
     occupancy = Column(Integer, default=0)  # 当前占用数量
+    max_stay_hours = Column(Float, nullable=True)  # 最长停车时长(小时),为空时使用默认值
+    ev_spots = Column(Integer, default=0, nullable=False)  # 充电车位数,编号从1开始
+    accessible_spots = Column(Integer, default=0, nullable=False)  # 无障碍车位数,编号接在充电车位后面
+    occupancy_stripes = Column(Integer, default=1, nullable=False)  # 大于1时占用数分散在parking_lot_counters里(lot_counters.py)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
     # 关联关系
     records = relationship("Record", back_populates="parking_lot")
 
+    # 增量同步按修改时间查询
+    # sqlite_autoincrement: 分库用SQLite测试时需要按分库设置自增ID的起点(shards.py)
+    __table_args__ = (
+        Index("ix_parking_lots_updated_at", "updated_at"),
+        {"sqlite_autoincrement": True},
+    )
+
     @property
     def availability(self):
         return self.occupancy < self.capacity
@@ -69,10 +98,13 @@ class Record(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     parking_lot_id = Column(Integer, ForeignKey("parking_lots.id"), nullable=False)
     car_number = Column(String(20), nullable=False)  # 车牌号
+    plate_key = Column(String(20), nullable=True)  # 标准化后的车牌(active_index.normalize_plate),用于查找车辆
     entry_time = Column(DateTime(timezone=True), server_default=func.now())
     exit_time = Column(DateTime(timezone=True), nullable=True)
     status = Column(Enum(RecordStatus), default=RecordStatus.PARKED)
     amount = Column(Float, default=0.0)  # 停车费用
+    spot_number = Column(Integer, nullable=True)  # 分配的车位编号(spots.py)
+    hourly_rate = Column(Float, nullable=True)  # 入场时的每小时价格(pricing.py),出场按这个价格计费
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -80,5 +112,133 @@ class Record(Base):
     user = relationship("User", back_populates="records")
     parking_lot = relationship("ParkingLot", back_populates="records")
 
+    # 归档任务按状态+离场时间挑选冷数据,增量同步按修改时间查询
+    __table_args__ = (
+        Index("ix_records_status_exit_time", "status", "exit_time"),
+        Index("ix_records_updated_at", "updated_at"),
+        Index("ix_records_user_updated_at", "user_id", "updated_at"),
+        Index("ix_records_plate_key", "plate_key"),
+        {"sqlite_autoincrement": True},
+    )
+
     def __repr__(self):
         return f"<Record(id={self.id}, user_id={self.user_id}, parking_lot_id={self.parking_lot_id}, car_number={self.car_number}, entry_time={self.entry_time}, exit_time={self.exit_time})>"
+
+
+# 已有的表在创建之后新增的列,启动时自动补上(create_all不会修改已存在的表)
+ADDED_COLUMNS = {
+    "parking_lots": {
+        "max_stay_hours": "FLOAT NULL",
+        "ev_spots": "INTEGER NOT NULL DEFAULT 0",
+        "accessible_spots": "INTEGER NOT NULL DEFAULT 0",
+        "occupancy_stripes": "INTEGER NOT NULL DEFAULT 1",
+    },
+    "records": {"plate_key": "VARCHAR(20) NULL", "spot_number": "INTEGER NULL", "hourly_rate": "FLOAT NULL"},
+    "records_archive": {"spot_number": "INTEGER NULL", "hourly_rate": "FLOAT NULL"},
+}
+
+
+# 热表和归档表共有的字段,归档时按这个顺序原样复制
+RECORD_COLUMNS = (
+    "id", "user_id", "parking_lot_id", "car_number", "entry_time",
+    "exit_time", "status", "amount", "spot_number", "hourly_rate", "created_at", "updated_at",
+)
+
+
+# 归档记录(冷数据),已完成且超过保留期的记录从records批量迁移到这里,保证热表足够小
+class ArchivedRecord(Base):
+    __tablename__ = "records_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # 沿用records里的原始ID
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    parking_lot_id = Column(Integer, ForeignKey("parking_lots.id"), nullable=False)
+    car_number = Column(String(20), nullable=False)
+    entry_time = Column(DateTime(timezone=True))
+    exit_time = Column(DateTime(timezone=True), nullable=True)
+    status = Column(Enum(RecordStatus), default=RecordStatus.COMPLETED)
+    amount = Column(Float, default=0.0)
+    spot_number = Column(Integer, nullable=True)
+    hourly_rate = Column(Float, nullable=True)
+    created_at = Column(DateTime(timezone=True))
+    updated_at = Column(DateTime(timezone=True))
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_records_archive_user_entry", "user_id", "entry_time"),
+    )
+
+
+# 预约记录,预约成功后在时间窗口内为用户保留一个车位
+class Reservation(Base):
+    __tablename__ = "reservations"
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    parking_lot_id = Column(Integer, ForeignKey("parking_lots.id"), nullable=False)
+    car_number = Column(String(20), nullable=False)
+    start_time = Column(DateTime(timezone=True), nullable=False)
+    end_time = Column(DateTime(timezone=True), nullable=False)
+    status = Column(Enum(ReservationStatus), default=ReservationStatus.ACTIVE)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    # 关联关系
+    user = relationship("User", back_populates="reservations")
+
+    __table_args__ = (
+        Index("ix_reservations_status_end_time", "status", "end_time"),
+        {"sqlite_autoincrement": True},
+    )
+
+
+# 后台任务队列(tasks.py),每个分库一张表,和触发任务的状态变化在同一个事务里写入
+class QueuedTask(Base):
+    __tablename__ = "task_queue"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(50), nullable=False)  # 任务类型,对应tasks.py里注册的处理函数
+    payload = Column(Text, nullable=False)  # JSON参数
+    status = Column(Enum(TaskStatus), default=TaskStatus.PENDING, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    run_at = Column(DateTime, nullable=False)  # 最早执行时间,重试时推后
+    locked_until = Column(DateTime, nullable=True)  # 执行中的租约,进程崩溃后过期的任务重新执行
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_task_queue_status_run_at", "status", "run_at"),
+    )
+
+
+# 每个停车场每天的出场车次和收入,由出场后的后台任务累加
+class LotDailyStats(Base):
+    __tablename__ = "lot_daily_stats"
+
+    parking_lot_id = Column(Integer, primary_key=True, autoincrement=False)
+    day = Column(Date, primary_key=True)
+    checkouts = Column(Integer, default=0, nullable=False)
+    revenue = Column(Float, default=0.0, nullable=False)
+
+
+# 车位占用位图(spots.py),每个停车场每类车位一行,由后台批量写入
+# 停车记录上的spot_number是准确的占用情况,这里的位图用于启动时恢复和对账
+class ParkingSpotMap(Base):
+    __tablename__ = "parking_spot_maps"
+
+    parking_lot_id = Column(Integer, primary_key=True, autoincrement=False)
+    spot_class = Column(String(20), primary_key=True)
+    first_spot = Column(Integer, nullable=False)  # 这一类第一个车位的编号
+    spot_count = Column(Integer, nullable=False)
+    bitmap = Column(LargeBinary, nullable=False)  # 每个车位一位,1表示占用,小端64位字
+    updated_at = Column(DateTime, nullable=False)
+
+
+# 繁忙停车场的分段占用计数(lot_counters.py),每个停车场occupancy_stripes行
+# 入场/出场只修改其中一行,停车场的占用数是各行之和,parking_lots.occupancy是定期汇总的缓存
+class ParkingLotCounter(Base):
+    __tablename__ = "parking_lot_counters"
+
+    parking_lot_id = Column(Integer, primary_key=True, autoincrement=False)
+    stripe = Column(Integer, primary_key=True, autoincrement=False)
+    occupancy = Column(Integer, default=0, nullable=False)
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+
+from sqlalchemy import case, func, text, update
+from sqlalchemy.future import select
+
+from models import ParkingLot, ParkingLotCounter, Record, RecordStatus
+from pricing import dynamic_pricing
+from shards import shard_router
+
+
+# 停车场占用数对账
+# parking_lots.occupancy是冗余计数,会和records里真实的在场车辆数产生偏差
+# 这里用一次分组聚合算出真实数量,再用一条批量UPDATE修正偏差
+# 修正时用 occupancy + 偏差 而不是直接赋值,对账期间发生的入场/出场不会被覆盖
+# 分段计数的停车场(lot_counters.py)按各段之和对账,偏差修正在第0段上
+RECONCILE_INTERVAL = int(os.getenv("OCCUPANCY_RECONCILE_INTERVAL", "600"))  # 定时对账间隔(秒)
+
+
+# 对账一个分库,返回 (停车场数量, 偏差)
+async def _reconcile_shard(shard: int, apply: bool):
+    async with shard_router.session(shard) as db:
+        # 两次查询在同一个事务里,读到的是同一个快照(普通SELECT不加锁)
+        actual_result = await db.execute(
+            select(Record.parking_lot_id, func.count(Record.id))
+            .filter(Record.status == RecordStatus.PARKED)
+            .group_by(Record.parking_lot_id)
+        )
+        actual = dict(actual_result.all())
+        lots_result = await db.execute(select(ParkingLot.id, ParkingLot.occupancy, ParkingLot.occupancy_stripes))
+        lots = lots_result.all()
+        stripes_result = await db.execute(
+            select(ParkingLotCounter.parking_lot_id, func.sum(ParkingLotCounter.occupancy))
+            .group_by(ParkingLotCounter.parking_lot_id)
+        )
+        striped_totals = dict(stripes_result.all())
+        await db.rollback()
+
+        drift = {}
+        striped = set()
+        for lot_id, occupancy, stripes in lots:
+            if (stripes or 1) > 1:
+                recorded = striped_totals.get(lot_id) or 0
+                striped.add(lot_id)
+            else:
+                recorded = occupancy or 0
+            count = actual.get(lot_id, 0)
+            if recorded != count:
+                drift[lot_id] = {"recorded": recorded, "actual": count, "drift": recorded - count}
+
+        if apply and drift:
+            plain = {lot_id: item for lot_id, item in drift.items() if lot_id not in striped}
+            try:
+                if plain:
+                    await db.execute(
+                        update(ParkingLot)
+                        .filter(ParkingLot.id.in_(list(plain)))
+                        .values(occupancy=func.coalesce(ParkingLot.occupancy, 0) - case(
+                            {lot_id: item["drift"] for lot_id, item in plain.items()},
+                            value=ParkingLot.id
+                        ))
+                        .execution_options(synchronize_session=False)
+                    )
+                if len(plain) < len(drift):
+                    await db.execute(
+                        text("""
+                        UPDATE parking_lot_counters
+                        SET occupancy = occupancy - :drift
+                        WHERE parking_lot_id = :parking_lot_id AND stripe = 0
+                        """),
+                        [
+                            {"parking_lot_id": lot_id, "drift": item["drift"]}
+                            for lot_id, item in drift.items() if lot_id in striped
+                        ]
+                    )
+                await db.commit()
+                # 动态定价里的占用数做同样的修正
+                for lot_id, item in drift.items():
+                    dynamic_pricing.adjust(lot_id, -item["drift"])
+            except Exception:
+                await db.rollback()
+                raise
+    return len(lots), drift
+
+
+# 停车场和它的停车记录在同一个分库,每个分库分别对账
+async def reconcile_occupancy(apply: bool = True) -> dict:
+    checked = 0
+    drift = {}
+    for shard in range(len(shard_router)):
+        shard_checked, shard_drift = await _reconcile_shard(shard, apply)
+        checked += shard_checked
+        drift.update(shard_drift)
+
+    if drift:
+        logging.warning(f"停车场占用数偏差{'(已修正)' if apply else ''}: {drift}")
+    return {
+        "checked": checked,
+        "drifted": len(drift),
+        "applied": apply,
+        "lots": drift,
+    }
+
+
+# 启动后先对账一次,之后定时对账
+async def reconcile_loop():
+    while True:
+        try:
+            await reconcile_occupancy()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"停车场占用数对账时发生错误: {str(e)}")
+        await asyncio.sleep(RECONCILE_INTERVAL)
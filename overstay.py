@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy.future import select
+
+import lot_events
+from models import ParkingLot, Record, RecordStatus
+from shards import shard_router
+
+
+# 超时停车告警
+# 在场车辆按"入场时间 + 停车场最长停车时长"放进时间轮,入场/出场时O(1)加入/移除
+# 后台每个tick推进一次时间轮,只处理到期槽里的车辆,不需要定时查询全部PARKED记录
+OVERSTAY_DEFAULT_HOURS = float(os.getenv("OVERSTAY_DEFAULT_HOURS", "24"))  # 停车场没有设置时的最长停车时长
+OVERSTAY_TICK = float(os.getenv("OVERSTAY_TICK", "60"))  # 时间轮精度(秒),告警最多晚一个tick
+OVERSTAY_WHEEL_SLOTS = int(os.getenv("OVERSTAY_WHEEL_SLOTS", "2048"))  # 槽数,槽数*tick最好大于常见的停车时长
+
+
+class TimerWheel:
+    # 哈希时间轮: 到期tick对槽数取模决定放在哪个槽,超过一圈的定时器留在槽里等下一圈
+    def __init__(self, tick: float, slots: int, now: float):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]  # 每个槽: key -> 到期tick
+        self.slot_of = {}  # key -> 所在的槽
+        self.current = int(now // tick)  # 已经处理到的tick
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def add(self, key, deadline: float):
+        self.remove(key)
+        due = max(math.ceil(deadline / self.tick), self.current + 1)
+        index = due % len(self.slots)
+        self.slots[index][key] = due
+        self.slot_of[key] = index
+
+    def remove(self, key):
+        index = self.slot_of.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    # 推进到now,返回到期的key; 落后超过一圈时每个槽只扫一次
+    def advance(self, now: float) -> list:
+        target = int(now // self.tick)
+        steps = min(target - self.current, len(self.slots))
+        fired = []
+        for t in range(target - steps + 1, target + 1):
+            slot = self.slots[t % len(self.slots)]
+            due = [key for key, due_tick in slot.items() if due_tick <= target]
+            for key in due:
+                del slot[key]
+                del self.slot_of[key]
+            fired.extend(due)
+        self.current = max(self.current, target)
+        return fired
+
+
+class ParkedSession:
+    __slots__ = ("record_id", "user_id", "car_number", "parking_lot_id", "entry_time", "deadline")
+
+    def __init__(self, record_id, user_id, car_number, parking_lot_id, entry_time, deadline):
+        self.record_id = record_id
+        self.user_id = user_id
+        self.car_number = car_number
+        self.parking_lot_id = parking_lot_id
+        self.entry_time = entry_time  # datetime
+        self.deadline = deadline  # 时间戳(秒)
+
+
+class OverstayMonitor:
+    # 和在场车辆索引一样,修改方法都是同步的
+    def __init__(self, tick: float = OVERSTAY_TICK, slots: int = OVERSTAY_WHEEL_SLOTS):
+        self.wheel = TimerWheel(tick, slots, time.time())
+        self.sessions = {}  # 记录ID -> ParkedSession
+        self.alerts = {}    # 已超时仍在场的记录ID -> ParkedSession
+        self.limits = {}    # 停车场ID -> 最长停车时长(小时)
+        self.fired_total = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def limit_hours(self, parking_lot_id: int) -> float:
+        return self.limits.get(parking_lot_id) or OVERSTAY_DEFAULT_HOURS
+
+    def _schedule(self, session: ParkedSession):
+        session.deadline = session.entry_time.timestamp() + self.limit_hours(session.parking_lot_id) * 3600
+        self.alerts.pop(session.record_id, None)
+        self.wheel.add(session.record_id, session.deadline)
+
+    def check_in(self, record_id: int, user_id: int, car_number: str, parking_lot_id: int, entry_time: datetime):
+        session = ParkedSession(record_id, user_id, car_number, parking_lot_id, entry_time, None)
+        self.sessions[record_id] = session
+        self._schedule(session)
+
+    def check_out(self, record_id: int):
+        self.sessions.pop(record_id, None)
+        self.alerts.pop(record_id, None)
+        self.wheel.remove(record_id)
+
+    # 更新停车场的时长限制,对应停车场的在场车辆重新计算到期时间
+    def set_limits(self, limits: dict, lot_ids=None):
+        if lot_ids is None:
+            self.limits = dict(limits)
+        else:
+            for lot_id in lot_ids:
+                self.limits.pop(lot_id, None)
+            self.limits.update(limits)
+        changed = None if lot_ids is None else set(lot_ids)
+        for session in self.sessions.values():
+            if changed is None or session.parking_lot_id in changed:
+                self._schedule(session)
+
+    # 推进时间轮,返回新超时的车辆
+    def tick(self, now: float = None) -> list:
+        fired = []
+        for record_id in self.wheel.advance(time.time() if now is None else now):
+            session = self.sessions.get(record_id)
+            if session is not None:
+                self.alerts[record_id] = session
+                fired.append(session)
+        self.fired_total += len(fired)
+        return fired
+
+    # 当前的超时告警,超时最久的在前
+    def active_alerts(self, parking_lot_id: int = None, now: float = None) -> list:
+        now = time.time() if now is None else now
+        sessions = sorted(
+            (s for s in self.alerts.values() if parking_lot_id is None or s.parking_lot_id == parking_lot_id),
+            key=lambda s: s.deadline
+        )
+        return [
+            {
+                "record_id": s.record_id,
+                "user_id": s.user_id,
+                "car_number": s.car_number,
+                "parking_lot_id": s.parking_lot_id,
+                "entry_time": s.entry_time,
+                "deadline": datetime.fromtimestamp(s.deadline),
+                "limit_hours": self.limit_hours(s.parking_lot_id),
+                "overdue_minutes": int((now - s.deadline) // 60),
+            }
+            for s in sessions
+        ]
+
+    async def load_limits(self, lot_ids=None):
+        async def load(db):
+            query = select(ParkingLot.id, ParkingLot.max_stay_hours).filter(ParkingLot.max_stay_hours.isnot(None))
+            if lot_ids is not None:
+                query = query.filter(ParkingLot.id.in_(lot_ids))
+            result = await db.execute(query)
+            return result.all()
+        self.set_limits(dict(await shard_router.gather(load)), lot_ids)
+
+    # 启动时从数据库加载在场车辆,已经超时的车辆在下一个tick产生告警
+    async def rebuild(self):
+        async def load(db):
+            result = await db.execute(
+                select(Record.id, Record.user_id, Record.car_number, Record.parking_lot_id, Record.entry_time)
+                .filter(Record.status == RecordStatus.PARKED)
+            )
+            return result.all()
+        rows = await shard_router.gather(load)
+        self.sessions = {}
+        self.alerts = {}
+        await self.load_limits()
+        for row in rows:
+            self.check_in(row.id, row.user_id, row.car_number, row.parking_lot_id, row.entry_time)
+        logging.info(f"超时停车监控已加载: {len(self)} 辆在场车辆")
+
+
+overstay_monitor = OverstayMonitor()
+
+_reload_tasks = set()
+
+
+# 停车场信息变化时重新加载时长限制
+def _on_lot_change(lot_ids):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    task = loop.create_task(overstay_monitor.load_limits(lot_ids))
+    _reload_tasks.add(task)
+    task.add_done_callback(_reload_tasks.discard)
+
+
+lot_events.subscribe(_on_lot_change)
+
+
+# 后台每个tick推进一次时间轮
+async def overstay_loop():
+    while True:
+        try:
+            for session in overstay_monitor.tick():
+                logging.warning(
+                    f"超时停车: 记录 {session.record_id}, 车辆 {session.car_number}, "
+                    f"停车场 {session.parking_lot_id}, 入场时间 {session.entry_time}"
+                )
+        except Exception as e:
+            logging.error(f"超时停车检查时发生错误: {str(e)}")
+        await asyncio.sleep(overstay_monitor.wheel.tick)
+
+
+# 性能测试(10万辆在场车辆): python overstay.py
+if __name__ == "__main__":
+    import random
+    from datetime import timedelta
+
+    count = 100_000
+    random.seed(1)
+    start = time.time()
+    base = datetime.fromtimestamp(start)
+    lots = 50
+
+    monitor = OverstayMonitor(tick=60)
+    monitor.limits = {lot_id: random.choice((2, 4, 8, 12, 24)) for lot_id in range(lots)}
+
+    started = time.perf_counter()
+    for i in range(count):
+        monitor.check_in(i, i, f"AB{i:06d}", i % lots, base - timedelta(minutes=random.randint(0, 24 * 60)))
+    elapsed = time.perf_counter() - started
+    print(f"入场 {count} 辆: 每次 {elapsed / count * 1e6:.2f} 微秒")
+
+    # 模拟48小时,每分钟一个tick; 期间每个tick随机出场100辆、入场100辆
+    ticks = 48 * 60
+    fired = 0
+    next_id = count
+    wheel_elapsed = 0.0
+    scan_elapsed = 0.0
+    for t in range(1, ticks + 1):
+        now = start + t * 60
+        for record_id in random.sample(list(monitor.sessions.keys())[:1000], 100):
+            monitor.check_out(record_id)
+        for _ in range(100):
+            monitor.check_in(next_id, next_id, f"CD{next_id:06d}", next_id % lots, datetime.fromtimestamp(now))
+            next_id += 1
+
+        started = time.perf_counter()
+        fired += len(monitor.tick(now))
+        wheel_elapsed += time.perf_counter() - started
+
+        # 对比: 每个tick扫描全部在场车辆
+        if t % 60 == 0:
+            started = time.perf_counter()
+            sum(1 for s in monitor.sessions.values() if s.deadline <= now)
+            scan_elapsed += (time.perf_counter() - started) * 60
+
+    print(f"模拟 {ticks} 个tick: 共 {fired} 次超时告警, 当前在场 {len(monitor)}, 告警中 {len(monitor.alerts)}")
+    print(f"时间轮: 每个tick平均 {wheel_elapsed / ticks * 1000:.3f} 毫秒, "
+          f"每次告警 {wheel_elapsed / max(fired, 1) * 1e6:.2f} 微秒")
+    print(f"全量扫描: 每个tick平均 {scan_elapsed / ticks * 1000:.3f} 毫秒")
@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, or_, update
+from sqlalchemy.future import select
+
+from active_index import normalize_plate
+from fast_json import RECORD_FIELDS, record_rows
+from models import Record, RecordStatus
+from shards import shard_router
+
+
+# 车牌查找
+# 在场车辆和最近的停车记录的标准化车牌放在内存的字典树里,支持按前缀查找和按编辑距离模糊查找
+# 字典树只返回匹配的车牌,记录本身再按records.plate_key(有索引)从数据库查询,状态总是最新的
+PLATE_SEARCH_RECENT_DAYS = int(os.getenv("PLATE_SEARCH_RECENT_DAYS", "30"))  # 查找范围: 在场车辆和最近多少天的记录
+PLATE_INDEX_REFRESH_INTERVAL = int(os.getenv("PLATE_INDEX_REFRESH_INTERVAL", "600"))  # 重建字典树的间隔(秒)
+PLATE_BACKFILL_BATCH_SIZE = 1000  # 补全旧记录plate_key时每批的记录数
+PLATE_SEARCH_MAX_DISTANCE = 2  # 模糊查找允许的最大编辑距离
+
+_END = ""  # 字典树里标记车牌结束的键,不会和单个字符冲突
+
+
+class PlateTrie:
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key: str):
+        node = self.root
+        for ch in key:
+            node = node.setdefault(ch, {})
+        if _END not in node:
+            node[_END] = True
+            self.size += 1
+
+    # 以prefix开头的车牌,按字典序返回前limit个
+    def prefix(self, prefix: str, limit: int = 20) -> list:
+        node = self.root
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return []
+        results = []
+        stack = [(prefix, node)]
+        while stack and len(results) < limit:
+            key, node = stack.pop()
+            if _END in node:
+                results.append(key)
+            for ch in sorted((ch for ch in node if ch != _END), reverse=True):
+                stack.append((key + ch, node[ch]))
+        return results
+
+    # 编辑距离不超过max_distance的车牌,返回 [(距离, 车牌)],距离小的在前
+    # 沿着字典树逐个字符计算编辑距离矩阵的一行,整行都超过max_distance的分支直接跳过
+    def fuzzy(self, query: str, max_distance: int = 1, limit: int = 20) -> list:
+        results = []
+        stack = [("", self.root, list(range(len(query) + 1)))]
+        while stack:
+            key, node, row = stack.pop()
+            if _END in node and row[-1] <= max_distance:
+                results.append((row[-1], key))
+            for ch, child in node.items():
+                if ch == _END:
+                    continue
+                new_row = [row[0] + 1]
+                for i, query_ch in enumerate(query, start=1):
+                    new_row.append(min(new_row[i - 1] + 1, row[i] + 1, row[i - 1] + (query_ch != ch)))
+                if min(new_row) <= max_distance:
+                    stack.append((key + ch, child, new_row))
+        results.sort()
+        return results[:limit]
+
+
+class PlateIndex:
+    def __init__(self):
+        self.trie = PlateTrie()
+
+    def __len__(self):
+        return len(self.trie)
+
+    # 入场时加入; 离开查找范围的车牌等下一次重建时去掉
+    def add(self, car_number: str):
+        key = normalize_plate(car_number)
+        if key:
+            self.trie.add(key)
+
+    def search(self, query: str, fuzzy: bool = False, max_distance: int = 1, limit: int = 20) -> list:
+        key = normalize_plate(query)
+        if not key:
+            return []
+        if fuzzy:
+            return self.trie.fuzzy(key, min(max_distance, PLATE_SEARCH_MAX_DISTANCE), limit)
+        return [(0, plate) for plate in self.trie.prefix(key, limit)]
+
+    async def rebuild(self):
+        cutoff = datetime.now() - timedelta(days=PLATE_SEARCH_RECENT_DAYS)
+
+        async def load(db):
+            result = await db.execute(
+                select(Record.car_number)
+                .filter(or_(Record.status == RecordStatus.PARKED, Record.entry_time >= cutoff))
+                .distinct()
+            )
+            return result.scalars().all()
+        car_numbers = await shard_router.gather(load)
+        trie = PlateTrie()
+        for car_number in car_numbers:
+            key = normalize_plate(car_number)
+            if key:
+                trie.add(key)
+        self.trie = trie
+        logging.info(f"车牌索引已构建: {len(trie)} 个车牌")
+
+
+plate_index = PlateIndex()
+
+
+# 给还没有plate_key的记录(新增这一列之前写入的)补上,每批一个小事务
+async def backfill_plate_keys(batch_size: int = PLATE_BACKFILL_BATCH_SIZE) -> int:
+    total = 0
+    for shard in range(len(shard_router)):
+        total += await _backfill_shard(shard, batch_size)
+    if total:
+        logging.info(f"已补全 {total} 条记录的标准化车牌")
+    return total
+
+
+async def _backfill_shard(shard: int, batch_size: int) -> int:
+    total = 0
+    while True:
+        async with shard_router.session(shard) as db:
+            result = await db.execute(
+                select(Record.id, Record.car_number)
+                .filter(Record.plate_key.is_(None))
+                .order_by(Record.id)
+                .limit(batch_size)
+            )
+            rows = result.all()
+            if not rows:
+                break
+            await db.execute(
+                update(Record.__table__)
+                .where(Record.__table__.c.id == bindparam("record_id"))
+                .values(plate_key=bindparam("new_plate_key")),
+                [{"record_id": row.id, "new_plate_key": normalize_plate(row.car_number)} for row in rows]
+            )
+            await db.commit()
+        total += len(rows)
+        if len(rows) < batch_size:
+            break
+    return total
+
+
+async def _load_records(db, plate_keys: list, cutoff: datetime):
+    result = await db.execute(
+        select(*[getattr(Record, name) for name in RECORD_FIELDS], Record.plate_key)
+        .filter(Record.plate_key.in_(plate_keys))
+        .filter(or_(Record.status == RecordStatus.PARKED, Record.entry_time >= cutoff))
+        .order_by(Record.entry_time.desc(), Record.id.desc())
+    )
+    return result.all()
+
+
+# 查找车辆: 返回匹配的车牌和对应的在场/最近记录(所有分库)
+async def search_records(query: str, fuzzy: bool = False, max_distance: int = 1, limit: int = 20) -> dict:
+    matches = plate_index.search(query, fuzzy, max_distance, limit)
+    records = {}
+    if matches:
+        rows = await shard_router.gather(
+            _load_records,
+            sort_key=lambda row: (row.entry_time, row.id),
+            descending=True,
+            plate_keys=[plate for _, plate in matches],
+            cutoff=datetime.now() - timedelta(days=PLATE_SEARCH_RECENT_DAYS)
+        )
+        for row, record in zip(rows, record_rows(rows)):
+            records.setdefault(row.plate_key, []).append(record)
+    return {
+        "query": normalize_plate(query),
+        "matches": [
+            {"plate_key": plate, "distance": distance, "records": records.get(plate, [])}
+            for distance, plate in matches
+        ],
+    }
+
+
+# 启动后先补全旧记录,之后定期重建字典树,去掉已经超出查找范围的车牌
+async def refresh_loop():
+    try:
+        await backfill_plate_keys()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"补全标准化车牌时发生错误: {str(e)}")
+    while True:
+        try:
+            await plate_index.rebuild()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"重建车牌索引时发生错误: {str(e)}")
+        await asyncio.sleep(PLATE_INDEX_REFRESH_INTERVAL)
+
+
+# 查找延迟测试(10万个车牌): python plates.py
+if __name__ == "__main__":
+    import random
+    import string
+    import time
+
+    random.seed(1)
+    count = 100_000
+    provinces = "京津沪渝冀豫云辽黑湘皖鲁新苏浙赣鄂桂甘晋蒙陕吉闽贵粤青藏川宁琼"
+    letters = string.ascii_uppercase.replace("I", "").replace("O", "")
+    plates = list({
+        random.choice(provinces) + random.choice(letters)
+        + "".join(random.choice(letters + string.digits) for _ in range(5))
+        for _ in range(count)
+    })
+
+    index = PlateIndex()
+    started = time.perf_counter()
+    for plate in plates:
+        index.add(plate)
+    print(f"构建 {len(index)} 个车牌: {(time.perf_counter() - started) * 1000:.0f} 毫秒")
+
+    def bench(name, fn, queries):
+        started = time.perf_counter()
+        for query in queries:
+            fn(query)
+        elapsed = (time.perf_counter() - started) / len(queries)
+        print(f"{name}: 每次 {elapsed * 1000:.3f} 毫秒")
+
+    samples = random.sample(plates, 200)
+    bench("前缀查找(3个字符)", lambda q: index.search(q[:3]), samples)
+    bench("前缀查找(5个字符)", lambda q: index.search(q[:5]), samples)
+    typos = [plate[:4] + ("0" if plate[4] != "0" else "1") + plate[5:] for plate in samples]
+    bench("模糊查找(距离1)", lambda q: index.search(q, fuzzy=True, max_distance=1), typos)
+    bench("模糊查找(距离2)", lambda q: index.search(q, fuzzy=True, max_distance=2), typos[:50])
+
+    keys = [normalize_plate(plate) for plate in plates]
+    def scan_prefix(query):
+        prefix = normalize_plate(query[:3])
+        return [key for key in keys if key.startswith(prefix)][:20]
+
+    bench("对比: 全量扫描前缀", scan_prefix, samples)
+    found = sum(1 for typo, plate in zip(typos, samples)
+                if normalize_plate(plate) in [p for _, p in index.search(typo, fuzzy=True)])
+    print(f"模糊查找命中原车牌: {found}/{len(samples)}")
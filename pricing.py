@@ -0,0 +1,189 @@
+import asyncio
+import bisect
+import logging
+import os
+
+from sqlalchemy.future import select
+
+import lot_events
+from models import ParkingLot
+from schemas import ParkingLot as SchemaParkingLot
+from shards import shard_router
+
+
+# 按占用率动态定价
+# 每小时价格 = 停车场的fee_rate × 倍率,倍率按 占用数/容量 所在的档位取: 空闲时打折,接近满场时加价
+# 每个停车场的占用数和当前倍率保存在内存里,入场/出场时只更新这一个停车场(二分查找档位),
+# 查询价格时直接读取,不查数据库也不重新计算; 停车场被修改时重新加载,定期和数据库同步(占用数对账会修正计数)
+# 入场时的价格写进停车记录(records.hourly_rate),出场按这个价格计费,停车期间的调价不影响已经入场的车辆
+def _parse_tiers(value: str) -> tuple:
+    tiers = sorted(
+        (float(threshold), float(multiplier))
+        for threshold, multiplier in (item.split(":") for item in value.split(",") if item.strip())
+    )
+    return tuple(threshold for threshold, _ in tiers), tuple(multiplier for _, multiplier in tiers)
+
+
+# 档位: "占用率下限:倍率",占用率低于第一档时倍率为1
+PRICING_TIERS = os.getenv("PRICING_TIERS", "0:0.8,0.3:1.0,0.7:1.25,0.9:1.5")
+PRICING_SYNC_INTERVAL = int(os.getenv("PRICING_SYNC_INTERVAL", "300"))  # 和数据库同步的间隔(秒)
+
+
+class LotPrice:
+    __slots__ = ("capacity", "occupancy", "multiplier")
+
+    def __init__(self, capacity: int, occupancy: int, multiplier: float):
+        self.capacity = capacity
+        self.occupancy = occupancy
+        self.multiplier = multiplier
+
+
+class DynamicPricing:
+    # 所有修改方法都是同步的,中间没有await,在事件循环里天然是原子的
+    def __init__(self, tiers: str = PRICING_TIERS):
+        self.thresholds, self.multipliers = _parse_tiers(tiers)
+        self.lots = {}  # 停车场ID -> LotPrice
+        self.version = 0  # 任何一个停车场的倍率变化时加1(停车场列表的ETag用它判断价格是否变化)
+
+    def multiplier_for(self, occupancy: int, capacity: int) -> float:
+        ratio = occupancy / capacity if capacity else 1.0
+        index = bisect.bisect_right(self.thresholds, ratio) - 1
+        return self.multipliers[index] if index >= 0 else 1.0
+
+    def set_lot(self, parking_lot_id: int, capacity: int, occupancy: int):
+        occupancy = max(0, occupancy or 0)
+        self.lots[parking_lot_id] = LotPrice(capacity, occupancy, self.multiplier_for(occupancy, capacity))
+        self.version += 1
+
+    # 占用数变化delta,只重新计算这一个停车场的倍率
+    def adjust(self, parking_lot_id: int, delta: int):
+        lot = self.lots.get(parking_lot_id)
+        if lot is None:
+            return
+        lot.occupancy = max(0, lot.occupancy + delta)
+        multiplier = self.multiplier_for(lot.occupancy, lot.capacity)
+        if multiplier != lot.multiplier:
+            lot.multiplier = multiplier
+            self.version += 1
+
+    # 入场/出场提交之后调用
+    def check_in(self, parking_lot_id: int):
+        self.adjust(parking_lot_id, 1)
+
+    def check_out(self, parking_lot_id: int):
+        self.adjust(parking_lot_id, -1)
+
+    def multiplier(self, parking_lot_id: int) -> float:
+        lot = self.lots.get(parking_lot_id)
+        return lot.multiplier if lot is not None else 1.0
+
+    # 当前每小时价格,保留两位小数
+    def rate(self, parking_lot_id: int, fee_rate: float) -> float:
+        return round((fee_rate or 0.0) * self.multiplier(parking_lot_id), 2)
+
+    def summary(self) -> list:
+        return [
+            {
+                "parking_lot_id": lot_id,
+                "capacity": lot.capacity,
+                "occupancy": lot.occupancy,
+                "occupancy_ratio": round(lot.occupancy / lot.capacity, 3) if lot.capacity else None,
+                "multiplier": lot.multiplier,
+            }
+            for lot_id, lot in sorted(self.lots.items())
+        ]
+
+    # 从数据库加载停车场的容量和占用数; lot_ids为空时加载全部停车场
+    async def sync(self, lot_ids: list = None):
+        async def load(db):
+            query = select(ParkingLot.id, ParkingLot.capacity, ParkingLot.occupancy)
+            if lot_ids is not None:
+                query = query.filter(ParkingLot.id.in_(lot_ids))
+            result = await db.execute(query)
+            return result.all()
+        rows = await shard_router.gather(load)
+        previous = {lot_id: lot.multiplier for lot_id, lot in self.lots.items()}
+        lots = {} if lot_ids is None else self.lots
+        for lot_id, capacity, occupancy in rows:
+            occupancy = max(0, occupancy or 0)
+            lots[lot_id] = LotPrice(capacity, occupancy, self.multiplier_for(occupancy, capacity))
+        self.lots = lots
+        if {lot_id: lot.multiplier for lot_id, lot in lots.items()} != previous:
+            self.version += 1
+
+
+dynamic_pricing = DynamicPricing()
+
+
+# 停车场的响应模型,带上当前倍率和每小时价格(只读内存,不增加查询)
+def priced(lot) -> SchemaParkingLot:
+    view = SchemaParkingLot.model_validate(lot)
+    view.price_multiplier = dynamic_pricing.multiplier(view.id)
+    view.current_rate = dynamic_pricing.rate(view.id, view.fee_rate)
+    return view
+
+
+_sync_tasks = set()
+
+
+async def _sync(lot_ids):
+    try:
+        await dynamic_pricing.sync(lot_ids)
+    except Exception as e:
+        logging.warning(f"重新加载停车场价格失败: {str(e)}")
+
+
+# 停车场被修改或导入时重新加载(容量可能变化)
+def _on_lot_change(lot_ids):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    task = loop.create_task(_sync(lot_ids))
+    _sync_tasks.add(task)
+    task.add_done_callback(_sync_tasks.discard)
+
+
+lot_events.subscribe(_on_lot_change)
+
+
+async def sync_loop():
+    while True:
+        await asyncio.sleep(PRICING_SYNC_INTERVAL)
+        try:
+            await dynamic_pricing.sync()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"同步停车场价格时发生错误: {str(e)}")
+
+
+# 入场/出场更新和价格查询的开销: python pricing.py
+if __name__ == "__main__":
+    import time
+
+    lots = 1000
+    pricing = DynamicPricing()
+    for lot_id in range(lots):
+        pricing.set_lot(lot_id, 500, 0)
+
+    count = 1_000_000
+    started = time.perf_counter()
+    for i in range(count):
+        lot_id = i % lots
+        if (i // lots) % 2 == 0:
+            pricing.check_in(lot_id)
+        else:
+            pricing.check_out(lot_id)
+    elapsed = time.perf_counter() - started
+    print(f"入场/出场更新倍率: 每次 {elapsed / count * 1e9:.0f} 纳秒")
+
+    started = time.perf_counter()
+    for i in range(count):
+        pricing.rate(i % lots, 10.0)
+    elapsed = time.perf_counter() - started
+    print(f"查询价格: 每次 {elapsed / count * 1e9:.0f} 纳秒")
+
+    for occupancy in (0, 100, 200, 350, 400, 450, 480, 500):
+        pricing.set_lot(0, 500, occupancy)
+        print(f"占用 {occupancy}/500: 倍率 {pricing.multiplier(0)}, 价格 {pricing.rate(0, 10.0)}/小时")
@@ -0,0 +1,285 @@
+import asyncio
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from urllib.parse import parse_qs
+
+
+# 按需的请求性能分析
+# 管理员请求带上 X-Profile: 1 请求头或 ?profile=1 参数时分析这一个请求; 也可以按比例抽样分析所有请求
+# 后台线程每隔PROFILER_INTERVAL秒采样一次被分析请求的调用栈:
+#   请求正在执行时取事件循环线程的调用栈,挂起等待时沿着协程的await链取异步调用栈
+# 每个样本按栈里的帧归类为 SQL / 序列化 / 等待 / Python,最近的PROFILER_MAX_PROFILES个结果保存在内存里,
+# 可以下载折叠栈格式(flamegraph.pl、speedscope都能直接打开)
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))  # 采样间隔(秒)
+PROFILER_MAX_PROFILES = int(os.getenv("PROFILER_MAX_PROFILES", "50"))  # 保留的分析结果数
+PROFILER_SAMPLE_RATE = float(os.getenv("PROFILER_SAMPLE_RATE", "0"))  # 抽样分析的请求比例,0表示只分析指定的请求
+PROFILE_HEADER = b"x-profile"
+
+# 样本归类: 栈里有这些模块的帧算SQL,有这些函数/模块的帧算序列化
+SQL_MODULES = ("sqlalchemy", "aiomysql", "pymysql", "aiosqlite")
+SERIALIZATION_FUNCTIONS = {"serialize_response", "jsonable_encoder", "render", "model_dump", "dumps"}
+SERIALIZATION_FILES = ("fast_json.py", "encoders.py")
+CATEGORIES = ("python", "sql", "serialization", "await")
+
+
+def _label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _category(frames: list, running: bool) -> str:
+    serialization = False
+    for frame in frames:
+        filename = frame.f_code.co_filename
+        if any(module in filename for module in SQL_MODULES):
+            return "sql"
+        if frame.f_code.co_name in SERIALIZATION_FUNCTIONS or filename.endswith(SERIALIZATION_FILES):
+            serialization = True
+    if serialization:
+        return "serialization"
+    return "python" if running else "await"
+
+
+# 正在执行的部分: 从事件循环线程当前的栈帧往外,找到协程的第一帧为止
+def _thread_stack(root, thread_frame) -> list:
+    frames = []
+    frame = thread_frame
+    while frame is not None:
+        frames.append(frame)
+        if frame is root:
+            break
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+# 请求的当前调用栈(从外到内)和是否正在执行
+# 挂起时沿着cr_await找到最内层的协程,它等待的Future就是所在任务的_fut_waiter;
+# 等待的是另一个任务或asyncio.gather(分库查询)时,继续进入第一个还没完成的子任务
+def _request_stack(coro, task, thread_frame) -> tuple:
+    frames = []
+    while coro is not None:
+        if getattr(coro, "cr_running", False):
+            return frames + _thread_stack(coro.cr_frame, thread_frame), True
+        while coro is not None:
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+            if frame is None:
+                break
+            frames.append(frame)
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        waiter = getattr(task, "_fut_waiter", None)
+        children = getattr(waiter, "_children", None)
+        if children is not None:
+            waiter = next((child for child in children if not child.done()), None)
+        if waiter is None or not hasattr(waiter, "get_coro"):
+            break
+        task = waiter
+        coro = waiter.get_coro()
+    return frames, False
+
+
+class Profile:
+    def __init__(self, profile_id: int, method: str, path: str, reason: str):
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.reason = reason  # requested / sampled
+        self.status = None
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.samples = 0
+        self.categories = Counter()
+        self.stacks = Counter()  # 折叠栈 -> 样本数
+
+    def add_sample(self, frames: list, running: bool):
+        if not frames:
+            return
+        category = _category(frames, running)
+        stack = ";".join(_label(frame) for frame in frames)
+        if not running:
+            stack += ";[await]"
+        self.samples += 1
+        self.categories[category] += 1
+        self.stacks[stack] += 1
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    # 各类耗时按样本比例分摊请求的总耗时
+    def summary(self) -> dict:
+        duration = self.duration or 0.0
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "reason": self.reason,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": round(duration * 1000, 3),
+            "samples": self.samples,
+            "breakdown_ms": {
+                category: round(duration * self.categories[category] / self.samples * 1000, 3) if self.samples else 0.0
+                for category in CATEGORIES
+            },
+        }
+
+    def detail(self, top: int = 20) -> dict:
+        result = self.summary()
+        result["top_stacks"] = [
+            {"stack": stack.split(";"), "samples": count} for stack, count in self.stacks.most_common(top)
+        ]
+        return result
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+    def __init__(self, interval: float = PROFILER_INTERVAL, max_profiles: int = PROFILER_MAX_PROFILES,
+                 sample_rate: float = PROFILER_SAMPLE_RATE):
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.profiles = deque(maxlen=max_profiles)
+        self.active = {}  # Profile -> (请求的协程, 所在的任务, 事件循环线程ID)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.ids = itertools.count(1)
+
+    # 管理员显式要求,或者按比例抽中
+    def reason(self, scope) -> str:
+        headers = dict(scope.get("headers") or [])
+        requested = headers.get(PROFILE_HEADER, b"").lower() in (b"1", b"true")
+        if not requested and b"profile=" in scope.get("query_string", b""):
+            query = parse_qs(scope["query_string"].decode("latin-1"))
+            requested = query.get("profile", [""])[-1].lower() in ("1", "true")
+        if requested and scope.get("session", {}).get("role") == "admin":
+            return "requested"
+        if self.sample_rate and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def start(self, method: str, path: str, reason: str, coro) -> Profile:
+        profile = Profile(next(self.ids), method, path, reason)
+        with self.lock:
+            self.active[profile] = (coro, asyncio.current_task(), threading.get_ident())
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self.thread.start()
+        return profile
+
+    def stop(self, profile: Profile):
+        profile.finish()
+        with self.lock:
+            self.active.pop(profile, None)
+            self.profiles.append(profile)
+
+    # 没有正在分析的请求时线程退出,下一次start再创建
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                active = list(self.active.items())
+            thread_frames = sys._current_frames()
+            for profile, (coro, task, thread_id) in active:
+                try:
+                    profile.add_sample(*_request_stack(coro, task, thread_frames.get(thread_id)))
+                except Exception:
+                    # 采样时请求可能刚好结束,帧已经失效
+                    continue
+
+    def get(self, profile_id: int) -> Profile:
+        for profile in self.profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+    def summaries(self) -> list:
+        return [profile.summary() for profile in reversed(self.profiles)]
+
+
+profiler = Profiler()
+
+
+class ProfilerMiddleware:
+    # 需要放在最内层(最先添加): BaseHTTPMiddleware会在另一个任务里执行内层应用,
+    # 在它外面就沿着await链找不到接口函数了
+    def __init__(self, app, profiler: Profiler = None):
+        self.app = app
+        self.profiler = profiler or globals()["profiler"]
+
+    async def __call__(self, scope, receive, send):
+        reason = self.profiler.reason(scope) if scope["type"] == "http" else None
+        if reason is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile = None
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message = {
+                    **message,
+                    "headers": [*message.get("headers", []), (b"x-profile-id", str(profile.id).encode())],
+                }
+            await send(message)
+
+        coro = self.app(scope, receive, send_with_profile_id)
+        profile = self.profiler.start(scope["method"], scope["path"], reason, coro)
+        try:
+            await coro
+        finally:
+            self.profiler.stop(profile)
+
+
+# 采样开销和归类测试: python profiler.py
+if __name__ == "__main__":
+    import httpx
+    import orjson
+    from fastapi import FastAPI
+
+    from fast_json import ORJSONResponse
+
+    test_app = FastAPI()
+
+    def compute(n):
+        return sum(i * i for i in range(n))
+
+    @test_app.get("/work")
+    async def work():
+        compute(200_000)  # CPU
+        await asyncio.sleep(0.01)  # 等待
+        rows = [{"id": i, "car_number": f"AB{i:05d}", "amount": i * 0.5} for i in range(20_000)]
+        return ORJSONResponse(rows)  # 序列化
+
+    async def run(app, count, headers):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            started = time.perf_counter()
+            for _ in range(count):
+                response = await client.get("/work", headers=headers)
+                assert response.status_code == 200
+            return (time.perf_counter() - started) / count
+
+    async def bench():
+        count = 50
+        plain = await run(test_app, count, {})
+        bench_profiler = Profiler(sample_rate=1.0)
+        profiled = await run(ProfilerMiddleware(test_app, bench_profiler), count, {})
+        print(f"不分析: 每个请求 {plain * 1000:.2f} 毫秒")
+        print(f"全部分析(采样间隔 {bench_profiler.interval * 1000:.0f} 毫秒): 每个请求 {profiled * 1000:.2f} 毫秒, "
+              f"开销 {(profiled / plain - 1) * 100:.1f}%")
+        last = bench_profiler.profiles[-1].detail(top=3)
+        print(orjson.dumps(last, option=orjson.OPT_INDENT_2).decode())
+
+    asyncio.run(bench())
@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+from sqlalchemy.future import select
+
+from models import Reservation, ReservationStatus
+from shards import shard_router
+
+
+# 预约容量规划
+# 每个停车场维护一棵按时间分片的线段树,节点保存"该时间段内同时被预约的最大车位数"
+# 新增/取消预约是一次区间加减,查询某个时间窗口的预约峰值是一次区间最大值,都是O(log n)
+SLOT_MINUTES = int(os.getenv("RESERVATION_SLOT_MINUTES", "15"))  # 时间片长度,预约窗口按时间片向外取整
+EXPIRE_INTERVAL = int(os.getenv("RESERVATION_EXPIRE_INTERVAL", "300"))  # 过期预约清理间隔(秒)
+TIMELINE_EPOCH = datetime(2020, 1, 1)
+TIMELINE_SLOTS = 1 << 24  # 15分钟一片时约可覆盖480年
+
+
+def to_local(t: datetime) -> datetime:
+    # 数据库里的时间都是本地时间,带时区的输入先转换成本地时间
+    if t.tzinfo is not None:
+        return t.astimezone().replace(tzinfo=None)
+    return t
+
+
+# 把时间窗口转换成时间片区间 [start_slot, end_slot)
+def to_slots(start_time: datetime, end_time: datetime):
+    slot_seconds = SLOT_MINUTES * 60
+    start = (to_local(start_time) - TIMELINE_EPOCH).total_seconds()
+    end = (to_local(end_time) - TIMELINE_EPOCH).total_seconds()
+    start_slot = max(0, int(start // slot_seconds))
+    end_slot = min(TIMELINE_SLOTS, max(start_slot + 1, -int(-end // slot_seconds)))
+    return start_slot, end_slot
+
+
+class CapacityTimeline:
+    # 稀疏线段树,只保存有预约的节点
+    # _add[node]: 整个节点区间都加上的预约数; _max[node]: 子树内的最大值(包含_add[node])
+    def __init__(self):
+        self._add = {}
+        self._max = {}
+
+    def __len__(self):
+        return len(self._max)
+
+    def add(self, start_slot: int, end_slot: int, delta: int):
+        self._update(1, 0, TIMELINE_SLOTS, start_slot, end_slot, delta)
+
+    def peak(self, start_slot: int, end_slot: int) -> int:
+        return self._query(1, 0, TIMELINE_SLOTS, start_slot, end_slot)
+
+    def _update(self, node, lo, hi, start, end, delta):
+        if end <= lo or hi <= start:
+            return
+        if start <= lo and hi <= end:
+            self._add[node] = self._add.get(node, 0) + delta
+        else:
+            mid = (lo + hi) // 2
+            self._update(2 * node, lo, mid, start, end, delta)
+            self._update(2 * node + 1, mid, hi, start, end, delta)
+
+        add = self._add.get(node, 0)
+        value = add + max(self._max.get(2 * node, 0), self._max.get(2 * node + 1, 0))
+        # 清理已经归零的节点,避免树无限增长
+        if not add:
+            self._add.pop(node, None)
+        if value:
+            self._max[node] = value
+        else:
+            self._max.pop(node, None)
+
+    def _query(self, node, lo, hi, start, end):
+        if end <= lo or hi <= start or node not in self._max:
+            return 0
+        if start <= lo and hi <= end:
+            return self._max[node]
+        mid = (lo + hi) // 2
+        return self._add.get(node, 0) + max(
+            self._query(2 * node, lo, mid, start, end),
+            self._query(2 * node + 1, mid, hi, start, end)
+        )
+
+
+class ReservationPlanner:
+    # 所有修改方法都是同步的,检查和占用之间没有await,在事件循环里天然是原子的
+    def __init__(self):
+        self.timelines = {}     # 停车场ID -> CapacityTimeline
+        self.reservations = {}  # 预约ID(或占位对象) -> (停车场ID, 用户ID, 开始时间, 结束时间)
+        self.by_user = {}       # 用户ID -> 预约ID集合
+
+    def __len__(self):
+        return len(self.reservations)
+
+    # 时间窗口内同时被预约的最大车位数
+    def reserved(self, parking_lot_id: int, start_time: datetime, end_time: datetime) -> int:
+        timeline = self.timelines.get(parking_lot_id)
+        if timeline is None:
+            return 0
+        return timeline.peak(*to_slots(start_time, end_time))
+
+    # 当前时刻被预约保留的车位数
+    def held_now(self, parking_lot_id: int, now: datetime = None) -> int:
+        now = now or datetime.now()
+        return self.reserved(parking_lot_id, now, now)
+
+    # 检查容量并占用,成功返回True
+    def try_hold(self, key, parking_lot_id: int, user_id: int, start_time: datetime, end_time: datetime,
+                 capacity: int, occupancy: int = 0) -> bool:
+        # 窗口已经开始时,当前在场的车辆也占用容量
+        in_use = occupancy if to_local(start_time) <= datetime.now() else 0
+        if self.reserved(parking_lot_id, start_time, end_time) + in_use >= capacity:
+            return False
+        self.hold(key, parking_lot_id, user_id, start_time, end_time)
+        return True
+
+    def hold(self, key, parking_lot_id: int, user_id: int, start_time: datetime, end_time: datetime):
+        timeline = self.timelines.setdefault(parking_lot_id, CapacityTimeline())
+        timeline.add(*to_slots(start_time, end_time), 1)
+        self.reservations[key] = (parking_lot_id, user_id, to_local(start_time), to_local(end_time))
+        self.by_user.setdefault(user_id, set()).add(key)
+
+    def release(self, key):
+        entry = self.reservations.pop(key, None)
+        if entry is None:
+            return
+        parking_lot_id, user_id, start_time, end_time = entry
+        self.timelines[parking_lot_id].add(*to_slots(start_time, end_time), -1)
+        keys = self.by_user.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_user[user_id]
+
+    # 占位写入数据库后换成真正的预约ID
+    def rekey(self, old_key, new_key):
+        entry = self.reservations.pop(old_key)
+        self.reservations[new_key] = entry
+        keys = self.by_user[entry[1]]
+        keys.discard(old_key)
+        keys.add(new_key)
+
+    # 用户在该停车场当前生效的预约
+    def find_current(self, user_id: int, parking_lot_id: int, now: datetime = None):
+        now = now or datetime.now()
+        for key in self.by_user.get(user_id, ()):
+            lot_id, _, start_time, end_time = self.reservations[key]
+            if lot_id == parking_lot_id and start_time <= now < end_time and isinstance(key, int):
+                return key
+        return None
+
+    # 移除已经结束的预约
+    def expire(self, now: datetime = None) -> int:
+        now = now or datetime.now()
+        expired = [key for key, entry in self.reservations.items() if entry[3] <= now and isinstance(key, int)]
+        for key in expired:
+            self.release(key)
+        return len(expired)
+
+    # 启动时从数据库加载仍然有效的预约
+    async def rebuild(self):
+        async def load(db):
+            result = await db.execute(
+                select(Reservation.id, Reservation.parking_lot_id, Reservation.user_id,
+                       Reservation.start_time, Reservation.end_time)
+                .filter(
+                    Reservation.status == ReservationStatus.ACTIVE,
+                    Reservation.end_time > datetime.now()
+                )
+            )
+            return result.all()
+        rows = await shard_router.gather(load)
+        self.timelines, self.reservations, self.by_user = {}, {}, {}
+        for row in rows:
+            self.hold(row.id, row.parking_lot_id, row.user_id, row.start_time, row.end_time)
+        logging.info(f"预约容量规划已加载: {len(rows)} 条预约")
+
+
+planner = ReservationPlanner()
+
+
+# 后台定期把过期未入场的预约标记为EXPIRED
+async def expire_loop():
+    while True:
+        await asyncio.sleep(EXPIRE_INTERVAL)
+        try:
+            now = datetime.now()
+
+            async def expire(db):
+                await db.execute(
+                    update(Reservation)
+                    .filter(
+                        Reservation.status == ReservationStatus.ACTIVE,
+                        Reservation.end_time <= now
+                    )
+                    .values(status=ReservationStatus.EXPIRED)
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+            await shard_router.scatter(expire)
+            planner.expire(now)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"清理过期预约时发生错误: {str(e)}")
+
+
+# 性能测试: python reservations.py
+if __name__ == "__main__":
+    import random
+    import time
+
+    random.seed(1)
+    count = 100_000
+    base = datetime.now().replace(minute=0, second=0, microsecond=0)
+    windows = []
+    for _ in range(count):
+        start_time = base + timedelta(minutes=15 * random.randrange(30 * 24 * 4))
+        windows.append((start_time, start_time + timedelta(minutes=15 * random.randint(1, 48))))
+
+    test_planner = ReservationPlanner()
+    started = time.perf_counter()
+    for i, (start_time, end_time) in enumerate(windows):
+        test_planner.hold(i + 1, 1, i % 5000, start_time, end_time)
+    elapsed = time.perf_counter() - started
+    print(f"写入 {count} 条预约: {elapsed:.2f} 秒, 每条 {elapsed / count * 1e6:.1f} 微秒, "
+          f"线段树节点 {len(test_planner.timelines[1])}")
+
+    started = time.perf_counter()
+    for start_time, end_time in windows:
+        test_planner.reserved(1, start_time, end_time)
+    elapsed = time.perf_counter() - started
+    print(f"查询 {count} 次: 每次 {elapsed / count * 1e6:.1f} 微秒")
+
+    # 和逐条扫描重叠预约的结果对比
+    start_time, end_time = base + timedelta(days=3, hours=14), base + timedelta(days=3, hours=18)
+    started = time.perf_counter()
+    s, e = to_slots(start_time, end_time)
+    counts = {}
+    for ws, we in windows:
+        ws, we = to_slots(ws, we)
+        for slot in range(max(s, ws), min(e, we)):
+            counts[slot] = counts.get(slot, 0) + 1
+    scan = max(counts.values(), default=0)
+    scan_elapsed = time.perf_counter() - started
+    print(f"14:00-18:00 预约峰值: 线段树 {test_planner.reserved(1, start_time, end_time)}, "
+          f"逐条扫描 {scan} ({scan_elapsed * 1000:.1f} 毫秒)")
@@ -2,7 +2,7 @@ from pydantic import BaseModel, EmailStr, Field, validator
 from typing import Optional, List
 from datetime import datetime
 import enum
-from models import UserRole, RecordStatus
+from models import UserRole, RecordStatus, SpotClass
 
 
 # 这个文件的核心功能就是定义不同场景需要的数据项和格式要求
@@ -48,6 +48,19 @@ class ParkingLotBase(BaseSchema):
     description: str
     capacity: int
     fee_rate: float
+    max_stay_hours: Optional[float] = None  # 超过这个时长仍在场会产生超时告警
+    ev_spots: int = 0  # 充电车位数
+    accessible_spots: int = 0  # 无障碍车位数
+
+    @validator('accessible_spots')
+    def validate_spots(cls, v, values):
+        ev_spots = values.get('ev_spots') or 0
+        if v < 0 or ev_spots < 0:
+            raise ValueError('spot counts must not be negative')
+        capacity = values.get('capacity')
+        if capacity is not None and ev_spots + v > capacity:
+            raise ValueError('ev_spots + accessible_spots must not exceed capacity')
+        return v
 
 
 # 停车场创建模型
@@ -62,6 +75,8 @@ class ParkingLot(ParkingLotBase):
     availability: bool
     created_at: datetime
     updated_at: datetime
+    price_multiplier: Optional[float] = None  # 按当前占用率的价格倍率(pricing.py)
+    current_rate: Optional[float] = None  # 当前每小时价格 = fee_rate × price_multiplier
 
 
 # 为了crud里面搜索清晰,我们直接做一个类用来搜索,这里是一个输入格式,所以是一个基类
@@ -80,6 +95,7 @@ class RecordBase(BaseSchema):
 # 记录创建模型
 class RecordCreate(RecordBase):
     status: Optional[str] = "PARKED"  # 使用字符串而非枚举
+    spot_class: SpotClass = SpotClass.standard  # 需要的车位类型
 
 
 # 记录响应模型
@@ -90,6 +106,8 @@ class Record(RecordBase):
     entry_time: datetime
     exit_time: Optional[datetime] = None
     amount: Optional[float] = None
+    spot_number: Optional[int] = None  # 分配的车位编号
+    hourly_rate: Optional[float] = None  # 入场时的每小时价格
     
     @validator('status')
     def validate_status(cls, v):
@@ -104,6 +122,45 @@ class RecordUpdate(BaseSchema):
     status: str = "COMPLETED"  # 使用字符串而非枚举
 
 
+# 预约创建模型
+class ReservationCreate(BaseSchema):
+    parking_lot_id: int
+    car_number: str
+    start_time: datetime
+    end_time: datetime
+
+    @validator('end_time')
+    def validate_end_time(cls, v, values):
+        start_time = values.get('start_time')
+        if start_time and v <= start_time:
+            raise ValueError('end_time must be later than start_time')
+        return v
+
+
+# 预约响应模型
+class Reservation(ReservationCreate):
+    id: int
+    user_id: int
+    status: str
+
+    @validator('status')
+    def validate_status(cls, v):
+        if v and isinstance(v, str):
+            return v.upper()
+        return v
+
+
+# 预约可用性查询结果
+class ReservationAvailability(BaseSchema):
+    parking_lot_id: int
+    start_time: datetime
+    end_time: datetime
+    capacity: int
+    reserved: int  # 时间窗口内同时被预约的最大车位数
+    available: bool
+    stale: bool = False  # 数据库熔断时按停车场快照计算
+
+
 # 认证相关
 class Token(BaseSchema):
     access_token: str
@@ -0,0 +1,179 @@
+import asyncio
+import heapq
+import os
+from contextlib import asynccontextmanager
+from itertools import islice
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import circuit
+from database import (
+    DATABASE_URL, SYNC_DATABASE_URL, sync_engine, async_sessionmaker,
+    Base, ensure_columns, ensure_indexes, open_session
+)
+from models import ADDED_COLUMNS
+
+
+# open_session只有一个yield,直接包装成异步上下文管理器,退出时(包括异常)关闭会话
+_session_context = asynccontextmanager(open_session)
+
+
+# 分库路由
+# 不同运营方的停车场分布在多个数据库里,停车场和它的停车记录、预约放在同一个分库,入场/出场的事务只涉及一个分库
+# 用户表只在第一个分库(主库)里; 第二个分库开始,连接上关闭外键检查(records.user_id指向主库的用户)
+# 每个分库的自增ID从 分库编号 * SHARD_ID_RANGE 开始,所以根据停车场/记录/预约的ID就能算出它在哪个分库
+# SHARD_DATABASE_URLS / SHARD_SYNC_DATABASE_URLS: 逗号分隔,第一个是主库; 不配置时只有主库一个分库,和原来完全一样
+SHARD_ID_RANGE = int(os.getenv("SHARD_ID_RANGE", "100000000"))  # 每个分库的ID区间大小
+SHARDED_TABLES = ("parking_lots", "records", "reservations")  # 按分库分配自增ID的表
+
+
+def _env_urls(name: str, default: str) -> list:
+    value = os.getenv(name)
+    if not value:
+        return [default]
+    return [url.strip() for url in value.split(",") if url.strip()]
+
+
+def _disable_foreign_key_checks(engine):
+    if engine.dialect.name != "mysql":
+        return
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET SESSION foreign_key_checks = 0")
+        cursor.close()
+
+
+# 新分库的自增ID从start开始(已经超过start时不变)
+def _set_id_start(engine, start: int):
+    with engine.begin() as conn:
+        for table in SHARDED_TABLES:
+            if engine.dialect.name == "sqlite":
+                # 表需要使用AUTOINCREMENT(models里的sqlite_autoincrement)才会记录在sqlite_sequence里
+                current = conn.execute(
+                    text("SELECT seq FROM sqlite_sequence WHERE name = :name"), {"name": table}
+                ).scalar()
+                if current is None:
+                    conn.execute(
+                        text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"),
+                        {"name": table, "seq": start}
+                    )
+                elif current < start:
+                    conn.execute(
+                        text("UPDATE sqlite_sequence SET seq = :seq WHERE name = :name"),
+                        {"name": table, "seq": start}
+                    )
+            else:
+                conn.execute(text(f"ALTER TABLE {table} AUTO_INCREMENT = {start + 1}"))
+
+
+class ShardRouter:
+    def __init__(self, urls: list, sync_urls: list, id_range: int = SHARD_ID_RANGE):
+        if len(urls) != len(sync_urls):
+            raise ValueError("SHARD_DATABASE_URLS和SHARD_SYNC_DATABASE_URLS的数量不一致")
+        self.id_range = id_range
+        self.session_factories = []
+        self.sync_engines = []
+        if urls[0] != DATABASE_URL or sync_urls[0] != SYNC_DATABASE_URL:
+            raise ValueError("SHARD_DATABASE_URLS/SHARD_SYNC_DATABASE_URLS的第一个必须是主库(DATABASE_URL/SYNC_DATABASE_URL)")
+        for shard, (url, sync_url) in enumerate(zip(urls, sync_urls)):
+            if shard == 0:
+                # 主库沿用database.py里的引擎和连接池
+                self.session_factories.append(async_sessionmaker)
+                self.sync_engines.append(sync_engine)
+                continue
+            engine = create_async_engine(url, pool_pre_ping=True)
+            circuit.install(engine, f"分库{shard}")
+            shard_sync_engine = create_engine(sync_url)
+            if shard > 0:
+                _disable_foreign_key_checks(engine.sync_engine)
+                _disable_foreign_key_checks(shard_sync_engine)
+            self.session_factories.append(sessionmaker(
+                bind=engine,
+                class_=AsyncSession,
+                autoflush=False,
+                autocommit=False,
+                expire_on_commit=False
+            ))
+            self.sync_engines.append(shard_sync_engine)
+
+    def __len__(self):
+        return len(self.session_factories)
+
+    # ID所在的分库; 不属于任何分库的ID交给主库,查询结果为空,由调用方按"不存在"处理
+    def shard_for_id(self, entity_id: int) -> int:
+        shard = entity_id // self.id_range if entity_id and entity_id > 0 else 0
+        return shard if shard < len(self) else 0
+
+    # 和FastAPI依赖一样经过open_session: 熔断检查、取连接超时(DB_CONNECT_TIMEOUT)、记录连接池等待时间
+    # 所在数据库熔断或者取不到连接时抛出circuit.DatabaseUnavailable; 用法: async with shard_router.session(shard) as db
+    def session(self, shard: int = 0):
+        return _session_context(self.session_factories[shard])
+
+    def session_for_id(self, entity_id: int):
+        return self.session(self.shard_for_id(entity_id))
+
+    # 建表、补列/索引、设置自增ID的起点(同步执行,启动时调用)
+    def prepare(self):
+        for shard, engine in enumerate(self.sync_engines):
+            Base.metadata.create_all(bind=engine)
+            ensure_columns(engine, ADDED_COLUMNS)
+            ensure_indexes(engine, Base.metadata)
+            if shard > 0:
+                _set_id_start(engine, shard * self.id_range)
+
+    # 在每个分库上执行 fn(db, **kwargs),返回每个分库的结果
+    async def scatter(self, fn, **kwargs) -> list:
+        async def run(shard):
+            async with self.session(shard) as db:
+                return await fn(db, **kwargs)
+        return list(await asyncio.gather(*(run(shard) for shard in range(len(self)))))
+
+    # 在每个分库上执行查询并合并结果列表
+    # sort_key为空时按分库顺序拼接(按ID排序的结果拼接后仍然有序),否则按sort_key归并(每个分库的结果需要已经排好序)
+    async def gather(self, fn, sort_key=None, descending: bool = False, **kwargs) -> list:
+        results = await self.scatter(fn, **kwargs)
+        if sort_key is None or len(results) == 1:
+            return [item for result in results for item in result]
+        return list(heapq.merge(*results, key=sort_key, reverse=descending))
+
+    # 分页的跨分库查询: 每个分库取前 skip+limit 条,归并之后再分页
+    # fn需要支持skip/limit参数,并且按sort_key排好序
+    async def gather_page(self, fn, sort_key, descending: bool = False,
+                          skip: int = 0, limit: int = None, **kwargs) -> list:
+        if len(self) == 1:
+            return (await self.scatter(fn, skip=skip, limit=limit, **kwargs))[0]
+        results = await self.scatter(fn, skip=0, limit=None if limit is None else skip + limit, **kwargs)
+        merged = heapq.merge(*results, key=sort_key, reverse=descending)
+        return list(islice(merged, skip, None if limit is None else skip + limit))
+
+
+shard_router = ShardRouter(
+    _env_urls("SHARD_DATABASE_URLS", DATABASE_URL),
+    _env_urls("SHARD_SYNC_DATABASE_URLS", SYNC_DATABASE_URL)
+)
+
+
+# FastAPI依赖: 主库(分库0)的会话,用户表在主库
+async def get_db():
+    async for session in open_session(shard_router.session_factories[0]):
+        yield session
+
+
+# FastAPI依赖: 按路径里的ID打开对应分库的会话
+async def get_lot_db(parking_lot_id: int):
+    async for session in open_session(shard_router.session_factories[shard_router.shard_for_id(parking_lot_id)]):
+        yield session
+
+
+async def get_record_db(record_id: int):
+    async for session in open_session(shard_router.session_factories[shard_router.shard_for_id(record_id)]):
+        yield session
+
+
+async def get_reservation_db(reservation_id: int):
+    async for session in open_session(shard_router.session_factories[shard_router.shard_for_id(reservation_id)]):
+        yield session
@@ -0,0 +1,52 @@
+import asyncio
+
+from shards import shard_router
+
+
+# 合并相同的并发只读查询(single-flight)
+# 同一时刻参数完全相同的请求只执行一次数据库查询,其余请求等待并共用这次的结果
+# 结果会被多个请求共用,调用方不能修改返回的对象
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}  # (分组, 键) -> [任务, 等待的请求数]
+        self.stats = {}      # 分组 -> 统计数据
+
+    async def do(self, group: str, key, fn):
+        inflight_key = (group, key)
+        call = self._inflight.get(inflight_key)
+        if call is None:
+            # 查询放在独立的任务里,发起查询的请求被取消时不影响其他等待的请求
+            call = self._inflight[inflight_key] = [asyncio.ensure_future(fn()), 0]
+            call[0].add_done_callback(lambda task: self._done(group, inflight_key, call))
+        call[1] += 1
+        return await asyncio.shield(call[0])
+
+    def _done(self, group, inflight_key, call):
+        if self._inflight.get(inflight_key) is call:
+            del self._inflight[inflight_key]
+        stats = self.stats.setdefault(group, {"executions": 0, "callers": 0, "max_callers": 0})
+        stats["executions"] += 1
+        stats["callers"] += call[1]
+        stats["max_callers"] = max(stats["max_callers"], call[1])
+
+    # 每个分组执行了多少次查询、平均每次查询服务了多少个请求
+    def metrics(self) -> dict:
+        return {
+            group: {
+                **stats,
+                "inflight": sum(1 for key in self._inflight if key[0] == group),
+                "callers_per_execution": round(stats["callers"] / stats["executions"], 2)
+            }
+            for group, stats in self.stats.items()
+        }
+
+
+single_flight = SingleFlight()
+
+
+# 合并执行crud里的查询函数,查询使用独立的会话,不占用每个请求自己的连接
+# 查询在所有分库上执行,结果按sort_key归并(不传时按分库顺序拼接)
+async def coalesced_query(group: str, key, query, sort_key=None, descending: bool = False, **kwargs):
+    async def run():
+        return await shard_router.gather(query, sort_key=sort_key, descending=descending, **kwargs)
+    return await single_flight.do(group, key, run)
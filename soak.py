@@ -0,0 +1,267 @@
+import asyncio
+import gc
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import httpx
+import orjson
+from sqlalchemy.orm import Session
+
+
+# 长时间稳定性测试(连接泄漏和内存泄漏)
+# 在进程内通过ASGI直接驱动应用,多个虚拟用户循环完整的用户流程:
+#   注册/登录 -> 查看停车场 -> 入场 -> 查看记录 -> 重复入场(错误路径) -> 出场 -> 出场不存在的记录(错误路径) -> 增量同步 -> 退出
+# 每隔SOAK_SAMPLE_INTERVAL秒暂停所有虚拟用户,等进行中的请求结束后采样:
+#   连接池借出的连接数、未结束的事务数、RSS、tracemalloc的内存和增长最多的分配位置
+# 结束时对预热之后的样本做线性回归,任何一项持续上升(增长超过阈值)就以退出码1结束
+# 使用database.py里配置的数据库(本地MySQL),会写入测试用户和停车记录,不要对生产库运行:
+#   SOAK_DURATION=14400 python soak.py
+SOAK_DURATION = float(os.getenv("SOAK_DURATION", "14400"))  # 运行秒数,默认4小时
+SOAK_USERS = int(os.getenv("SOAK_USERS", "8"))  # 虚拟用户数
+SOAK_SAMPLE_INTERVAL = float(os.getenv("SOAK_SAMPLE_INTERVAL", "60"))  # 采样间隔(秒)
+SOAK_THINK_TIME = float(os.getenv("SOAK_THINK_TIME", "0.2"))  # 每一步之间的停顿(秒),避免触发按用户限流
+SOAK_WARMUP_SAMPLES = int(os.getenv("SOAK_WARMUP_SAMPLES", "3"))  # 不参与趋势判断的前几个样本(缓存、连接池预热)
+SOAK_REPORT = os.getenv("SOAK_REPORT", "soak_report.jsonl")  # 每个样本一行JSON
+SOAK_TOP_ALLOCATORS = 10
+
+# 每项指标在整个测试期间允许的增长(按回归直线计算的首尾差)
+SOAK_THRESHOLDS = {
+    "pool_checked_out": float(os.getenv("SOAK_MAX_POOL_GROWTH", "1")),
+    "open_transactions": float(os.getenv("SOAK_MAX_TRANSACTION_GROWTH", "1")),
+    "rss_mb": float(os.getenv("SOAK_MAX_RSS_GROWTH_MB", "64")),
+    "traced_mb": float(os.getenv("SOAK_MAX_TRACED_GROWTH_MB", "32")),
+}
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        # 没有/proc时只能取峰值
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def pool_checked_out(engines) -> int:
+    return sum(engine.pool.checkedout() for engine in engines)
+
+
+# 还在事务里的会话(请求已经结束,正常情况下应该是0)
+def open_transactions() -> int:
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, Session) and obj.in_transaction())
+
+
+# 去掉tracemalloc自己和导入机制的分配
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+
+
+# 最小二乘斜率,x是秒
+def slope(points: list) -> float:
+    if len(points) < 2:
+        return 0.0
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    mean_x = statistics.fmean(xs)
+    mean_y = statistics.fmean(ys)
+    denominator = sum((x - mean_x) ** 2 for x in xs)
+    if not denominator:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / denominator
+
+
+# 判断每项指标是否持续上升,返回 {指标: {growth, threshold, trending}}
+def analyze(samples: list, warmup: int = SOAK_WARMUP_SAMPLES, thresholds: dict = SOAK_THRESHOLDS) -> dict:
+    samples = samples[warmup:]
+    result = {}
+    for metric, threshold in thresholds.items():
+        points = [(sample["elapsed"], sample[metric]) for sample in samples]
+        growth = slope(points) * (points[-1][0] - points[0][0]) if len(points) >= 2 else 0.0
+        result[metric] = {
+            "growth": round(growth, 3),
+            "threshold": threshold,
+            "trending": growth > threshold,
+        }
+    return result
+
+
+class SoakRunner:
+    def __init__(self, app, engines, users: int = SOAK_USERS, think_time: float = SOAK_THINK_TIME):
+        self.app = app
+        self.engines = engines
+        self.users = users
+        self.think_time = think_time
+        self.running = asyncio.Event()  # 采样时清除,虚拟用户在下一步之前停下
+        self.running.set()
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.statuses = {}  # (方法, 路径模板, 状态码) -> 次数
+        self.lifecycles = 0
+        self.errors = 0  # 请求本身抛出的异常(不是HTTP错误状态)
+        self.lot_ids = []
+
+    async def request(self, client, method: str, path: str, label: str = None, **kwargs):
+        await self.running.wait()
+        self.in_flight += 1
+        self.idle.clear()
+        try:
+            response = await client.request(method, path, **kwargs)
+            key = f"{method} {label or path} {response.status_code}"
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+            return response
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"请求 {method} {path} 失败: {str(e)}")
+            return None
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.idle.set()
+            await asyncio.sleep(self.think_time)
+
+    async def lifecycle(self, client, user: int, iteration: int):
+        username = f"soak_user_{user}"
+        credentials = {"username": username, "password": "soak-password"}
+        if iteration == 0:
+            await self.request(client, "POST", "/auth/register", json=credentials)
+        await self.request(client, "POST", "/auth/login", json=credentials)
+
+        lots = await self.request(client, "GET", "/parking/lots")
+        if lots is not None and lots.status_code == 200 and lots.json():
+            self.lot_ids = [lot["id"] for lot in lots.json()]
+        lot_id = random.choice(self.lot_ids) if self.lot_ids else 1
+
+        car_number = f"SK{user:03d}{iteration % 100000:05d}"
+        record = {"car_number": car_number, "parking_lot_id": lot_id}
+        created = await self.request(client, "POST", "/customer/records", json=record)
+        await self.request(client, "GET", "/customer/records/uncompleted")
+        await self.request(client, "GET", "/customer/my-records", params={"limit": 20})
+        start = datetime.now() + timedelta(hours=1)
+        await self.request(client, "GET", f"/parking/lots/{lot_id}/availability", label="/parking/lots/{id}/availability",
+                           params={"start_time": start.isoformat(), "end_time": (start + timedelta(hours=2)).isoformat()})
+        await self.request(client, "POST", "/customer/records", label="/customer/records (duplicate)", json=record)
+
+        if created is not None and created.status_code == 200:
+            await self.request(client, "PUT", f"/customer/records/{created.json()['id']}",
+                               label="/customer/records/{id}", json={"status": "COMPLETED"})
+        await self.request(client, "PUT", "/customer/records/0", label="/customer/records/{id} (missing)",
+                           json={"status": "COMPLETED"})
+        await self.request(client, "GET", "/sync/changes")
+        await self.request(client, "POST", "/auth/logout")
+        self.lifecycles += 1
+
+    async def user_loop(self, user: int, deadline: float):
+        # 未处理的异常和生产环境一样变成500响应
+        transport = httpx.ASGITransport(app=self.app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://soak") as client:
+            iteration = 0
+            while time.monotonic() < deadline:
+                try:
+                    await self.lifecycle(client, user, iteration)
+                except Exception as e:
+                    self.errors += 1
+                    logging.error(f"虚拟用户 {user} 执行失败: {str(e)}")
+                iteration += 1
+
+    # 暂停虚拟用户,等进行中的请求结束之后采样
+    async def sample(self, started: float, baseline) -> dict:
+        self.running.clear()
+        try:
+            if self.in_flight:
+                await asyncio.wait_for(self.idle.wait(), 60)
+            gc.collect()
+            snapshot = take_snapshot()
+            traced, _ = tracemalloc.get_traced_memory()
+            top = snapshot.compare_to(baseline, "lineno")[:SOAK_TOP_ALLOCATORS]
+            return {
+                "elapsed": round(time.monotonic() - started, 1),
+                "lifecycles": self.lifecycles,
+                "errors": self.errors,
+                "pool_checked_out": pool_checked_out(self.engines),
+                "open_transactions": open_transactions(),
+                "rss_mb": round(rss_mb(), 2),
+                "traced_mb": round(traced / 1024 / 1024, 2),
+                "top_allocators": [
+                    {"where": str(stat.traceback), "size_diff_kb": round(stat.size_diff / 1024, 1),
+                     "count_diff": stat.count_diff}
+                    for stat in top
+                ],
+            }
+        finally:
+            self.running.set()
+
+    async def run(self, duration: float, interval: float, report_path: str) -> list:
+        tracemalloc.start()
+        started = time.monotonic()
+        deadline = started + duration
+        users = [asyncio.create_task(self.user_loop(user, deadline)) for user in range(self.users)]
+        baseline = take_snapshot()
+        samples = []
+        with open(report_path, "wb") as report:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(min(interval, max(0.0, deadline - time.monotonic())))
+                sample = await self.sample(started, baseline)
+                samples.append(sample)
+                report.write(orjson.dumps(sample) + b"\n")
+                report.flush()
+                print(f"[{sample['elapsed']:>8.0f}s] 流程 {sample['lifecycles']}, 借出连接 {sample['pool_checked_out']}, "
+                      f"未结束事务 {sample['open_transactions']}, RSS {sample['rss_mb']} MB, "
+                      f"tracemalloc {sample['traced_mb']} MB", flush=True)
+        await asyncio.gather(*users, return_exceptions=True)
+        tracemalloc.stop()
+        return samples
+
+
+async def soak(duration: float = SOAK_DURATION, users: int = SOAK_USERS,
+               interval: float = SOAK_SAMPLE_INTERVAL, report_path: str = SOAK_REPORT) -> bool:
+    import main
+    from shards import shard_router
+
+    # 关掉INFO日志和SQL日志,长时间运行时它们本身就会占用大量时间和内存
+    logging.getLogger().setLevel(logging.WARNING)
+    engines = [factory.kw["bind"] for factory in shard_router.session_factories]
+    for engine in engines:
+        engine.sync_engine.echo = False
+
+    # 和uvicorn一样先执行启动事件(建表、初始化数据、后台任务)
+    await main.startup_event()
+    runner = SoakRunner(main.app, engines, users)
+    try:
+        samples = await runner.run(duration, interval, report_path)
+    finally:
+        await main.shutdown_event()
+
+    print("\n请求统计:")
+    for key, count in sorted(runner.statuses.items()):
+        print(f"  {key}: {count}")
+    if len(samples) <= SOAK_WARMUP_SAMPLES + 1:
+        print(f"样本太少({len(samples)}个),无法判断趋势; 增加SOAK_DURATION或减小SOAK_SAMPLE_INTERVAL")
+        return False
+
+    result = analyze(samples)
+    print("\n趋势(预热之后,回归直线的首尾差):")
+    for metric, item in result.items():
+        flag = "上升" if item["trending"] else "正常"
+        print(f"  {metric}: {item['growth']:+.3f} (阈值 {item['threshold']}) {flag}")
+    if any(item["trending"] for item in result.values()):
+        print("\n增长最多的分配位置(最后一个样本):")
+        for stat in samples[-1]["top_allocators"]:
+            print(f"  {stat['where']}: {stat['size_diff_kb']:+.1f} KB ({stat['count_diff']:+d} 个对象)")
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(0 if asyncio.run(soak()) else 1)
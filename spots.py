@@ -0,0 +1,446 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.future import select
+
+from models import ParkingLot, ParkingSpotMap, Record, RecordStatus, SpotClass
+from shards import shard_router
+
+
+# 车位分配
+# 每个停车场的车位编号为 1..capacity: 前ev_spots个是充电车位,接着accessible_spots个无障碍车位,其余是普通车位
+# 每类车位一个位图(每64个车位一个整数,1表示占用),入场时分配这一类里编号最小的空闲车位,出场时清掉对应的位
+# 分配从"之前的字都已占满"的位置开始找,通常是O(1),最坏O(字数); 位图只在内存里修改,
+# 后台每隔SPOT_FLUSH_INTERVAL秒把有变化的停车场批量写入parking_spot_maps表
+# 记录上的spot_number和入场在同一个事务里写入,是车位占用的准确来源; 启动时先加载位图再和在场记录对账,
+# 之后定期对账,修正进程崩溃时还没来得及写入的变化
+SPOT_FLUSH_INTERVAL = float(os.getenv("SPOT_FLUSH_INTERVAL", "1"))  # 写入位图的间隔(秒)
+SPOT_RECONCILE_INTERVAL = int(os.getenv("SPOT_RECONCILE_INTERVAL", "300"))  # 对账间隔(秒)
+
+WORD_BITS = 64
+FULL_WORD = (1 << WORD_BITS) - 1
+SPOT_CLASS_NAMES = {
+    SpotClass.standard: "普通",
+    SpotClass.ev: "充电",
+    SpotClass.accessible: "无障碍",
+}
+
+
+class SpotBitmap:
+    __slots__ = ("first", "count", "words", "used", "hint")
+
+    def __init__(self, first: int, count: int):
+        self.first = first  # 第一个车位的编号
+        self.count = count
+        self.words = [0] * ((count + WORD_BITS - 1) // WORD_BITS)
+        self.used = 0
+        self.hint = 0  # 这个下标之前的字都已经占满
+        self._pad()
+
+    # 最后一个字里超出车位数的位置为1,分配时不会越界
+    def _pad(self):
+        tail = self.count % WORD_BITS
+        if tail:
+            self.words[-1] |= FULL_WORD ^ ((1 << tail) - 1)
+
+    @property
+    def free(self) -> int:
+        return self.count - self.used
+
+    # 分配编号最小的空闲车位,没有空闲车位时返回None
+    def allocate(self) -> int:
+        words = self.words
+        for index in range(self.hint, len(words)):
+            word = words[index]
+            if word != FULL_WORD:
+                lowest_zero = ~word & (word + 1)
+                words[index] = word | lowest_zero
+                self.hint = index
+                self.used += 1
+                return self.first + index * WORD_BITS + lowest_zero.bit_length() - 1
+        self.hint = len(words)
+        return None
+
+    def _locate(self, number: int):
+        offset = number - self.first
+        if not 0 <= offset < self.count:
+            return None, None
+        return offset // WORD_BITS, 1 << (offset % WORD_BITS)
+
+    def occupied(self, number: int) -> bool:
+        index, mask = self._locate(number)
+        return index is not None and bool(self.words[index] & mask)
+
+    # 标记占用(加载和对账时使用),返回是否有变化
+    def occupy(self, number: int) -> bool:
+        index, mask = self._locate(number)
+        if index is None or self.words[index] & mask:
+            return False
+        self.words[index] |= mask
+        self.used += 1
+        return True
+
+    # 释放车位,返回是否有变化
+    def release(self, number: int) -> bool:
+        index, mask = self._locate(number)
+        if index is None or not self.words[index] & mask:
+            return False
+        self.words[index] &= ~mask
+        self.used -= 1
+        self.hint = min(self.hint, index)
+        return True
+
+    def numbers(self):
+        for index, word in enumerate(self.words):
+            while word:
+                lowest = word & -word
+                number = self.first + index * WORD_BITS + lowest.bit_length() - 1
+                if number >= self.first + self.count:
+                    break
+                yield number
+                word ^= lowest
+
+    def to_bytes(self) -> bytes:
+        return b"".join(word.to_bytes(8, "little") for word in self.words)
+
+    @classmethod
+    def from_bytes(cls, first: int, count: int, data: bytes) -> "SpotBitmap":
+        bitmap = cls(first, count)
+        if len(data) != len(bitmap.words) * 8:
+            return bitmap
+        bitmap.words = [int.from_bytes(data[i:i + 8], "little") for i in range(0, len(data), 8)]
+        bitmap._pad()
+        padding = len(bitmap.words) * WORD_BITS - count
+        bitmap.used = sum(bin(word).count("1") for word in bitmap.words) - padding
+        return bitmap
+
+
+class LotSpots:
+    __slots__ = ("layout", "bitmaps")
+
+    def __init__(self, capacity: int, ev_spots: int, accessible_spots: int):
+        ev_spots = min(ev_spots or 0, capacity)
+        accessible_spots = min(accessible_spots or 0, capacity - ev_spots)
+        self.layout = (capacity, ev_spots, accessible_spots)
+        self.bitmaps = {
+            SpotClass.ev: SpotBitmap(1, ev_spots),
+            SpotClass.accessible: SpotBitmap(ev_spots + 1, accessible_spots),
+            SpotClass.standard: SpotBitmap(ev_spots + accessible_spots + 1, capacity - ev_spots - accessible_spots),
+        }
+
+    def bitmap_for(self, number: int) -> SpotBitmap:
+        for bitmap in self.bitmaps.values():
+            if bitmap.first <= number < bitmap.first + bitmap.count:
+                return bitmap
+        return None
+
+    def occupied_numbers(self) -> set:
+        return {number for bitmap in self.bitmaps.values() for number in bitmap.numbers()}
+
+
+class SpotMap:
+    # 所有修改方法都是同步的,中间没有await,在事件循环里天然是原子的
+    def __init__(self):
+        self.lots = {}  # 停车场ID -> LotSpots
+        self.dirty = set()  # 有变化还没写入数据库的停车场
+        self.pending = set()  # (停车场ID, 车位编号): 已分配但入场还没提交
+        self._touched = None  # 对账期间被入场/出场修改过的 (停车场ID, 车位编号)
+        self.allocated = 0
+        self.released = 0
+        self.rejected = 0  # 这一类车位已满
+        self.flushes = 0
+
+    # 取停车场的位图,车位数或分类变化时重新划分,已占用的车位保持占用
+    def ensure(self, parking_lot_id: int, capacity: int, ev_spots: int, accessible_spots: int) -> LotSpots:
+        lot = self.lots.get(parking_lot_id)
+        layout = (capacity, ev_spots or 0, accessible_spots or 0)
+        if lot is not None and lot.layout == layout:
+            return lot
+        new_lot = LotSpots(capacity, ev_spots, accessible_spots)
+        if lot is not None:
+            for number in lot.occupied_numbers():
+                bitmap = new_lot.bitmap_for(number)
+                if bitmap is not None:
+                    bitmap.occupy(number)
+        self.lots[parking_lot_id] = new_lot
+        self.dirty.add(parking_lot_id)
+        return new_lot
+
+    def _touch(self, parking_lot_id: int, number: int):
+        self.dirty.add(parking_lot_id)
+        if self._touched is not None:
+            self._touched.add((parking_lot_id, number))
+
+    # 入场时分配车位,这一类车位已满时返回None; 入场提交后调用confirm,失败时调用release
+    def allocate(self, parking_lot_id: int, capacity: int, ev_spots: int, accessible_spots: int,
+                 spot_class: SpotClass = SpotClass.standard) -> int:
+        lot = self.ensure(parking_lot_id, capacity, ev_spots, accessible_spots)
+        number = lot.bitmaps[SpotClass(spot_class)].allocate()
+        if number is None:
+            self.rejected += 1
+            return None
+        self.allocated += 1
+        self.pending.add((parking_lot_id, number))
+        self._touch(parking_lot_id, number)
+        return number
+
+    # 对账可能在提交之前读了在场记录,提交后仍然以内存为准
+    def confirm(self, parking_lot_id: int, number: int):
+        self.pending.discard((parking_lot_id, number))
+        if self._touched is not None:
+            self._touched.add((parking_lot_id, number))
+
+    # 出场或入场失败时释放车位
+    def release(self, parking_lot_id: int, number: int):
+        self.pending.discard((parking_lot_id, number))
+        lot = self.lots.get(parking_lot_id)
+        bitmap = lot.bitmap_for(number) if lot is not None else None
+        if bitmap is not None and bitmap.release(number):
+            self.released += 1
+            self._touch(parking_lot_id, number)
+
+    def spot_class(self, parking_lot_id: int, number: int) -> SpotClass:
+        lot = self.lots.get(parking_lot_id)
+        if lot is None or number is None:
+            return None
+        for spot_class, bitmap in lot.bitmaps.items():
+            if bitmap.first <= number < bitmap.first + bitmap.count:
+                return spot_class
+        return None
+
+    # 每类车位的编号范围和空闲数
+    def summary(self, parking_lot_id: int) -> dict:
+        lot = self.lots.get(parking_lot_id)
+        if lot is None:
+            return None
+        return {
+            spot_class.value: {
+                "first": bitmap.first,
+                "last": bitmap.first + bitmap.count - 1,
+                "total": bitmap.count,
+                "free": bitmap.free,
+                "occupied": list(bitmap.numbers()),
+            }
+            for spot_class, bitmap in lot.bitmaps.items()
+        }
+
+    def metrics(self) -> dict:
+        return {
+            "lots": len(self.lots),
+            "allocated": self.allocated,
+            "released": self.released,
+            "rejected": self.rejected,
+            "pending": len(self.pending),
+            "dirty": len(self.dirty),
+            "flushes": self.flushes,
+        }
+
+    # 把有变化的停车场的位图写入所在的分库: 每个分库一个事务,已有的行批量UPDATE,没有的批量INSERT
+    # 一个分库写入失败时,它的停车场留到下一次重新写入,其他分库照常写入,最后抛出一次异常
+    async def flush(self) -> int:
+        dirty, self.dirty = self.dirty, set()
+        if not dirty:
+            return 0
+        now = datetime.now()
+        by_shard = {}
+        for parking_lot_id in dirty:
+            lot = self.lots.get(parking_lot_id)
+            if lot is None:
+                continue
+            by_shard.setdefault(shard_router.shard_for_id(parking_lot_id), []).extend(
+                {"lot_id": parking_lot_id, "class": spot_class.value, "first": bitmap.first,
+                 "count": bitmap.count, "data": bitmap.to_bytes(), "now": now}
+                for spot_class, bitmap in lot.bitmaps.items()
+            )
+        table = ParkingSpotMap.__table__
+        written = 0
+        failed = {}  # 分库 -> 异常
+        for shard, rows in by_shard.items():
+            try:
+                async with shard_router.session(shard) as db:
+                    result = await db.execute(
+                        select(table.c.parking_lot_id, table.c.spot_class)
+                        .where(table.c.parking_lot_id.in_({row["lot_id"] for row in rows}))
+                    )
+                    existing = set(result.all())
+                    updates = [row for row in rows if (row["lot_id"], row["class"]) in existing]
+                    creates = [row for row in rows if (row["lot_id"], row["class"]) not in existing]
+                    if updates:
+                        await db.execute(
+                            update(table)
+                            .where(table.c.parking_lot_id == bindparam("lot_id"),
+                                   table.c.spot_class == bindparam("class"))
+                            .values(first_spot=bindparam("first"), spot_count=bindparam("count"),
+                                    bitmap=bindparam("data"), updated_at=bindparam("now")),
+                            updates
+                        )
+                    if creates:
+                        await db.execute(insert(table), [
+                            {"parking_lot_id": row["lot_id"], "spot_class": row["class"], "first_spot": row["first"],
+                             "spot_count": row["count"], "bitmap": row["data"], "updated_at": row["now"]}
+                            for row in creates
+                        ])
+                    await db.commit()
+                written += len(rows)
+            except Exception as e:
+                # 下一次重新写入
+                self.dirty.update(row["lot_id"] for row in rows)
+                failed[shard] = e
+        if failed:
+            error = next(iter(failed.values()))
+            raise RuntimeError(
+                f"分库{'、'.join(map(str, failed))}的车位位图写入失败(已写入{written}行): {str(error)}"
+            ) from error
+        self.flushes += 1
+        return written
+
+    async def _load_layouts(self) -> list:
+        async def load(db):
+            result = await db.execute(
+                select(ParkingLot.id, ParkingLot.capacity, ParkingLot.ev_spots, ParkingLot.accessible_spots)
+            )
+            return result.all()
+        return await shard_router.gather(load)
+
+    async def _load_parked(self) -> list:
+        async def load(db):
+            result = await db.execute(
+                select(Record.parking_lot_id, Record.spot_number)
+                .filter(Record.status == RecordStatus.PARKED, Record.spot_number.isnot(None))
+            )
+            return result.all()
+        return await shard_router.gather(load)
+
+    # 启动时从parking_spot_maps加载位图,再和在场记录对账
+    async def rebuild(self):
+        async def load(db):
+            result = await db.execute(select(ParkingSpotMap))
+            return result.scalars().all()
+        stored = {(row.parking_lot_id, row.spot_class): row for row in await shard_router.gather(load)}
+        lots = {}
+        for lot_id, capacity, ev_spots, accessible_spots in await self._load_layouts():
+            lot = lots[lot_id] = LotSpots(capacity, ev_spots, accessible_spots)
+            for spot_class, bitmap in lot.bitmaps.items():
+                row = stored.get((lot_id, spot_class.value))
+                if row is not None and (row.first_spot, row.spot_count) == (bitmap.first, bitmap.count):
+                    lot.bitmaps[spot_class] = SpotBitmap.from_bytes(bitmap.first, bitmap.count, row.bitmap)
+        self.lots = lots
+        drift = await self.reconcile()
+        logging.info(f"车位位图已加载: {len(lots)} 个停车场, 对账修正 {drift} 个车位")
+
+    # 用在场记录的车位编号修正位图,返回修正的车位数
+    # 对账期间发生变化的车位和还没提交的分配以内存为准
+    async def reconcile(self) -> int:
+        self._touched = set()
+        try:
+            layouts = await self._load_layouts()
+            parked = await self._load_parked()
+            touched = self._touched
+        finally:
+            self._touched = None
+
+        actual = {}
+        for parking_lot_id, number in parked:
+            actual.setdefault(parking_lot_id, set()).add(number)
+        drift = 0
+        for lot_id, capacity, ev_spots, accessible_spots in layouts:
+            lot = self.ensure(lot_id, capacity, ev_spots, accessible_spots)
+            numbers = actual.get(lot_id, set())
+            for spot_class, bitmap in lot.bitmaps.items():
+                fixed = SpotBitmap(bitmap.first, bitmap.count)
+                for number in range(bitmap.first, bitmap.first + bitmap.count):
+                    key = (lot_id, number)
+                    if key in touched or key in self.pending:
+                        keep = bitmap.occupied(number)
+                    else:
+                        keep = number in numbers
+                    if keep:
+                        fixed.occupy(number)
+                changed = sum(bin(old ^ new).count("1") for old, new in zip(bitmap.words, fixed.words))
+                if changed:
+                    drift += changed
+                    lot.bitmaps[spot_class] = fixed
+                    self.dirty.add(lot_id)
+        if drift:
+            logging.warning(f"车位位图与在场记录不一致,已修正 {drift} 个车位")
+        return drift
+
+
+spot_map = SpotMap()
+
+
+# 定期写入有变化的位图
+async def flush_loop():
+    while True:
+        await asyncio.sleep(SPOT_FLUSH_INTERVAL)
+        try:
+            await spot_map.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"写入车位位图时发生错误: {str(e)}")
+
+
+async def reconcile_loop():
+    while True:
+        await asyncio.sleep(SPOT_RECONCILE_INTERVAL)
+        try:
+            await spot_map.reconcile()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"车位位图对账时发生错误: {str(e)}")
+
+
+# 分配/释放吞吐量: python spots.py
+if __name__ == "__main__":
+    import random
+    import time
+
+    capacity = 10_000
+    spots = SpotMap()
+    lot = spots.ensure(1, capacity, 200, 100)
+    print(f"{capacity} 个车位: 位图 {sum(len(b.to_bytes()) for b in lot.bitmaps.values())} 字节")
+
+    # 从空到满
+    started = time.perf_counter()
+    numbers = []
+    for _ in range(capacity - 300):
+        number = spots.allocate(1, capacity, 200, 100)
+        spots.confirm(1, number)
+        numbers.append(number)
+    elapsed = time.perf_counter() - started
+    print(f"顺序分配 {len(numbers)} 个普通车位: 每次 {elapsed / len(numbers) * 1e9:.0f} 纳秒, "
+          f"{len(numbers) / elapsed:,.0f} 次/秒")
+    assert spots.allocate(1, capacity, 200, 100) is None
+
+    # 90%占用时随机出场/入场
+    random.seed(1)
+    for number in random.sample(numbers, len(numbers) // 10):
+        spots.release(1, number)
+    parked = set(lot.bitmaps[SpotClass.standard].numbers())
+    operations = 1_000_000
+    started = time.perf_counter()
+    for _ in range(operations // 2):
+        number = parked.pop()
+        spots.release(1, number)
+        number = spots.allocate(1, capacity, 200, 100)
+        spots.confirm(1, number)
+        parked.add(number)
+    elapsed = time.perf_counter() - started
+    print(f"90% 占用时出场+入场 {operations // 2} 次: 每次操作 {elapsed / operations * 1e9:.0f} 纳秒, "
+          f"{operations / elapsed:,.0f} 次/秒")
+
+    # 对照: 在已占用车位集合里从1开始找第一个空闲编号
+    occupied = set(parked)
+    rounds = 2000
+    started = time.perf_counter()
+    for _ in range(rounds):
+        number = occupied.pop()
+        number = next(n for n in range(301, capacity + 1) if n not in occupied)
+        occupied.add(number)
+    elapsed = time.perf_counter() - started
+    print(f"对照(集合+线性查找): 每次出场+入场 {elapsed / rounds * 1e9:.0f} 纳秒")
@@ -0,0 +1,243 @@
+from sqlalchemy import DateTime, bindparam, insert, text
+from sqlalchemy.future import select
+
+from models import ParkingLot, QueuedTask, Record, TaskStatus, User
+
+
+# 预先构建的SQL语句
+# 入场/出场每个请求都要执行好几条SQL,原来在处理函数里每次重新创建text()/select():
+# text()每次都要用正则解析:参数,select()每次都要重新构建表达式并计算缓存键,才能命中SQLAlchemy的编译缓存
+# 这里在模块加载时创建一次,参数全部用绑定参数,每次执行只传参数字典:
+# 语句对象的缓存键只计算一次(SQLAlchemy会记住),编译结果一直命中引擎的编译缓存(query_cache_size)
+# aiomysql不支持服务端预处理语句(COM_STMT_PREPARE),参数仍在客户端转义,这里只减少Python端的开销
+
+
+# ---------- 入场(main.create_record) ----------
+
+LOT_FOR_CHECK_IN = text("""
+    SELECT id, name, location, description, capacity, fee_rate, occupancy, ev_spots, accessible_spots,
+           occupancy_stripes
+    FROM parking_lots
+    WHERE id = :parking_lot_id
+""")
+
+UPDATE_LOT_OCCUPANCY = text("""
+    UPDATE parking_lots
+    SET occupancy = :occupancy, updated_at = CURRENT_TIMESTAMP
+    WHERE id = :id
+""")
+
+INSERT_RECORD = text("""
+    INSERT INTO records (user_id, car_number, plate_key, parking_lot_id, entry_time, status, amount,
+                         spot_number, hourly_rate, updated_at)
+    VALUES (:user_id, :car_number, :plate_key, :parking_lot_id, :entry_time, :status, :amount,
+            :spot_number, :hourly_rate, CURRENT_TIMESTAMP)
+""")
+
+FULFILL_RESERVATION = text("""
+    UPDATE reservations
+    SET status = 'FULFILLED'
+    WHERE id = :id
+""")
+
+
+# ---------- 出场(main.update_record) ----------
+
+# 声明时间列的类型,结果才会转换成datetime(SQLite返回的是字符串,出场时要用它计算停车时长)
+RECORD_FOR_UPDATE = text("""
+    SELECT id, user_id, car_number, parking_lot_id,
+           status, entry_time, exit_time, amount, spot_number, hourly_rate
+    FROM records
+    WHERE id = :record_id
+""").columns(entry_time=DateTime, exit_time=DateTime)
+
+LOT_FOR_CHECK_OUT = text("""
+    SELECT id, name, location, description, capacity, fee_rate, occupancy, occupancy_stripes
+    FROM parking_lots
+    WHERE id = :parking_lot_id
+""")
+
+COMPLETE_RECORD = text("""
+    UPDATE records
+    SET status = :status,
+        exit_time = :exit_time,
+        amount = :amount,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = :id
+""")
+
+UPDATE_RECORD_STATUS = text("""
+    UPDATE records
+    SET status = :status, updated_at = CURRENT_TIMESTAMP
+    WHERE id = :id
+""")
+
+
+# ---------- 分段占用计数(lot_counters.py) ----------
+
+STRIPE_TOTAL = text("""
+    SELECT COALESCE(SUM(occupancy), 0)
+    FROM parking_lot_counters
+    WHERE parking_lot_id = :parking_lot_id
+""")
+
+# 这一段没有超过它的配额时加1,没有更新到行说明这一段已满
+ACQUIRE_STRIPE = text("""
+    UPDATE parking_lot_counters
+    SET occupancy = occupancy + 1
+    WHERE parking_lot_id = :parking_lot_id AND stripe = :stripe AND occupancy < :quota
+""")
+
+RELEASE_STRIPE = text("""
+    UPDATE parking_lot_counters
+    SET occupancy = occupancy - 1
+    WHERE parking_lot_id = :parking_lot_id AND stripe = :stripe AND occupancy > 0
+""")
+
+
+# ---------- ORM查询(crud.py) ----------
+
+USER_BY_USERNAME = select(User).filter(User.username == bindparam("username"))
+
+LOT_BY_ID = select(ParkingLot).filter(ParkingLot.id == bindparam("parking_lot_id"))
+
+RECORD_BY_ID = select(Record).filter(Record.id == bindparam("record_id"))
+
+# 后台任务入队(tasks.enqueue),出场时每次写两条
+INSERT_TASK = insert(QueuedTask)
+
+
+# 入场/出场处理函数里SQL部分每个请求的CPU时间: python statements.py
+# 用内存SQLite执行和处理函数相同的语句序列,对比每次新建语句(原来的写法)和使用预先构建的语句
+if __name__ == "__main__":
+    import statistics
+    import time
+    from datetime import datetime, timedelta
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    from database import Base
+
+    BENCH_REQUESTS = 2000
+    BENCH_ROUNDS = 5
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(User(id=1, username="bench", password="x", role="customer"))
+        session.add(ParkingLot(id=1, name="bench", location="bench", description="bench",
+                               capacity=10 ** 9, fee_rate=10.0, occupancy=0))
+        session.commit()
+
+    # 原来的写法: 每个请求在处理函数里新建语句
+    def check_in_inline(session, n):
+        lot = session.execute(text("""
+        SELECT id, name, location, description, capacity, fee_rate, occupancy, ev_spots, accessible_spots
+        FROM parking_lots
+        WHERE id = :parking_lot_id
+        """), {"parking_lot_id": 1}).fetchone()
+        session.execute(text("""
+        UPDATE parking_lots
+        SET occupancy = :occupancy, updated_at = CURRENT_TIMESTAMP
+        WHERE id = :id
+        """), {"occupancy": lot.occupancy + 1, "id": lot.id})
+        result = session.execute(text("""
+        INSERT INTO records (user_id, car_number, plate_key, parking_lot_id, entry_time, status, amount,
+                             spot_number, hourly_rate, updated_at)
+        VALUES (:user_id, :car_number, :plate_key, :parking_lot_id, :entry_time, :status, :amount,
+                :spot_number, :hourly_rate, CURRENT_TIMESTAMP)
+        """), _record_params(n))
+        session.commit()
+        return result.lastrowid
+
+    def check_out_inline(session, record_id):
+        record = session.execute(text("""
+        SELECT id, user_id, car_number, parking_lot_id,
+               status, entry_time, exit_time, amount, spot_number, hourly_rate
+        FROM records
+        WHERE id = :record_id
+        """), {"record_id": record_id}).fetchone()
+        lot = session.execute(text("""
+        SELECT id, name, location, description, capacity, fee_rate, occupancy
+        FROM parking_lots
+        WHERE id = :parking_lot_id
+        """), {"parking_lot_id": record.parking_lot_id}).fetchone()
+        session.execute(text("""
+        UPDATE parking_lots
+        SET occupancy = :occupancy, updated_at = CURRENT_TIMESTAMP
+        WHERE id = :id
+        """), {"occupancy": max(0, lot.occupancy - 1), "id": lot.id})
+        session.execute(text("""
+        UPDATE records
+        SET status = :status,
+            exit_time = :exit_time,
+            amount = :amount,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = :id
+        """), _complete_params(record_id))
+        session.execute(insert(QueuedTask).values(**_task_values()))
+        session.execute(insert(QueuedTask).values(**_task_values()))
+        session.commit()
+        # crud.update_record/get_record的ORM查询
+        session.execute(select(Record).filter(Record.id == record_id)).scalar()
+        session.execute(select(ParkingLot).filter(ParkingLot.id == 1)).scalar()
+
+    # 现在的写法: 使用预先构建的语句
+    def check_in_prepared(session, n):
+        lot = session.execute(LOT_FOR_CHECK_IN, {"parking_lot_id": 1}).fetchone()
+        session.execute(UPDATE_LOT_OCCUPANCY, {"occupancy": lot.occupancy + 1, "id": lot.id})
+        result = session.execute(INSERT_RECORD, _record_params(n))
+        session.commit()
+        return result.lastrowid
+
+    def check_out_prepared(session, record_id):
+        record = session.execute(RECORD_FOR_UPDATE, {"record_id": record_id}).fetchone()
+        lot = session.execute(LOT_FOR_CHECK_OUT, {"parking_lot_id": record.parking_lot_id}).fetchone()
+        session.execute(UPDATE_LOT_OCCUPANCY, {"occupancy": max(0, lot.occupancy - 1), "id": lot.id})
+        session.execute(COMPLETE_RECORD, _complete_params(record_id))
+        session.execute(INSERT_TASK, _task_values())
+        session.execute(INSERT_TASK, _task_values())
+        session.commit()
+        session.execute(RECORD_BY_ID, {"record_id": record_id}).scalar()
+        session.execute(LOT_BY_ID, {"parking_lot_id": 1}).scalar()
+
+    base = datetime(2024, 1, 1, 8, 0, 0)
+
+    def _record_params(n):
+        return {
+            "user_id": 1, "car_number": f"AB{n:05d}", "plate_key": f"AB{n:05d}", "parking_lot_id": 1,
+            "entry_time": base + timedelta(minutes=n), "status": "PARKED", "amount": 0.0,
+            "spot_number": None, "hourly_rate": 10.0,
+        }
+
+    def _complete_params(record_id):
+        return {"status": "COMPLETED", "exit_time": base + timedelta(hours=2), "amount": 20.0, "id": record_id}
+
+    def _task_values():
+        return {
+            "kind": "bench", "payload": "{}", "status": TaskStatus.PENDING, "attempts": 0,
+            "run_at": base, "created_at": base,
+        }
+
+    # 处理函数本身的CPU时间(单线程的SQLite,process_time里也包含SQLite执行SQL的时间,两边相同)
+    def run(check_in, check_out):
+        with Session(engine) as session:
+            started = time.process_time()
+            for n in range(BENCH_REQUESTS):
+                record_id = check_in(session, n)
+                check_out(session, record_id)
+            return (time.process_time() - started) / BENCH_REQUESTS
+
+    flows = {"每次新建语句": (check_in_inline, check_out_inline), "预先构建的语句": (check_in_prepared, check_out_prepared)}
+    for flow in flows.values():
+        run(*flow)  # 预热,两种写法都先填好编译缓存
+    results = {name: [] for name in flows}
+    for _ in range(BENCH_ROUNDS):
+        for name, flow in flows.items():
+            results[name].append(run(*flow))
+    medians = {name: statistics.median(values) for name, values in results.items()}
+    for name, elapsed in medians.items():
+        print(f"{name}: 每次入场+出场 CPU {elapsed * 1e6:.0f} 微秒")
+    saved = medians["每次新建语句"] - medians["预先构建的语句"]
+    print(f"每次入场+出场节省 {saved * 1e6:.0f} 微秒 ({saved / medians['每次新建语句'] * 100:.0f}%)")
@@ -6,6 +6,12 @@ let userRole = null;
 // API configuration
 const API_BASE_URL = 'http://localhost:8000'; // FastAPI backend address
 
+// Delta sync state: lists are fully loaded once, later refreshes only merge changes
+let syncCursor = null;
+const lotsById = new Map();
+const myRecordsById = new Map();
+const allRecordsById = new Map();
+
 // Utility functions
 function showMessage(message, isError = false) {
     const toast = document.createElement('div');
@@ -124,38 +130,18 @@ async function login(event) {
 
         console.log('登录成功，用户信息:', currentUser);
 
-        // 等待一小段时间让会话建立
-        await new Promise(resolve => setTimeout(resolve, 1000));
-        
-        // 验证会话是否正确设置
-        try {
-            console.log('验证会话状态...');
-            const sessionCheckResponse = await fetch(`${API_BASE_URL}/auth/status`, {
-                method: 'GET',
-                headers: {
-                    'Accept': 'application/json'
-                },
-                credentials: 'include'
-            });
-
-            if (!sessionCheckResponse.ok) {
-                throw new Error('会话验证失败');
-            }
-
-            const sessionData = await sessionCheckResponse.json();
-            console.log('会话验证成功:', sessionData);
-
-            // 更新UI并加载数据
-            updateUIAfterLogin();
-            showMessage('登录成功！');
-        } catch (sessionError) {
-            console.error('会话验证失败:', sessionError);
-            // 尝试重新登录
+        // 一次请求取回页面数据,同时确认会话已经建立
+        const loaded = await loadBootstrap();
+        if (!loaded || !isLoggedIn) {
+            console.error('会话验证失败');
             isLoggedIn = false;
             currentUser = null;
+            userRole = null;
+            updateUI();
             showMessage('登录失败：会话无效，请重试', true);
             return;
         }
+        showMessage('登录成功！');
     } catch (error) {
         console.error('登录失败:', error);
         showMessage(error.message || '登录失败', true);
@@ -171,6 +157,8 @@ async function logout() {
         isLoggedIn = false;
         currentUser = null;
         userRole = null;
+        myRecordsById.clear();
+        allRecordsById.clear();
         updateUI();
         showMessage('Logged out successfully');
     } catch (error) {
@@ -215,6 +203,7 @@ async function loadParkingLots() {
     parkingLotsList.innerHTML = '<p class="loading">Loading...</p>';
 
     try {
+        await ensureSyncCursor();
         const searchLocation = document.getElementById('searchLocation').value;
         const url = new URL('/parking/lots', API_BASE_URL);
         if (searchLocation) {
@@ -230,34 +219,9 @@ async function loadParkingLots() {
         }
         
         const parkingLots = await response.json();
-        parkingLotsList.innerHTML = '';
-
-        if (parkingLots.length === 0) {
-            parkingLotsList.innerHTML = '<p class="no-data">No parking lots available</p>';
-            return;
-        }
-
-        parkingLots.forEach(lot => {
-            const card = document.createElement('div');
-            card.className = 'parking-lot-card';
-            card.innerHTML = `
-                <h3>${lot.name || 'Unnamed Parking Lot'}</h3>
-                <div class="parking-lot-info">
-                    <p>Location: ${lot.location || 'Unknown'}</p>
-                    <p>Description: ${lot.description || 'No description'}</p>
-                    <p>Capacity: ${lot.capacity || 0}</p>
-                    <p>Rate: $${lot.fee_rate || 0}/hour</p>
-                    <p class="${lot.availability ? 'status-available' : 'status-full'}">
-                        Status: ${lot.availability ? 'Available' : 'Full'}
-                    </p>
-                    ${isLoggedIn && lot.availability ? 
-                        `<button onclick="checkIn(${lot.id})" class="btn-primary">Park Here</button>` : ''}
-                    ${isLoggedIn && userRole === 'admin' ? 
-                        `<button onclick="editParkingLot(${lot.id})" class="btn-secondary">Edit</button>` : ''}
-                </div>
-            `;
-            parkingLotsList.appendChild(card);
-        });
+        lotsById.clear();
+        parkingLots.forEach(lot => lotsById.set(lot.id, lot));
+        renderParkingLots();
     } catch (error) {
         console.error('Failed to load parking lots:', error);
         parkingLotsList.innerHTML = '<p class="error-message">Failed to load parking lots</p>';
@@ -265,136 +229,256 @@ async function loadParkingLots() {
     }
 }
 
-// Search parking lots
-function searchParkingLots() {
-    loadParkingLots();
+// Render parking lots from local state
+function renderParkingLots() {
+    const parkingLotsList = document.getElementById('parkingLotsList');
+    parkingLotsList.innerHTML = '';
+
+    if (lotsById.size === 0) {
+        parkingLotsList.innerHTML = '<p class="no-data">No parking lots available</p>';
+        return;
+    }
+
+    lotsById.forEach(lot => {
+        const card = document.createElement('div');
+        card.className = 'parking-lot-card';
+        card.innerHTML = `
+            <h3>${lot.name || 'Unnamed Parking Lot'}</h3>
+            <div class="parking-lot-info">
+                <p>Location: ${lot.location || 'Unknown'}</p>
+                <p>Description: ${lot.description || 'No description'}</p>
+                <p>Capacity: ${lot.capacity || 0}</p>
+                <p>Rate: $${lot.current_rate ?? lot.fee_rate ?? 0}/hour${lot.price_multiplier && lot.price_multiplier !== 1 ? ` (×${lot.price_multiplier} of $${lot.fee_rate})` : ''}</p>
+                <p class="${lot.availability ? 'status-available' : 'status-full'}">
+                    Status: ${lot.availability ? 'Available' : 'Full'}
+                </p>
+                ${isLoggedIn && lot.availability ? 
+                    `<button onclick="checkIn(${lot.id})" class="btn-primary">Park Here</button>` : ''}
+                ${isLoggedIn && lot.availability && lot.ev_spots > 0 ? 
+                    `<button onclick="checkIn(${lot.id}, 'ev')" class="btn-secondary">EV Charging Bay</button>` : ''}
+                ${isLoggedIn && lot.availability && lot.accessible_spots > 0 ? 
+                    `<button onclick="checkIn(${lot.id}, 'accessible')" class="btn-secondary">Accessible Bay</button>` : ''}
+                ${isLoggedIn && userRole === 'admin' ? 
+                    `<button onclick="editParkingLot(${lot.id})" class="btn-secondary">Edit</button>` : ''}
+            </div>
+        `;
+        parkingLotsList.appendChild(card);
+    });
 }
 
-// Load my records
-async function loadMyRecords() {
-    if (!isLoggedIn || !currentUser) {
-        console.log('Not logged in');
-        const recordsList = document.getElementById('recordsList');
-        recordsList.innerHTML = '<p class="no-data">Login first</p>';
+// Get a sync cursor before a full load, so changes made during the load are not missed
+async function ensureSyncCursor() {
+    if (syncCursor) {
         return;
     }
+    const response = await fetch(`${API_BASE_URL}/sync/changes`, {
+        credentials: 'include',
+        headers: {
+            'Accept': 'application/json'
+        }
+    });
+    if (response.ok) {
+        syncCursor = (await response.json()).cursor;
+    }
+}
 
-    const recordsList = document.getElementById('recordsList');
-    recordsList.innerHTML = '<p class="loading">Loading records...</p>';
+// Reload every visible list in full
+async function reloadAll() {
+    await loadBootstrap();
+}
 
+// Load the user, sync cursor, parking lots and first page of records in one request
+// Returns false when the request failed
+async function loadBootstrap() {
     try {
-        console.log('loading records...');
-        console.log('current user status:', { isLoggedIn, currentUser });
+        const url = new URL('/bootstrap', API_BASE_URL);
+        const searchLocation = document.getElementById('searchLocation').value;
+        if (searchLocation) {
+            url.searchParams.append('location', searchLocation);
+        }
 
-        // 先检查登录状态
-        const statusResponse = await fetch(`${API_BASE_URL}/auth/status`, {
+        const response = await fetch(url.toString(), {
             credentials: 'include',
             headers: {
                 'Accept': 'application/json'
             }
         });
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
 
-        if (!statusResponse.ok) {
-            console.log('会话已过期，执行登出');
-            isLoggedIn = false;
+        const data = await response.json();
+        syncCursor = data.cursor;
+        lotsById.clear();
+        data.lots.forEach(lot => lotsById.set(lot.id, lot));
+        myRecordsById.clear();
+        data.records.forEach(record => myRecordsById.set(record.id, record));
+        allRecordsById.clear();
+        data.all_records.forEach(record => allRecordsById.set(record.id, record));
+
+        if (data.user) {
+            currentUser = data.user;
+            isLoggedIn = true;
+            userRole = data.user.role;
+            updateUIAfterLogin();
+            renderMyRecords();
+            if (userRole === 'admin') {
+                renderAllRecords();
+            }
+        } else {
             currentUser = null;
+            isLoggedIn = false;
+            userRole = null;
             updateUI();
-            recordsList.innerHTML = '<p class="error-message">Session expired, please login again</p>';
-            showMessage('Session expired, please login again', true);
-            return;
         }
+        renderParkingLots();
+        return true;
+    } catch (error) {
+        console.error('Failed to load page data:', error);
+        document.getElementById('parkingLotsList').innerHTML =
+            '<p class="error-message">Failed to load parking lots</p>';
+        showMessage(error.message, true);
+        return false;
+    }
+}
 
-        // 获取停车记录
-        const response = await fetch(`${API_BASE_URL}/customer/my-records`, {
-            method: 'GET',
-            headers: {
-                'Accept': 'application/json'
-            },
-            credentials: 'include'
-        });
+// Fetch changes since the cursor and merge them into the local lists
+async function syncChanges() {
+    if (!syncCursor) {
+        await reloadAll();
+        return;
+    }
 
-        console.log('records response status:', response.status);
-        
-        const responseText = await response.text();
-        console.log('records original response:', responseText);
-        
-        let data;
-        try {
-            data = JSON.parse(responseText);
-        } catch (e) {
-            console.error('reading records failed:', e);
-            throw new Error('server response format error');
+    try {
+        const isAdmin = isLoggedIn && currentUser && currentUser.role === 'admin';
+        const url = new URL('/sync/changes', API_BASE_URL);
+        url.searchParams.append('since', syncCursor);
+        if (isAdmin) {
+            url.searchParams.append('scope', 'all');
         }
 
+        const response = await fetch(url.toString(), {
+            credentials: 'include',
+            headers: {
+                'Accept': 'application/json'
+            }
+        });
         if (!response.ok) {
-            throw new Error(data.detail || 'loading records failed');
+            throw new Error(`HTTP error! status: ${response.status}`);
         }
 
-        if (!Array.isArray(data)) {
-            console.error('response data is not an array:', data);
-            throw new Error('server returned data format error');
+        const changes = await response.json();
+        if (changes.reset) {
+            syncCursor = null;
+            await reloadAll();
+            return;
         }
+        syncCursor = changes.cursor;
 
-        recordsList.innerHTML = '';
+        // 有搜索条件时,新出现的停车场只在位置匹配时加入
+        const searchLocation = document.getElementById('searchLocation').value.trim().toLowerCase();
+        changes.lots.forEach(lot => {
+            if (lotsById.has(lot.id) || !searchLocation || (lot.location || '').toLowerCase().includes(searchLocation)) {
+                lotsById.set(lot.id, lot);
+            }
+        });
+        changes.records.forEach(record => {
+            if (currentUser && record.user_id === currentUser.id) {
+                myRecordsById.set(record.id, record);
+            }
+            if (isAdmin) {
+                allRecordsById.set(record.id, record);
+            }
+        });
 
-        if (data.length === 0) {
-            recordsList.innerHTML = '<p class="no-data">No records</p>';
-            return;
+        renderParkingLots();
+        if (isLoggedIn && currentUser) {
+            renderMyRecords();
+            if (isAdmin) {
+                renderAllRecords();
+            }
         }
+    } catch (error) {
+        console.error('sync failed, reloading:', error);
+        syncCursor = null;
+        await reloadAll();
+    }
+}
 
-        // 状态映射表
-        const statusMap = {
-            'PARKED': 'parked',
-            'PAID': 'paid',
-            'COMPLETED': 'completed',
-            'parked': 'parked',
-            'paid': 'paid',
-            'completed': 'completed'
-        };
+// Search parking lots
+function searchParkingLots() {
+    loadParkingLots();
+}
 
-        data.forEach(record => {
-            const card = document.createElement('div');
-            card.className = 'record-card';
-            
-            // 确保所有必需的字段都存在
-            const safeRecord = {
-                id: record.id || '未知',
-                car_number: record.car_number || '未知',
-                parking_lot_id: record.parking_lot_id || '未知',
-                entry_time: record.entry_time ? new Date(record.entry_time).toLocaleString() : '未知',
-                status: record.status || 'UNKNOWN',
-                exit_time: record.exit_time ? new Date(record.exit_time).toLocaleString() : null,
-                amount: record.amount || 0
-            };
-
-            // 获取状态显示文本
-            const statusText = statusMap[safeRecord.status] || '未知状态';
-            // 判断是否为停车中状态
-            const isParked = safeRecord.status.toLowerCase() === 'parked';
-
-            card.innerHTML = `
-                <h3>record #${safeRecord.id}</h3>
-                <div class="record-info">
-                    <p>car number: ${safeRecord.car_number}</p>
-                    <p>parking lot id: ${safeRecord.parking_lot_id}</p>
-                    <p>entry time: ${safeRecord.entry_time}</p>
-                    <p>status: ${statusText}</p>
-                    ${safeRecord.exit_time ? `<p>exit time: ${safeRecord.exit_time}</p>` : ''}
-                    ${safeRecord.amount > 0 ? `<p>amount: ¥${safeRecord.amount.toFixed(2)}</p>` : ''}
-                    ${isParked ? `<button onclick="checkOut(${safeRecord.id})" class="btn-primary">end parking</button>` : ''}
-                </div>
-            `;
-            recordsList.appendChild(card);
-        });
-    } catch (error) {
-        console.error('loading records failed:', error);
-        recordsList.innerHTML = '<p class="error-message">loading records failed</p>';
-        showMessage(error.message || 'loading records failed', true);
+// Records newest first, same order as the server
+function sortedRecords(recordsById) {
+    return [...recordsById.values()].sort((a, b) =>
+        new Date(b.entry_time) - new Date(a.entry_time) || b.id - a.id
+    );
+}
+
+// Render my records from local state
+function renderMyRecords() {
+    const recordsList = document.getElementById('recordsList');
+    recordsList.innerHTML = '';
+
+    if (myRecordsById.size === 0) {
+        recordsList.innerHTML = '<p class="no-data">No records</p>';
+        return;
     }
+
+    // 状态映射表
+    const statusMap = {
+        'PARKED': 'parked',
+        'PAID': 'paid',
+        'COMPLETED': 'completed',
+        'parked': 'parked',
+        'paid': 'paid',
+        'completed': 'completed'
+    };
+
+    sortedRecords(myRecordsById).forEach(record => {
+        const card = document.createElement('div');
+        card.className = 'record-card';
+        
+        // 确保所有必需的字段都存在
+        const safeRecord = {
+            id: record.id || '未知',
+            car_number: record.car_number || '未知',
+            parking_lot_id: record.parking_lot_id || '未知',
+            entry_time: record.entry_time ? new Date(record.entry_time).toLocaleString() : '未知',
+            status: record.status || 'UNKNOWN',
+            exit_time: record.exit_time ? new Date(record.exit_time).toLocaleString() : null,
+            amount: record.amount || 0,
+            spot_number: record.spot_number,
+            hourly_rate: record.hourly_rate
+        };
+
+        // 获取状态显示文本
+        const statusText = statusMap[safeRecord.status] || '未知状态';
+        // 判断是否为停车中状态
+        const isParked = safeRecord.status.toLowerCase() === 'parked';
+
+        card.innerHTML = `
+            <h3>record #${safeRecord.id}</h3>
+            <div class="record-info">
+                <p>car number: ${safeRecord.car_number}</p>
+                <p>parking lot id: ${safeRecord.parking_lot_id}</p>
+                ${safeRecord.spot_number ? `<p>bay: #${safeRecord.spot_number}</p>` : ''}
+                ${safeRecord.hourly_rate != null ? `<p>rate: ¥${safeRecord.hourly_rate}/hour</p>` : ''}
+                <p>entry time: ${safeRecord.entry_time}</p>
+                <p>status: ${statusText}</p>
+                ${safeRecord.exit_time ? `<p>exit time: ${safeRecord.exit_time}</p>` : ''}
+                ${safeRecord.amount > 0 ? `<p>amount: ¥${safeRecord.amount.toFixed(2)}</p>` : ''}
+                ${isParked ? `<button onclick="checkOut(${safeRecord.id})" class="btn-primary">end parking</button>` : ''}
+            </div>
+        `;
+        recordsList.appendChild(card);
+    });
 }
 
 // Check in (park)
-async function checkIn(parkingLotId) {
+async function checkIn(parkingLotId, spotClass = 'standard') {
     if (!isLoggedIn) {
         showMessage('请先登录', true);
         return;
@@ -418,11 +502,13 @@ async function checkIn(parkingLotId) {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
-                'Accept': 'application/json'
+                'Accept': 'application/json',
+                'Idempotency-Key': crypto.randomUUID()
             },
             body: JSON.stringify({
                 car_number: carNumber,
-                parking_lot_id: parkingLotId
+                parking_lot_id: parkingLotId,
+                spot_class: spotClass
                 // 不发送status字段，让后端使用默认值
             }),
             credentials: 'include'
@@ -455,9 +541,8 @@ async function checkIn(parkingLotId) {
             throw new Error(data.detail || 'parking failed');
         }
 
-        showMessage('parking successful!');
-        await loadParkingLots();
-        await loadMyRecords();
+        showMessage(data.spot_number ? `parking successful! your bay: #${data.spot_number}` : 'parking successful!');
+        await syncChanges();
     } catch (error) {
         console.error('parking failed:', error);
         showMessage(error.message || 'parking failed', true);
@@ -482,7 +567,8 @@ async function checkOut(recordId) {
             method: 'PUT',
             headers: {
                 'Content-Type': 'application/json',
-                'Accept': 'application/json'
+                'Accept': 'application/json',
+                'Idempotency-Key': crypto.randomUUID()
             },
             body: JSON.stringify({
                 status: 'COMPLETED'  // 使用大写的状态值
@@ -520,8 +606,7 @@ async function checkOut(recordId) {
         }
 
         showMessage('parking ended successfully!');
-        await loadParkingLots();
-        await loadMyRecords();
+        await syncChanges();
     } catch (error) {
         console.error('ending parking failed:', error);
         showMessage(error.message || 'ending parking failed', true);
@@ -576,64 +661,40 @@ async function editParkingLot(lotId) {
         }
 
         showMessage('parking lot information updated successfully!');
-        loadParkingLots();
+        syncChanges();
     } catch (error) {
         showMessage(error.message || 'operation failed', true);
     }
 }
 
-// Load all records (admin only)
-async function loadAllRecords() {
-    if (!isLoggedIn || currentUser.role !== 'admin') {
-        console.log('non-admin user, do not load all records');
-        return;
-    }
-
+// Render all records (admin) from local state
+function renderAllRecords() {
     const allRecordsList = document.getElementById('allRecordsList');
-    allRecordsList.innerHTML = '<p class="loading">loading all records...</p>';
-
-    try {
-        const response = await fetch(`${API_BASE_URL}/admin/records`, {
-            credentials: 'include',
-            headers: {
-                'Accept': 'application/json'
-            }
-        });
-
-        if (!response.ok) {
-            throw new Error('failed to load records');
-        }
-
-        const records = await response.json();
-        allRecordsList.innerHTML = '';
+    allRecordsList.innerHTML = '';
 
-        if (!Array.isArray(records) || records.length === 0) {
-            allRecordsList.innerHTML = '<p class="no-data">no parking records</p>';
-            return;
-        }
-
-        records.forEach(record => {
-            const card = document.createElement('div');
-            card.className = 'record-card';
-            card.innerHTML = `
-                <h3>parking record #${record.id}</h3>
-                <div class="record-info">
-                    <p>user id: ${record.user_id}</p>
-                    <p>car number: ${record.car_number}</p>
-                    <p>parking lot id: ${record.parking_lot_id}</p>
-                    <p>entry time: ${new Date(record.entry_time).toLocaleString()}</p>
-                    <p>status: ${record.status === 'PARKED' ? 'parked' : 'completed'}</p>
-                    ${record.exit_time ? `<p>exit time: ${new Date(record.exit_time).toLocaleString()}</p>` : ''}
-                    ${record.amount ? `<p>amount: ¥${record.amount}</p>` : ''}
-                </div>
-            `;
-            allRecordsList.appendChild(card);
-        });
-    } catch (error) {
-        console.error('failed to load all records:', error);
-        allRecordsList.innerHTML = '<p class="error-message">failed to load records</p>';
-        showMessage(error.message || 'failed to load records', true);
+    if (allRecordsById.size === 0) {
+        allRecordsList.innerHTML = '<p class="no-data">no parking records</p>';
+        return;
     }
+
+    sortedRecords(allRecordsById).forEach(record => {
+        const card = document.createElement('div');
+        card.className = 'record-card';
+        card.innerHTML = `
+            <h3>parking record #${record.id}</h3>
+            <div class="record-info">
+                <p>user id: ${record.user_id}</p>
+                <p>car number: ${record.car_number}</p>
+                <p>parking lot id: ${record.parking_lot_id}</p>
+                ${record.spot_number ? `<p>bay: #${record.spot_number}</p>` : ''}
+                <p>entry time: ${new Date(record.entry_time).toLocaleString()}</p>
+                <p>status: ${record.status === 'PARKED' ? 'parked' : 'completed'}</p>
+                ${record.exit_time ? `<p>exit time: ${new Date(record.exit_time).toLocaleString()}</p>` : ''}
+                ${record.amount ? `<p>amount: ¥${record.amount}</p>` : ''}
+            </div>
+        `;
+        allRecordsList.appendChild(card);
+    });
 }
 
 // Update UI after login
@@ -655,51 +716,12 @@ function updateUIAfterLogin() {
 
     if (currentUser.role === 'admin') {
         adminSection.style.display = 'block';
-        loadAllRecords();
     } else {
         adminSection.style.display = 'none';
     }
-
-    // 加载数据
-    loadParkingLots();
-    loadMyRecords();
 }
 
-// Initialize the application
+// Initialize the application: the bootstrap response tells whether the user is already logged in
 document.addEventListener('DOMContentLoaded', () => {
-    loadParkingLots();
-    // Check if user is already logged in
-    fetch(`${API_BASE_URL}/auth/status`, {
-        credentials: 'include',
-        headers: {
-            'Accept': 'application/json'
-        }
-    })
-        .then(response => {
-            if (!response.ok) {
-                throw new Error('not logged in');
-            }
-            return response.json();
-        })
-        .then(data => {
-            // 更新全局状态
-            currentUser = {
-                id: data.id,
-                username: data.username,
-                role: data.role
-            };
-            isLoggedIn = true;
-            userRole = data.role;
-
-            console.log('logged in, user info:', currentUser);
-            updateUIAfterLogin();
-        })
-        .catch(error => {
-            console.log('not logged in or session expired:', error);
-            // 确保用户状态为未登录
-            currentUser = null;
-            isLoggedIn = false;
-            userRole = null;
-            updateUI();
-        });
-}); 
\ No newline at end of file
+    loadBootstrap();
+});
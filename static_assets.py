@@ -0,0 +1,194 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from fastapi import Request
+from fastapi.responses import HTMLResponse, Response
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import FileResponse
+
+try:
+    import brotli  # 可选依赖,没有安装时只生成gzip文件
+except ImportError:
+    brotli = None
+
+
+# 前端静态资源
+# python static_assets.py 会把js/css复制成带内容哈希的文件名(static/dist/),并预先压缩成.gz/.br
+# 带哈希的文件内容不会变,浏览器可以永久缓存; index.html里的引用在返回时替换成带哈希的文件名
+STATIC_DIR = "static"
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST_PATH = os.path.join(DIST_DIR, "manifest.json")
+ASSETS = ("js/main.js", "css/style.css")
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))  # q值相同时优先br
+
+
+# 生成带哈希的文件和压缩文件,返回 原路径 -> 带哈希的路径
+def build_assets() -> dict:
+    os.makedirs(DIST_DIR, exist_ok=True)
+    manifest = {}
+    for asset in ASSETS:
+        with open(os.path.join(STATIC_DIR, asset), "rb") as f:
+            content = f.read()
+        name, ext = os.path.splitext(os.path.basename(asset))
+        hashed_name = f"{name}.{hashlib.sha256(content).hexdigest()[:10]}{ext}"
+        target = os.path.join(DIST_DIR, hashed_name)
+
+        with open(target, "wb") as f:
+            f.write(content)
+        with open(target + ".gz", "wb") as f:
+            f.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(target + ".br", "wb") as f:
+                f.write(brotli.compress(content))
+        manifest[asset] = f"dist/{hashed_name}"
+
+    with open(MANIFEST_PATH, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_manifest() -> dict:
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# 解析Accept-Encoding,返回 编码(小写) -> q值; 没有写q的为1,q值无效时按0(不接受)
+def _accepted_encodings(header: str) -> dict:
+    accepted = {}
+    for item in header.split(","):
+        encoding, *params = item.split(";")
+        encoding = encoding.strip().lower()
+        if not encoding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[encoding] = q
+    return accepted
+
+
+# 客户端接受的预压缩格式,按q值从高到低; 没有列出的编码使用"*"的q值,q=0表示不接受
+def preferred_encodings(accept_encoding: str) -> list:
+    accepted = _accepted_encodings(accept_encoding)
+    default = accepted.get("*", 0.0)
+    candidates = [(accepted.get(encoding, default), encoding, suffix) for encoding, suffix in PRECOMPRESSED]
+    candidates.sort(key=lambda candidate: -candidate[0])
+    return [(encoding, suffix) for q, encoding, suffix in candidates if q > 0]
+
+
+def _vary_values(vary: str) -> list:
+    return [value.strip() for value in vary.split(",") if value.strip()]
+
+
+# 在响应头的Vary里加上value,已经有了(或者是*)时不重复添加
+def add_vary(headers: MutableHeaders, value: str):
+    values = _vary_values(headers.get("vary", ""))
+    if not {"*", value.lower()} & {existing.lower() for existing in values}:
+        headers["Vary"] = ", ".join(values + [value])
+
+
+# 去掉Vary里重复的值
+# GZipMiddleware处理响应时直接在Vary后面追加Accept-Encoding,不检查是否已经有了,静态文件会出现两次; 放在它外面
+class VaryDedupMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_deduplicated(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                if "vary" in headers:
+                    unique = {}
+                    for value in _vary_values(headers["vary"]):
+                        unique.setdefault(value.lower(), value)
+                    headers["Vary"] = ", ".join(unique.values())
+            await send(message)
+
+        await self.app(scope, receive, send_deduplicated)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    # 客户端支持时返回预先压缩好的.br/.gz文件,带哈希的文件加上永久缓存
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        accept_encoding = request_headers.get("accept-encoding", "")
+        full_path = str(full_path)
+
+        response = None
+        for encoding, suffix in preferred_encodings(accept_encoding):
+            if os.path.isfile(full_path + suffix):
+                response = FileResponse(
+                    full_path + suffix,
+                    status_code=status_code,
+                    stat_result=os.stat(full_path + suffix),
+                    media_type=mimetypes.guess_type(full_path)[0] or "text/plain"
+                )
+                response.headers["Content-Encoding"] = encoding
+                break
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+
+        add_vary(response.headers, "Accept-Encoding")
+        is_hashed = os.path.dirname(os.path.abspath(full_path)) == os.path.abspath(DIST_DIR)
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE if is_hashed else REVALIDATE_CACHE
+
+        if self.is_not_modified(response.headers, request_headers):
+            return Response(status_code=304, headers={
+                name: value for name, value in response.headers.items()
+                if name.lower() in ("etag", "last-modified", "cache-control", "vary", "content-encoding")
+            })
+        return response
+
+
+_index_cache = {}
+
+
+# 首页: 替换成带哈希的资源路径,支持ETag
+def index_response(request: Request) -> Response:
+    page = _index_cache.get("page")
+    if page is None:
+        with open(os.path.join(STATIC_DIR, "index.html"), encoding="utf-8") as f:
+            html = f.read()
+        for asset, hashed in load_manifest().items():
+            html = html.replace(f"/static/{asset}", f"/static/{hashed}")
+        etag = '"' + hashlib.sha256(html.encode("utf-8")).hexdigest()[:16] + '"'
+        page = _index_cache["page"] = (html, etag)
+
+    html, etag = page
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(html, headers=headers)
+
+
+# 生成静态资源并统计一次页面加载传输的字节数: python static_assets.py
+if __name__ == "__main__":
+    manifest = build_assets()
+    files = ["index.html"] + list(ASSETS)
+    raw = sum(os.path.getsize(os.path.join(STATIC_DIR, name)) for name in files)
+    gz = sum(len(gzip.compress(open(os.path.join(STATIC_DIR, name), "rb").read(), 9)) for name in files)
+    print(f"已生成: {manifest}")
+    print(f"首次加载(未压缩): {raw} 字节")
+    print(f"首次加载(gzip): {gz} 字节")
+    if brotli is not None:
+        br = sum(len(brotli.compress(open(os.path.join(STATIC_DIR, name), "rb").read())) for name in files)
+        print(f"首次加载(brotli): {br} 字节")
+    print("再次加载: js/css命中永久缓存不发请求, index.html返回304(只有响应头)")
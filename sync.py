@@ -0,0 +1,66 @@
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from fast_json import RECORD_FIELDS, record_rows
+from models import ParkingLot, Record
+from pricing import priced
+from shards import shard_router
+
+
+# 增量同步
+# 前端第一次全量加载之后,只拉取游标之后发生变化的停车记录和停车场,在本地合并
+# 游标是数据库的当前时间,按updated_at(有索引)查询; 每次多往前查一小段重叠时间,
+# 覆盖秒级精度和提交顺序与时间戳顺序不一致的情况,重叠部分由前端按ID覆盖去重
+SYNC_OVERLAP_SECONDS = int(os.getenv("SYNC_OVERLAP_SECONDS", "5"))
+SYNC_MAX_CHANGES = int(os.getenv("SYNC_MAX_CHANGES", "1000"))  # 变化超过这个数量时让前端重新全量加载
+
+
+async def current_cursor(db: AsyncSession) -> datetime:
+    return await db.scalar(select(func.now()))
+
+
+async def _changed_records(db: AsyncSession, window: datetime, user_id: int, limit: int) -> list:
+    query = (
+        select(*[getattr(Record, name) for name in RECORD_FIELDS])
+        .filter(Record.updated_at >= window)
+        .order_by(Record.updated_at, Record.id)
+        .limit(limit + 1)
+    )
+    if user_id is not None:
+        query = query.filter(Record.user_id == user_id)
+    return (await db.execute(query)).all()
+
+
+async def _changed_lots(db: AsyncSession, window: datetime) -> list:
+    result = await db.execute(
+        select(ParkingLot).filter(ParkingLot.updated_at >= window).order_by(ParkingLot.id)
+    )
+    return result.scalars().all()
+
+
+# since为空时只返回当前游标,前端在全量加载之前先取游标
+# user_id为空时返回所有用户的记录(管理员); 游标取主库的时间,各分库的时钟差由重叠时间覆盖
+async def get_changes(since: datetime = None, user_id: int = None,
+                      include_records: bool = True, limit: int = SYNC_MAX_CHANGES) -> dict:
+    async with shard_router.session() as db:
+        cursor = await current_cursor(db)
+    changes = {"cursor": cursor, "reset": False, "records": [], "lots": []}
+    if since is None:
+        return changes
+
+    window = since - timedelta(seconds=SYNC_OVERLAP_SECONDS)
+
+    if include_records:
+        rows = await shard_router.gather(_changed_records, window=window, user_id=user_id, limit=limit)
+        if len(rows) > limit:
+            changes["reset"] = True
+            return changes
+        changes["records"] = record_rows(rows)
+
+    lots = await shard_router.gather(_changed_lots, window=window)
+    changes["lots"] = [priced(lot).model_dump() for lot in lots]
+    return changes
@@ -0,0 +1,302 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+import orjson
+from sqlalchemy import and_, delete, func, insert, or_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import statements
+from models import LotDailyStats, ParkingLot, QueuedTask, Record, TaskStatus
+from shards import shard_router
+
+
+# 后台任务队列
+# 出场请求只做状态变化(费用、记录、占用数),小票、统计汇总、通知等后续工作写成任务,在后台执行
+# 任务和状态变化在同一个事务里写进所在分库的task_queue表,请求成功就一定有对应的任务,进程重启也不会丢
+# 执行时先用条件UPDATE抢占任务(多进程不会重复执行),处理函数的数据库修改和"已完成"标记在同一个事务里提交
+# 失败按指数退避重试,超过次数标记为FAILED; 执行中的进程崩溃时,租约过期后任务被重新执行
+TASK_CONCURRENCY = int(os.getenv("TASK_CONCURRENCY", "4"))  # 同时执行的任务数
+TASK_POLL_INTERVAL = float(os.getenv("TASK_POLL_INTERVAL", "2"))  # 没有新任务通知时查询队列的间隔(秒)
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "5"))  # 最多执行次数
+TASK_RETRY_BASE = float(os.getenv("TASK_RETRY_BASE", "5"))  # 第一次重试的等待秒数,之后每次翻倍
+TASK_LEASE = int(os.getenv("TASK_LEASE", "300"))  # 执行租约(秒)
+TASK_RETENTION_HOURS = int(os.getenv("TASK_RETENTION_HOURS", "24"))  # 已完成的任务保留的小时数
+
+_handlers = {}
+
+
+# 注册任务处理函数: async def handler(db, payload),在任务所在的分库上执行,不需要自己提交
+def task_handler(kind: str):
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+# 在调用方的事务里写入任务,调用方提交之后再调用task_queue.notify()
+async def enqueue(db: AsyncSession, kind: str, payload: dict, delay: float = 0):
+    now = datetime.now()
+    await db.execute(
+        statements.INSERT_TASK,
+        {
+            "kind": kind,
+            "payload": orjson.dumps(payload).decode(),
+            "status": TaskStatus.PENDING,
+            "attempts": 0,
+            "run_at": now + timedelta(seconds=delay),
+            "created_at": now,
+        }
+    )
+
+
+def _claimable(now: datetime):
+    return or_(
+        and_(QueuedTask.status == TaskStatus.PENDING, QueuedTask.run_at <= now),
+        and_(QueuedTask.status == TaskStatus.RUNNING, QueuedTask.locked_until < now),
+    )
+
+
+class TaskQueue:
+    def __init__(self, concurrency: int = TASK_CONCURRENCY):
+        self.concurrency = concurrency
+        self.running = set()
+        self.wakeup = None  # 在run()里创建,绑定当前的事件循环
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.total_lag = 0.0  # 已完成任务从写入到开始执行的等待时间之和(秒)
+        self.max_lag = 0.0
+
+    # 有新任务时唤醒调度,不用等下一次轮询
+    def notify(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    # 抢占一个分库里最多limit个到期的任务
+    async def _claim(self, shard: int, limit: int) -> list:
+        now = datetime.now()
+        async with shard_router.session(shard) as db:
+            result = await db.execute(
+                select(QueuedTask).filter(_claimable(now)).order_by(QueuedTask.run_at, QueuedTask.id).limit(limit)
+            )
+            candidates = result.scalars().all()
+            claimed = []
+            for task in candidates:
+                updated = await db.execute(
+                    update(QueuedTask)
+                    .where(QueuedTask.id == task.id, _claimable(now))
+                    .values(
+                        status=TaskStatus.RUNNING,
+                        attempts=QueuedTask.attempts + 1,
+                        locked_until=now + timedelta(seconds=TASK_LEASE),
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                if updated.rowcount == 1:
+                    claimed.append(task)
+            await db.commit()
+        return [(shard, task) for task in claimed]
+
+    async def _run(self, shard: int, task: QueuedTask):
+        attempts = task.attempts + 1
+        lag = max(0.0, (datetime.now() - task.run_at).total_seconds())
+        async with shard_router.session(shard) as db:
+            try:
+                handler = _handlers.get(task.kind)
+                if handler is None:
+                    raise ValueError(f"未知的任务类型: {task.kind}")
+                await handler(db, orjson.loads(task.payload))
+                await db.execute(
+                    update(QueuedTask)
+                    .where(QueuedTask.id == task.id)
+                    .values(status=TaskStatus.DONE, locked_until=None, finished_at=datetime.now())
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+                self.completed += 1
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+            except Exception as e:
+                await db.rollback()
+                failed = attempts >= TASK_MAX_ATTEMPTS
+                values = {"locked_until": None, "last_error": str(e)[:1000]}
+                if failed:
+                    values.update(status=TaskStatus.FAILED, finished_at=datetime.now())
+                    self.failed += 1
+                    logging.error(f"任务 {task.kind}#{task.id}(分库 {shard}) 执行 {attempts} 次仍然失败: {str(e)}")
+                else:
+                    delay = TASK_RETRY_BASE * 2 ** (attempts - 1)
+                    values.update(status=TaskStatus.PENDING, run_at=datetime.now() + timedelta(seconds=delay))
+                    self.retried += 1
+                    logging.warning(f"任务 {task.kind}#{task.id}(分库 {shard}) 执行失败, {delay:g} 秒后重试: {str(e)}")
+                await db.execute(
+                    update(QueuedTask)
+                    .where(QueuedTask.id == task.id)
+                    .values(**values)
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+
+    def _start(self, shard: int, task: QueuedTask):
+        job = asyncio.create_task(self._run(shard, task))
+        self.running.add(job)
+
+        def done(job):
+            self.running.discard(job)
+            self.notify()  # 有空闲的执行位,马上取下一批
+        job.add_done_callback(done)
+
+    # 调度循环: 有空闲的执行位时从各分库抢占任务,最多同时执行concurrency个
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                self.wakeup.clear()
+                for shard in range(len(shard_router)):
+                    free = self.concurrency - len(self.running)
+                    if free <= 0:
+                        break
+                    for shard_id, task in await self._claim(shard, free):
+                        self._start(shard_id, task)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"调度后台任务时发生错误: {str(e)}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), TASK_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    # 队列深度和延迟: 每个分库等待/执行中/失败的任务数,最早的到期任务已经等待的秒数
+    async def metrics(self) -> dict:
+        now = datetime.now()
+
+        async def load(db):
+            counts = await db.execute(
+                select(QueuedTask.status, func.count(QueuedTask.id))
+                .filter(QueuedTask.status != TaskStatus.DONE)
+                .group_by(QueuedTask.status)
+            )
+            oldest = await db.scalar(
+                select(func.min(QueuedTask.run_at))
+                .filter(QueuedTask.status == TaskStatus.PENDING, QueuedTask.run_at <= now)
+            )
+            return [(dict(counts.all()), oldest)]
+
+        depth = {status.value: 0 for status in (TaskStatus.PENDING, TaskStatus.RUNNING, TaskStatus.FAILED)}
+        oldest = None
+        for counts, shard_oldest in await shard_router.gather(load):
+            for task_status, count in counts.items():
+                depth[getattr(task_status, "value", task_status)] += count
+            if shard_oldest is not None and (oldest is None or shard_oldest < oldest):
+                oldest = shard_oldest
+        return {
+            "depth": depth,
+            "lag_seconds": round((now - oldest).total_seconds(), 3) if oldest else 0.0,
+            "running": len(self.running),
+            "concurrency": self.concurrency,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "avg_lag_seconds": round(self.total_lag / self.completed, 3) if self.completed else 0.0,
+            "max_lag_seconds": round(self.max_lag, 3),
+        }
+
+    # 删除保留期之前已完成的任务(失败的任务保留,等待人工处理)
+    async def purge(self) -> int:
+        cutoff = datetime.now() - timedelta(hours=TASK_RETENTION_HOURS)
+
+        async def purge_shard(db):
+            result = await db.execute(
+                delete(QueuedTask)
+                .where(QueuedTask.status == TaskStatus.DONE, QueuedTask.finished_at < cutoff)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+            return result.rowcount
+        return sum(await shard_router.scatter(purge_shard))
+
+
+task_queue = TaskQueue()
+
+
+async def purge_loop():
+    while True:
+        try:
+            purged = await task_queue.purge()
+            if purged:
+                logging.info(f"已清理 {purged} 个已完成的后台任务")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"清理后台任务时发生错误: {str(e)}")
+        await asyncio.sleep(3600)
+
+
+# 出场后的任务
+
+# 出场请求提交前调用,和记录的状态变化在同一个事务里
+async def enqueue_checkout(db: AsyncSession, record_id: int, parking_lot_id: int, exit_time: datetime, amount: float):
+    payload = {
+        "record_id": record_id,
+        "parking_lot_id": parking_lot_id,
+        "exit_time": exit_time.isoformat(),
+        "amount": amount,
+    }
+    await enqueue(db, "checkout_stats", payload)
+    await enqueue(db, "checkout_receipt", payload)
+
+
+# 累加停车场当天的出场车次和收入; 并发的第一次插入冲突时任务失败,重试时走UPDATE
+@task_handler("checkout_stats")
+async def update_daily_stats(db: AsyncSession, payload: dict):
+    day = datetime.fromisoformat(payload["exit_time"]).date()
+    amount = payload["amount"] or 0.0
+    result = await db.execute(
+        update(LotDailyStats)
+        .where(LotDailyStats.parking_lot_id == payload["parking_lot_id"], LotDailyStats.day == day)
+        .values(checkouts=LotDailyStats.checkouts + 1, revenue=LotDailyStats.revenue + amount)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        await db.execute(
+            insert(LotDailyStats).values(
+                parking_lot_id=payload["parking_lot_id"], day=day, checkouts=1, revenue=amount
+            )
+        )
+
+
+# 生成停车小票并通知用户; 还没有接入短信/推送渠道,先写日志
+@task_handler("checkout_receipt")
+async def send_receipt(db: AsyncSession, payload: dict):
+    result = await db.execute(
+        select(Record.id, Record.user_id, Record.car_number, Record.entry_time, ParkingLot.name)
+        .join(ParkingLot, ParkingLot.id == Record.parking_lot_id)
+        .filter(Record.id == payload["record_id"])
+    )
+    row = result.first()
+    if row is None:
+        return
+    logging.info(
+        f"停车小票: 记录 {row.id}, 用户 {row.user_id}, 车辆 {row.car_number}, 停车场 {row.name}, "
+        f"入场 {row.entry_time}, 出场 {payload['exit_time']}, 费用 {payload['amount']:.2f}"
+    )
+
+
+# 每个停车场最近days天的出场车次和收入
+async def daily_stats(parking_lot_id: int = None, days: int = 30) -> list:
+    since = datetime.now().date() - timedelta(days=days - 1)
+
+    async def load(db):
+        query = select(LotDailyStats).filter(LotDailyStats.day >= since)
+        if parking_lot_id is not None:
+            query = query.filter(LotDailyStats.parking_lot_id == parking_lot_id)
+        result = await db.execute(query.order_by(LotDailyStats.day.desc(), LotDailyStats.parking_lot_id))
+        return [
+            {"parking_lot_id": s.parking_lot_id, "day": s.day, "checkouts": s.checkouts, "revenue": s.revenue}
+            for s in result.scalars().all()
+        ]
+    return await shard_router.gather(load, sort_key=lambda s: (s["day"], -s["parking_lot_id"]), descending=True)